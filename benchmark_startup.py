@@ -0,0 +1,102 @@
+"""Measure how long the GUI takes to start.
+
+Reports the import-time breakdown of woundcomputegui.main_gui (from ``python -X importtime``) and the time from
+process start until the main window is shown, using the offscreen Qt platform so it also runs without a display.
+Every measurement runs in a fresh interpreter. Use --max-window-seconds to fail when startup gets slower than a
+known-good value, e.g.
+
+    python benchmark_startup.py --runs 5 --max-window-seconds 2.0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+
+WINDOW_SNIPPET = """
+import os, sys, time
+t_start = float(os.environ['WCGUI_BENCH_T0'])
+import woundcomputegui.main_gui as mg
+t_import = time.time()
+app = mg.QApplication(sys.argv)
+window = mg.MyWindow()
+window.show()
+app.processEvents()
+t_window = time.time()
+print(f'{t_import - t_start} {t_window - t_start}')
+"""
+
+
+def import_breakdown(module: str, top_n: int) -> (float, list):
+    """Given a module name. Returns the total import time in seconds and the top_n slowest top-level packages as
+    (package, cumulative seconds), from a fresh interpreter run with -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    packages = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level after the separator's own space
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        seconds = int(cumulative) / 1e6
+        # Only modules imported directly by the interpreter (depth 0) add up to the total
+        if depth == 0:
+            total += seconds
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0.0) + seconds
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top_n]
+    return total, slowest
+
+
+def time_to_window() -> (float, float):
+    """Returns (seconds until main_gui is imported, seconds until the window is shown) for one fresh process"""
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    env['WCGUI_BENCH_T0'] = repr(time.time())
+    result = subprocess.run([sys.executable, '-c', WINDOW_SNIPPET], capture_output=True, text=True, env=env,
+                            check=True)
+    t_import, t_window = result.stdout.split()[-2:]
+    return float(t_import), float(t_window)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes to time (default: 5)")
+    parser.add_argument('--top', type=int, default=15, help="slowest packages to list (default: 15)")
+    parser.add_argument('--module', default='woundcomputegui.main_gui', help="module for the import breakdown")
+    parser.add_argument('--max-window-seconds', type=float,
+                        help="exit with an error when the median time to first window is above this")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to a .json file")
+    args = parser.parse_args(argv)
+
+    total, slowest = import_breakdown(args.module, args.top)
+    print(f"Import time of {args.module}: {total:.3f} s")
+    for package, seconds in slowest:
+        print(f"\t{package:<30s} {seconds:8.3f} s")
+
+    runs = [time_to_window() for _ in range(args.runs)]
+    median_import = statistics.median(run[0] for run in runs)
+    median_window = statistics.median(run[1] for run in runs)
+    print(f"Time to first window over {args.runs} runs: median {median_window:.3f} s "
+          f"(import {median_import:.3f} s), min {min(run[1] for run in runs):.3f} s, "
+          f"max {max(run[1] for run in runs):.3f} s")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'module': args.module, 'import_seconds': total, 'slowest_packages': slowest,
+                       'window_runs': runs, 'median_window_seconds': median_window}, file, indent=2)
+
+    if args.max_window_seconds is not None and median_window > args.max_window_seconds:
+        print(f"Error: median time to first window {median_window:.3f} s is above "
+              f"{args.max_window_seconds:.3f} s.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,13 @@
 import sys
-import woundcomputegui.main_gui as mg
 
 # Main function to run the application
 def main():
+    # Imported here so worker processes that re-import this script on spawn platforms do not load the GUI
+    import woundcomputegui.main_gui as mg
     app = mg.QApplication(sys.argv)
     window = mg.MyWindow()
     window.show()
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,271 @@
+"""Headless command line interface for woundcomputegui.
+
+Runs the same organize / run / extract steps as the GUI without importing PyQt5, so plates can be processed on
+compute nodes without a display, e.g.
+
+    woundcomputegui all /data/plate_01 --output-name Sorted --image-type ph1 --cpu-percent 80 --interval 0.5
+"""
+import os
+import sys
+import time
+import argparse
+from humanfriendly import format_timespan
+
+# Never let matplotlib pick a Qt backend on a headless node
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import woundcomputegui.wc_functions as wcf
+import woundcomputegui.data_management as dm
+
+
+def parse_frame_inds(text: str) -> list:
+    """Given a comma-separated string of frame indices. Returns them as a list of int"""
+    if not text:
+        return []
+    try:
+        return [int(x) for x in text.split(',') if x.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated frame indices, got '{text}'")
+
+
+def export_formats(text: str) -> tuple:
+    """Given a comma-separated list of formats, e.g. xlsx,parquet. Returns them as a tuple"""
+    formats = tuple(f.strip().lower() for f in text.split(',') if f.strip())
+    unknown = [f for f in formats if f not in dm.EXPORT_FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(f"expected a comma-separated list of {', '.join(dm.EXPORT_FORMATS)}")
+    return formats
+
+
+def percent(text: str) -> int:
+    value = int(text)
+    if not 1 <= value <= 100:
+        raise argparse.ArgumentTypeError("percent must be between 1 and 100")
+    return value
+
+
+def build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--image-type', default='ph1',
+                        choices=['ph1', 'dic', 'Phase contrast', 'Differential interference contrast'],
+                        help="microscope image type (default: ph1)")
+    common.add_argument('--low-quality-frames', type=parse_frame_inds, default=[], metavar='INDS',
+                        help="comma-separated frame indices to skip, e.g. 0,1,2")
+    common.add_argument('--run-together', action=argparse.BooleanOptionalAction, default=True,
+                        help="run before injury (*_bi) and after injury (*_ai) data together (default: on)")
+
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--output-name', required=True,
+                        help="name of the sorted folder created inside the input folder; an interrupted organize "
+                             "run in this folder is resumed")
+    output.add_argument('--organize-mode', default='copy', choices=list(wcf.LINK_MODE_ORDER),
+                        help="how raw images are placed in the sorted folder (default: copy)")
+
+    organize = argparse.ArgumentParser(add_help=False)
+    organize.add_argument('--dedup', default='off', choices=['off', 'fast', 'full'],
+                          help="link frames identical to ones organized by an earlier run (default: off)")
+    organize.add_argument('--pack-stacks', action='store_true',
+                          help="also pack each sample's images into one stack file (.npy)")
+    organize.add_argument('--remove-tifs', action='store_true',
+                          help="with --pack-stacks, delete each sample's .tif files once packed; WoundCompute gets "
+                               "them back from the stack while it runs")
+
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument('--cpu-percent', type=percent, default=80,
+                     help="maximum CPU %% usage while running WoundCompute (default: 80)")
+    run.add_argument('--force', action='store_true',
+                     help="re-analyze every position, including those whose outputs are up to date")
+
+    # Scheduler options of run and all; watch submits each position as it completes and does not use them
+    schedule = argparse.ArgumentParser(add_help=False)
+    schedule.add_argument('--memory-percent', type=percent, default=80,
+                          help="share of RAM the WoundCompute processes may use; a position only starts when its "
+                               "expected memory fits (default: 80)")
+    schedule.add_argument('--frame-chunks', type=int, metavar='FRAMES',
+                          help="segment positions with at least twice this many frames in chunks of FRAMES frames "
+                               "on several cores, for plates with few wells and long time-lapses (default: off)")
+
+    extract = argparse.ArgumentParser(add_help=False)
+    extract.add_argument('--interval', type=float, default=0.5,
+                         help="imaging interval in hours (default: 0.5)")
+    extract.add_argument('--export', type=export_formats, default=('xlsx',), metavar='FORMATS',
+                         help="comma-separated output formats: xlsx (code_output_<basename>.xlsx), parquet and/or "
+                              "feather (one file per table in code_output_<basename>/, needs pyarrow) "
+                              "(default: xlsx)")
+    extract.add_argument('--condition-map', metavar='FILE',
+                         help=".csv or .xlsx with Well, Condition_Number and Condition_Name columns (and optionally "
+                              "Basename). Without it, an existing condition_map sheet is reused, or every well is "
+                              "assigned to Condition_1")
+
+    parser = argparse.ArgumentParser(prog='woundcomputegui', description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sp = subparsers.add_parser('organize', parents=[common, output, organize],
+                               help="organize .tif files and prepare .yaml files")
+    sp.add_argument('input', help="directory with .TIF files")
+
+    sp = subparsers.add_parser('run', parents=[common, run, schedule], help="run WoundCompute on an organized folder")
+    sp.add_argument('organized', help="folder with organized data")
+    mode = sp.add_mutually_exclusive_group()
+    mode.add_argument('--failed-only', action='store_true',
+                      help=f"only re-run the positions listed in {wcf.FAILURE_LIST_NAME} by an earlier run")
+    mode.add_argument('--resume', action='store_true',
+                      help=f"continue an interrupted run: only run the positions {wcf.LEDGER_NAME} does not record "
+                           f"as done")
+
+    sp = subparsers.add_parser('extract', parents=[common, extract], help="extract metadata from an organized folder")
+    sp.add_argument('organized', help="folder with organized data")
+
+    sp = subparsers.add_parser('all', parents=[common, output, organize, run, schedule, extract],
+                               help="organize, run WoundCompute and extract metadata")
+    sp.add_argument('input', help="directory with .TIF files")
+
+    sp = subparsers.add_parser('watch', parents=[common, output, run, extract],
+                               help="organize and analyze each stage position while a MetaMorph plate is being "
+                                    "acquired")
+    sp.add_argument('input', help="directory the microscope writes .TIF files to")
+    sp.add_argument('--expected-frames', type=int, metavar='N',
+                    help="frames per stage position (default: NTimePoints times wavelengths from the .nd file)")
+    sp.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                    help="stop after this long without new files and analyze incomplete positions (default: wait "
+                         "until every stage position in the .nd files is complete)")
+    sp.add_argument('--poll-interval', type=float, default=2.0, metavar='SECONDS',
+                    help="seconds between folder scans when polling (default: 2)")
+    sp.add_argument('--inotify', action=argparse.BooleanOptionalAction, default=True,
+                    help="use inotify on Linux instead of polling (default: on)")
+    sp.add_argument('--extract', action='store_true', help="extract metadata once watching ends")
+    return parser
+
+
+def prepare_output_folder(path_input: str, output_name: str) -> str:
+    """Create the sorted folder inside path_input, or reuse it when it holds an interrupted organize run. Any other
+    existing folder, including one whose organize run finished, is refused"""
+    path_output = os.path.join(path_input, output_name.strip())
+    if wcf.organize_unfinished(path_output):
+        print(f"\tResuming the previous organize run in {path_output}")
+        return path_output
+    if os.path.exists(path_output):
+        raise SystemExit(f"Error: folder '{path_output}' already exists! Please choose a new --output-name.")
+    os.makedirs(path_output)
+    return path_output
+
+
+def resolve_compiled_mode(basename_list: list, path_output, run_together: bool) -> bool:
+    """Decide whether Extract reads the *_compiled folders. Falls back to the *_ai and *_bi folders when compiled
+    folders are missing, which is the only choice the GUI offers in that case"""
+    found_compiled, missing_compiled = wcf.compiled_folder_status(basename_list, path_output)
+    if run_together and missing_compiled:
+        print(f"\tCompiled folder(s) missing: {', '.join(missing_compiled)}. Extracting from *_ai and *_bi folders.")
+        return False
+    if not run_together and found_compiled:
+        print(f"\tIgnoring compiled folder(s) {', '.join(found_compiled)} because --no-run-together was given.")
+    return run_together
+
+
+def check_for_segmentation(path_output, basename: str, image_type: str):
+    if 'warn' in basename:
+        return
+    basename_path = os.path.join(path_output, basename)
+    folder_path_list = sorted(n1.path for n1 in os.scandir(basename_path) if n1.is_dir())
+    if not folder_path_list or not os.path.isdir(os.path.join(folder_path_list[0], "segment_" + image_type)):
+        raise SystemExit("Error: cannot find folder containing segmented images. Please run WoundCompute first.")
+
+
+def condition_map_for(args, path_output, basename: str, stage_pos_map: dict):
+    if args.condition_map:
+        df_assignments = dm.read_condition_map_file(args.condition_map, basename)
+        if df_assignments.empty:
+            print(f"\tNo rows for {basename} in {args.condition_map}.")
+        else:
+            dm.save_condition_map(path_output, basename, df_assignments)
+            return df_assignments
+    df_assignments = dm.read_condition_map(path_output, basename)
+    if df_assignments is None:
+        print(f"\tNo condition map for {basename}; assigning every well to Condition_1.")
+        df_assignments = dm.default_condition_map(stage_pos_map)
+        dm.save_condition_map(path_output, basename, df_assignments)
+    return df_assignments
+
+
+def extract_metadata(args, path_output, basename_list: list, stage_pos_maps: dict, image_type: str,
+                     use_compiled: bool):
+    print("Extracting metadata...")
+    if use_compiled:
+        basename_list = dm.compiled_basename_list(basename_list, stage_pos_maps)
+        print(f"\tCompiled-mode basename list: {basename_list}")
+
+    for basename in basename_list:
+        if 'warn' in basename:
+            continue
+        df_assignments = condition_map_for(args, path_output, basename, stage_pos_maps.get(basename, {}))
+        dm.extract_basename_outputs(path_output, basename, image_type, args.interval, df_assignments, args.export)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    image_type = dm.match_image_type_formatting(args.image_type)
+    if set(getattr(args, 'export', ())) - {'xlsx'} and not dm.columnar_export_available():
+        raise SystemExit("Error: Parquet and Feather export need pyarrow (pip install pyarrow).")
+    if getattr(args, 'remove_tifs', False) and not args.pack_stacks:
+        raise SystemExit("Error: --remove-tifs needs --pack-stacks.")
+    time_start = time.time()
+
+    if args.command == 'watch':
+        print("Watching for new .tif files...")
+        path_output = prepare_output_folder(args.input, args.output_name)
+        try:
+            basename_list, stage_pos_maps = wcf.watch_plate(
+                args.input, path_output, image_type, args.low_quality_frames, args.run_together, args.cpu_percent,
+                link_mode=args.organize_mode, expected_frames=args.expected_frames, poll_interval=args.poll_interval,
+                idle_timeout=args.idle_timeout, use_inotify=args.inotify, force=args.force,
+            )
+        except ValueError as e:
+            raise SystemExit(f"Error: {e}")
+        if args.extract and basename_list:
+            extract_metadata(args, path_output, basename_list, stage_pos_maps, image_type, args.run_together)
+        print("Total time taken:", format_timespan(time.time() - time_start))
+        return 0
+
+    if args.command in ('organize', 'all'):
+        print("Organizing .tif files and preparing .yaml files...")
+        path_output = prepare_output_folder(args.input, args.output_name)
+        basename_list, stage_pos_maps = wcf.organize_plate(
+            args.input, path_output, image_type, args.low_quality_frames, args.run_together,
+            link_mode=args.organize_mode, dedup=None if args.dedup == 'off' else args.dedup,
+            pack_stacks=args.pack_stacks, remove_tifs=args.remove_tifs,
+        )
+    else:
+        path_output = args.organized
+        if not os.path.isdir(path_output):
+            raise SystemExit(f"Error: '{path_output}' is not a folder.")
+        basename_list, stage_pos_maps = wcf.load_organized_plate(path_output)
+        if not basename_list:
+            raise SystemExit("Error: no sorted directory found in '%s'." % path_output)
+        wcf.update_wc_yamls(path_output, image_type, args.low_quality_frames, args.run_together)
+
+    if args.command in ('run', 'all'):
+        print("Running WoundCompute...")
+        if getattr(args, 'failed_only', False):
+            wcf.wc_process_failed(path_output, args.cpu_percent, args.memory_percent, args.frame_chunks)
+        elif getattr(args, 'resume', False):
+            wcf.wc_resume_run(path_output, args.cpu_percent, args.memory_percent, args.frame_chunks)
+        else:
+            wcf.run_plate(path_output, basename_list, args.cpu_percent, args.run_together, args.memory_percent,
+                          args.force, args.frame_chunks)
+        print("\tDone running WoundCompute!")
+
+    if args.command in ('extract', 'all'):
+        use_compiled = resolve_compiled_mode(basename_list, path_output, args.run_together)
+        if args.command == 'extract':
+            seg_basename = basename_list[0]
+            if use_compiled and seg_basename.endswith('_ai'):
+                seg_basename = seg_basename[:-len('_ai')] + '_compiled'
+            check_for_segmentation(path_output, seg_basename, image_type)
+        extract_metadata(args, path_output, basename_list, stage_pos_maps, image_type, use_compiled)
+
+    print("Total time taken:", format_timespan(time.time() - time_start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
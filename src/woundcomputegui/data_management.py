@@ -1,10 +1,12 @@
 import os
 import shutil
-import pandas as pd
-import openpyxl
-import matplotlib.pyplot as plt
 import re
-import numpy as np
+import io
+import time
+import sqlite3
+import importlib.util
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 def match_image_type_formatting(img_type:str)->str:
@@ -18,8 +20,329 @@ def match_image_type_formatting(img_type:str)->str:
         raise ValueError(f"Unsupported image type: {img_type}")
 
 
+# CONDITION MAP FUNCTIONS #
+def condition_map_path(path_output_fn, basename_fn: str) -> str:
+    return os.path.join(path_output_fn, f'code_output_{basename_fn}.xlsx')
+
+
+def read_condition_map(path_output_fn, basename_fn: str):
+    """Returns the condition_map sheet of an existing code_output_<basename>.xlsx, or None"""
+    import pandas as pd
+    path_map = condition_map_path(path_output_fn, basename_fn)
+    if not os.path.exists(path_map):
+        return None
+    print("\tFound existing condition map file.")
+    try:
+        return pd.read_excel(path_map, sheet_name='condition_map')
+    except Exception as e:
+        print("\tError reading condition map file:", e)
+        return None
+
+
+def save_condition_map(path_output_fn, basename_fn: str, df_assignments):
+    # Save the condition map to an Excel file
+    df_assignments.to_excel(condition_map_path(path_output_fn, basename_fn), sheet_name='condition_map', index=False)
+    print("\tCondition map saved to Excel file")
+
+
+def read_condition_map_file(fpath: str, basename_fn: str = None):
+    """Read a condition map from a .csv or .xlsx file with Well, Condition_Number and Condition_Name columns. If the
+    file has a Basename column, only the rows of basename_fn are returned"""
+    import pandas as pd
+    if fpath.lower().endswith('.csv'):
+        df = pd.read_csv(fpath)
+    else:
+        df = pd.read_excel(fpath, sheet_name=0)
+    missing = {'Well', 'Condition_Number', 'Condition_Name'} - set(df.columns)
+    if missing:
+        raise ValueError(f"Condition map {fpath} is missing column(s): {', '.join(sorted(missing))}")
+    if 'Basename' in df.columns and basename_fn is not None:
+        df = df[df['Basename'] == basename_fn]
+    return df[['Well', 'Condition_Number', 'Condition_Name']].reset_index(drop=True)
+
+
+WELL_PATTERN = re.compile(r'([A-H]\d{2})')
+
+
+def well_of(name) -> str:
+    """The well (e.g. A01) in a stage position or sample folder name, or the name itself"""
+    match = WELL_PATTERN.search(str(name))
+    return match.group(1) if match else str(name)
+
+
+def default_condition_map(stage_pos_map: dict):
+    """Assign every well of a stage position map to Condition_1"""
+    import pandas as pd
+    wells = [well_of(v) for v in stage_pos_map.values()]
+    return pd.DataFrame({'Well': wells, 'Condition_Number': 1, 'Condition_Name': 'Condition_1'})
+
+
+def compiled_basename_list(basename_list_fn: list, stage_pos_maps: dict) -> list:
+    """Replace every *_ai basename by its *_compiled folder and drop the *_bi basenames. The compiled folders reuse
+    the stage position map of their *_ai basename"""
+    compiled_list = []
+    for bn in basename_list_fn:
+        if bn.endswith('_ai'):
+            compiled_bn = bn[:-len('_ai')] + '_compiled'
+            compiled_list.append(compiled_bn)
+            if compiled_bn not in stage_pos_maps:
+                stage_pos_maps[compiled_bn] = stage_pos_maps.get(bn, {})
+        elif bn.endswith('_bi'):
+            continue
+        else:
+            compiled_list.append(bn)
+    return compiled_list
+
+
+# RESULTS DATABASE #
+RESULTS_STORE_NAME = 'results.sqlite'
+
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conditions (
+    basename TEXT NOT NULL, well TEXT NOT NULL, condition_number INTEGER, condition_name TEXT,
+    PRIMARY KEY (basename, well));
+CREATE INDEX IF NOT EXISTS conditions_name ON conditions(condition_name);
+
+CREATE TABLE IF NOT EXISTS metrics (
+    basename TEXT NOT NULL, sample TEXT NOT NULL, well TEXT, metric TEXT NOT NULL, frame INTEGER NOT NULL,
+    time REAL, value REAL,
+    PRIMARY KEY (basename, sample, metric, frame)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metrics_metric_frame ON metrics(metric, frame);
+CREATE INDEX IF NOT EXISTS metrics_basename_well ON metrics(basename, well);
+
+CREATE TABLE IF NOT EXISTS pillar_metrics (
+    basename TEXT NOT NULL, sample TEXT NOT NULL, well TEXT, metric TEXT NOT NULL, frame INTEGER NOT NULL,
+    pillar INTEGER NOT NULL, time REAL, value REAL,
+    PRIMARY KEY (basename, sample, metric, frame, pillar)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pillar_metrics_metric_frame ON pillar_metrics(metric, frame);
+CREATE INDEX IF NOT EXISTS pillar_metrics_basename_well ON pillar_metrics(basename, well);
+
+CREATE VIEW IF NOT EXISTS metrics_by_condition AS
+    SELECT m.*, c.condition_number, c.condition_name FROM metrics m
+    LEFT JOIN conditions c ON c.basename = m.basename AND c.well = m.well;
+CREATE VIEW IF NOT EXISTS pillar_metrics_by_condition AS
+    SELECT p.*, c.condition_number, c.condition_name FROM pillar_metrics p
+    LEFT JOIN conditions c ON c.basename = p.basename AND c.well = p.well;
+"""
+
+
+class ResultsStore:
+    """SQLite database (results.sqlite in an output folder) with the extracted tables of every basename, so that
+    experiments can be compared with indexed SQL instead of opening one workbook per basename, e.g. the mean wound
+    area per condition at frame 10:
+
+        SELECT condition_name, AVG(value) FROM metrics_by_condition
+        WHERE metric = 'wound_area' AND frame = 10 GROUP BY condition_name
+
+    Per-frame metrics go to the metrics table, one row per (basename, sample, metric, frame). Pillar tables go to
+    pillar_metrics with a row per pillar, under the metric '<table>.<column>', e.g. 'pillar_positions.X'. Extracting
+    a basename again replaces all of its rows, so frames, wells or metrics that are gone do not linger. Its condition
+    map is joined on (basename, well) by the *_by_condition views. The output folder is often on a network share,
+    where SQLite's WAL mode is not safe, so the database uses the default rollback journal"""
+
+    def __init__(self, path_output_fn):
+        self.path = os.path.join(path_output_fn, RESULTS_STORE_NAME)
+        self._conn = sqlite3.connect(self.path, timeout=60)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=DELETE')
+            self._conn.executescript(RESULTS_SCHEMA)
+
+    def replace_basename(self, basename_fn: str, dfs: dict):
+        """Given the {table name: DataFrame} returned by extract_data for one basename. Replaces the stored rows of
+        that basename with its tables in a single transaction"""
+        import pandas as pd
+
+        time_start = time.time()
+        metric_rows, pillar_rows = [], []
+        for name, df in dfs.items():
+            if name == 'condition_map' or df.empty:
+                continue
+            if 'Pillar' in df.columns:
+                for column in [c for c in df.columns if c not in ('Sample', 'Frame', 'Time', 'Pillar')]:
+                    values = pd.to_numeric(df[column], errors='coerce')
+                    pillar_rows += zip([basename_fn] * len(df), df['Sample'], map(well_of, df['Sample']),
+                                       [f'{name}.{column}'] * len(df), df['Frame'].astype(int), df['Pillar'].astype(int),
+                                       df['Time'].astype(float), values.astype(float))
+            else:
+                for sample in [c for c in df.columns if c not in ('Frame', 'Time')]:
+                    values = pd.to_numeric(df[sample], errors='coerce')
+                    metric_rows += zip([basename_fn] * len(df), [str(sample)] * len(df), [well_of(sample)] * len(df),
+                                       [name] * len(df), df['Frame'].astype(int), df['Time'].astype(float),
+                                       values.astype(float))
+
+        condition_rows = []
+        if 'condition_map' in dfs:
+            # Condition maps come from user files; a missing or non-numeric condition number is stored as NULL
+            df_map = dfs['condition_map']
+            numbers = pd.to_numeric(df_map['Condition_Number'], errors='coerce')
+            condition_rows = [(basename_fn, str(well), None if pd.isna(number) else int(number),
+                               None if pd.isna(condition) else str(condition))
+                              for well, number, condition in zip(df_map['Well'], numbers, df_map['Condition_Name'])
+                              if not pd.isna(well)]
+
+        with self._conn:
+            for table in ('metrics', 'pillar_metrics', 'conditions'):
+                self._conn.execute(f'DELETE FROM {table} WHERE basename = ?', (basename_fn,))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO conditions (basename, well, condition_number, condition_name) '
+                'VALUES (?, ?, ?, ?)', condition_rows)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO metrics (basename, sample, well, metric, frame, time, value) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((b, s, w, m, int(f), float(t), None if v != v else float(v)) for b, s, w, m, f, t, v in metric_rows))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO pillar_metrics (basename, sample, well, metric, frame, pillar, time, value) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((b, s, w, m, int(f), int(p), float(t), None if v != v else float(v))
+                 for b, s, w, m, f, p, t, v in pillar_rows))
+        print(f"\tStored {len(metric_rows)} metric and {len(pillar_rows)} pillar values of {basename_fn} in "
+              f"{self.path} in {time.time() - time_start:.2f} s")
+
+    def close(self):
+        self._conn.close()
+
+
+def extract_basename_outputs(path_output_fn, basename_fn: str, image_type: str, interval_in, df_assignments,
+                             export_formats=('xlsx',)):
+    """Extract data for one basename into code_output_<basename>.xlsx and/or the Parquet or Feather tables of
+    code_output_<basename>, and gather its result images"""
+
+    # Extract data from the folders and create an Excel file
+    dfs = extract_data(path_output_fn, basename_fn, image_type, interval_in, df_assignments, export_formats)
+    print(f"\tData of {basename_fn} extracted ({', '.join(export_formats)})")
+
+    # Add the tables to the results database shared by all basenames of this output folder
+    if dfs:
+        store = ResultsStore(path_output_fn)
+        store.replace_basename(basename_fn, dfs)
+        store.close()
+
+    # Move ph1_contour_all_*.png images from all samples into the same folder
+    conglomerate_segmentation_images(path_output_fn, basename_fn, image_type)
+    conglomerate_pillar_disps_images(path_output_fn, basename_fn, image_type)
+    print("\tDone extracting data!")
+
+
 # DATA EXTRACTION AND VISUALIZATION FUNCTIONS #
-def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval_in: int, df_assignments_in) -> (dict,list) :
+# Output formats of extract_data: the Excel workbook and/or one columnar file per table (needs pyarrow)
+EXPORT_FORMATS = ('xlsx', 'parquet', 'feather')
+
+
+def columnar_export_available() -> bool:
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def columnar_output_folder(path_output_fn, basename_fn: str) -> str:
+    return os.path.join(path_output_fn, f'code_output_{basename_fn}')
+
+
+# Concurrent reads of the per-position text files; the reads are I/O-bound, so this can exceed the core count
+EXTRACT_READ_WORKERS = 16
+
+
+def read_text_files(paths: list, max_workers: int = EXTRACT_READ_WORKERS) -> dict:
+    """Given a list of file paths. Reads them concurrently with a bounded thread pool and reports the throughput.
+    Returns {path: text}, with the OSError instead of the text for files that could not be read"""
+
+    def read(path):
+        try:
+            with open(path, 'r') as file:
+                return file.read()
+        except OSError as e:
+            return e
+
+    time_start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        texts = dict(zip(paths, executor.map(read, paths)))
+    seconds = max(time.time() - time_start, 1e-6)
+    num_bytes = sum(len(text) for text in texts.values() if isinstance(text, str))
+    print(f"\tRead {len(paths)} files ({num_bytes / 1e6:.1f} MB) in {seconds:.2f} s: {len(paths) / seconds:.0f} "
+          f"files/s, {num_bytes / 1e6 / seconds:.1f} MB/s")
+    return texts
+
+
+def text_of(texts: dict, path) -> str:
+    """The text read by read_text_files for path; raises the read error if it failed"""
+    text = texts.get(path)
+    if text is None:
+        text = read_text_files([path])[path]
+    if isinstance(text, Exception):
+        raise text
+    return text
+
+
+def read_table_text(texts: dict, path):
+    """pd.read_table(path, header=None) on the text read by read_text_files; raises the read error if it failed"""
+    import pandas as pd
+    return pd.read_table(io.StringIO(text_of(texts, path)), header=None)
+
+
+def parse_pillar_values(text: str, frames: int):
+    """Given the text of a pillar tracker file, one line per frame with a whitespace-separated value per pillar.
+    Returns a (frames x pillars) float array padded with NaN where a line has fewer values or is missing, a boolean
+    array of the same shape that is True where a value was present and parsed (a literal nan counts as parsed), and
+    the number of values on each frame line"""
+    import numpy as np
+    import pandas as pd
+
+    lines = [line.split('\t')[0] for line in text.splitlines() if line.strip()][:frames]
+    counts = np.zeros(frames, dtype=int)
+    counts[:len(lines)] = [len(line.split()) for line in lines]
+    values = np.full((frames, int(counts.max()) if frames else 0), np.nan)
+    parsed = np.zeros(values.shape, dtype=bool)
+
+    num_tokens = int(counts.sum())
+    if num_tokens:
+        joined = ' '.join(lines)
+        # fromstring parses in C but fails (or stops early) at a token that is not a number; only then are the
+        # tokens parsed one by one
+        try:
+            numbers = np.fromstring(joined, sep=' ')
+        except ValueError:
+            numbers = np.empty(0)
+        valid = np.ones(num_tokens, dtype=bool)
+        if numbers.size != num_tokens:
+            tokens = np.array(joined.split())
+            numbers = pd.to_numeric(pd.Series(tokens), errors='coerce').to_numpy(dtype=float)
+            valid = ~np.isnan(numbers) | np.isin(np.char.lower(tokens), ['nan', '+nan', '-nan'])
+        rows = np.repeat(np.arange(frames), counts)
+        cols = np.arange(num_tokens) - np.repeat(np.cumsum(counts) - counts, counts)
+        values[rows, cols] = numbers
+        parsed[rows, cols] = valid
+    return values, parsed, counts
+
+
+def tidy_pillar_table(sample: str, tlist: list, keep, columns: dict):
+    """Long-format table of one sample: a row per (frame, pillar) where keep is True, in frame then pillar order,
+    with a column per (frames x pillars) array in columns"""
+    import numpy as np
+    import pandas as pd
+    frame_inds, pillars = np.nonzero(keep)
+    table = {'Sample': sample, 'Frame': frame_inds + 1, 'Time': np.asarray(tlist)[frame_inds], 'Pillar': pillars}
+    table.update({name: values[keep] for name, values in columns.items()})
+    return pd.DataFrame(table)
+
+
+def report_pillar_problems(sample: str, counts, frames: int, mismatched: int = 0, invalid: int = 0):
+    """Print one summary line per sample instead of one per frame or pillar"""
+    problems = []
+    if (counts > 0).sum() < frames:
+        problems.append(f"{frames - (counts > 0).sum()} of {frames} frames without values")
+    if mismatched:
+        problems.append(f"{mismatched} frames with different x and y pillar counts (using the smaller count)")
+    if invalid:
+        problems.append(f"{invalid} invalid values skipped")
+    if problems:
+        print(f"\tPillar data of {sample}: " + ", ".join(problems) + ".")
+
+
+def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval_in: int, df_assignments_in,
+                 export_formats=('xlsx',)) -> dict:
+    """Given an organized output folder and a basename. Collects the per-frame metrics of every position into wide
+    tables and the pillar tracks into long tables, writes them in each of export_formats (see EXPORT_FORMATS) and
+    returns them as {table name: DataFrame}"""
+    import numpy as np
+    import pandas as pd
     if not os.path.exists( os.path.join(path_input_fn, basename_fn )):
         print(f"Folder {basename_fn} does not exist. Skipping data extraction...")
         return
@@ -40,11 +363,19 @@ def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval
         tlist = [T * interval_in for T in range(0, frames)]
         folder_ind+=1
 
-    dfs = {}
+    # Read every metric file of every position up front, concurrently, then build the DataFrames from memory
+    text_paths = []
+    for file in folder_path_list:
+        text_paths += [os.path.join(file.path, 'segment_' + image_type, metric) for metric in metrics]
+        text_paths += [os.path.join(file.path, 'track_pillars_' + image_type, mp) for mp in metrics_pillars]
+    texts = read_text_files(text_paths)
 
-    if not os.path.exists(os.path.join(path_input_fn, 'code_output_' + basename_fn + '.xlsx')):
-        workbook = openpyxl.Workbook()
-        workbook.save(os.path.join(path_input_fn, 'code_output_' + basename_fn + '.xlsx'))
+    dfs = {}
+    # Every sheet is collected here and the workbook is written once at the end
+    excel_output_path = os.path.join(path_input_fn, 'code_output_' + basename_fn + '.xlsx')
+    if df_assignments_in is None:
+        df_assignments_in = read_condition_map(path_input_fn, basename_fn)
+    sheets = [] if df_assignments_in is None else [ExcelSheet('condition_map', df_assignments_in, index=False)]
 
     for metric in metrics:
         print(f"\tExtracting data for {metric.split('_vs_')[0]}...")
@@ -52,57 +383,46 @@ def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval
 
         for file in folder_path_list:
             try:
-                dfs[metric.split('_vs_')[0]][file.name] = pd.read_table(os.path.join(file.path, 'segment_' + image_type, metric), header=None)
+                dfs[metric.split('_vs_')[0]][file.name] = read_table_text(texts, os.path.join(file.path, 'segment_' + image_type, metric))
             except Exception as e:
                 print(e)
 
-        append_to_excel(os.path.join(path_input_fn, 'code_output_' + basename_fn + '.xlsx'), dfs[metric.split('_vs_')[0]], metric.split('_vs_')[0])
+        sheets.append(ExcelSheet(metric.split('_vs_')[0], dfs[metric.split('_vs_')[0]]))
 
     for mp in metrics_pillars:
         header_name = mp.split('.txt')[0]
-        excel_output_path = os.path.join(path_input_fn, 'code_output_' + basename_fn + '.xlsx')
         print(f"\tExtracting data for {header_name}...")
 
         if header_name == "pillar_tracker_x":  # single pass triggered on x; y is read here too
-            rows = []
+            tables = []
             for file in folder_path_list:
                 mp_x = mp
                 mp_y = mp.replace("pillar_tracker_x", "pillar_tracker_y")
                 try:
-                    df_x = pd.read_table(os.path.join(file.path, 'track_pillars_' + image_type, mp_x), header=None)
-                    df_y = pd.read_table(os.path.join(file.path, 'track_pillars_' + image_type, mp_y), header=None)
-
-                    for frame_idx in range(frames):
-                        x_vals = str(df_x.iloc[frame_idx, 0]).split()
-                        y_vals = str(df_y.iloc[frame_idx, 0]).split()
-                        n_pillars = min(len(x_vals), len(y_vals))
-                        if len(x_vals) != len(y_vals):
-                            print(f"Pillar count mismatch for {file.name}, frame {frame_idx + 1}: "
-                                f"{len(x_vals)} x-values vs {len(y_vals)} y-values — using first {n_pillars}.")
-                        for pillar in range(n_pillars):
-                            try:
-                                rows.append({
-                                    'Sample': file.name,
-                                    'Frame': frame_idx + 1,
-                                    'Time': tlist[frame_idx],
-                                    'Pillar': pillar,
-                                    'X': float(x_vals[pillar]),
-                                    'Y': float(y_vals[pillar]),
-                                })
-                            except ValueError:
-                                print(f"Invalid value for {file.name}, frame {frame_idx + 1}, pillar {pillar} — skipping.")
+                    x, x_parsed, x_counts = parse_pillar_values(
+                        text_of(texts, os.path.join(file.path, 'track_pillars_' + image_type, mp_x)), frames)
+                    y, y_parsed, y_counts = parse_pillar_values(
+                        text_of(texts, os.path.join(file.path, 'track_pillars_' + image_type, mp_y)), frames)
+                    # Pillars beyond the shorter of the x and y lines are dropped, as are unparsable values
+                    n_pillars = min(x.shape[1], y.shape[1])
+                    x, y = x[:, :n_pillars], y[:, :n_pillars]
+                    in_both = np.arange(n_pillars) < np.minimum(x_counts, y_counts)[:, None]
+                    keep = in_both & x_parsed[:, :n_pillars] & y_parsed[:, :n_pillars]
+                    tables.append(tidy_pillar_table(file.name, tlist, keep, {'X': x, 'Y': y}))
+                    report_pillar_problems(file.name, np.minimum(x_counts, y_counts), frames,
+                                           int((x_counts != y_counts).sum()), int((in_both & ~keep).sum()))
                 except Exception as e:
                     print(e)
 
-            dfs["pillar_positions"] = pd.DataFrame(rows, columns=['Sample', 'Frame', 'Time', 'Pillar', 'X', 'Y'])
-            append_to_excel(excel_output_path, dfs["pillar_positions"], "pillar_positions", 0, 'replace')
+            dfs["pillar_positions"] = pd.concat(tables, ignore_index=True) if tables else \
+                pd.DataFrame(columns=['Sample', 'Frame', 'Time', 'Pillar', 'X', 'Y'])
 
             notes_list = [
                 "This sheet is in tidy/long format: one row per pillar per frame per sample.",
                 "Pillar IDs: 0 = top left, 1 = top right, 2 = bottom right, 3 = bottom left. Bugs may occasionally affect this pattern.",
                 f"To verify pillar positions for each sample, check 'pillar_positions.png' in the 'track_pillars_{image_type}' folder."
             ]
-            add_notes_to_excel_by_rows(excel_output_path, notes_list, "pillar_positions")
+            sheets.append(ExcelSheet("pillar_positions", dfs["pillar_positions"], notes_list))
 
         elif header_name == "pillar_tracker_y":
             pass  # handled in the x pass above
@@ -111,37 +431,27 @@ def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval
             dfs[header_name] = pd.DataFrame({'Frame': range(1, frames + 1), 'Time': tlist})
             for file in folder_path_list:
                 try:
-                    dfs[header_name][file.name] = pd.read_table(os.path.join(file.path, 'track_pillars_' + image_type, mp), header=None)
+                    dfs[header_name][file.name] = read_table_text(texts, os.path.join(file.path, 'track_pillars_' + image_type, mp))
                 except Exception as e:
                     print(e)
             
-            append_to_excel(excel_output_path, dfs[header_name], header_name)
+            sheets.append(ExcelSheet(header_name, dfs[header_name]))
         
         elif header_name == "change_in_pillar_distance_from_centroid":
             sheet_name = "change_in_pillar_distance_from_centroid"
-            rows = []
+            tables = []
             for file in folder_path_list:
                 try:
-                    df = pd.read_table(os.path.join(file.path, 'track_pillars_' + image_type, mp), header=None)
-
-                    for frame_idx in range(frames):
-                        vals = str(df.iloc[frame_idx, 0]).split()
-                        for pillar in range(len(vals)):
-                            try:
-                                rows.append({
-                                    'Sample': file.name,
-                                    'Frame': frame_idx + 1,
-                                    'Time': tlist[frame_idx],
-                                    'Pillar': pillar,
-                                    'Change_dist_from_centroid': float(vals[pillar]),
-                                })
-                            except ValueError:
-                                print(f"Invalid value for {file.name}, frame {frame_idx + 1}, pillar {pillar} — skipping.")
+                    values, parsed, counts = parse_pillar_values(
+                        text_of(texts, os.path.join(file.path, 'track_pillars_' + image_type, mp)), frames)
+                    present = np.arange(values.shape[1]) < counts[:, None]
+                    tables.append(tidy_pillar_table(file.name, tlist, parsed, {'Change_dist_from_centroid': values}))
+                    report_pillar_problems(file.name, counts, frames, invalid=int((present & ~parsed).sum()))
                 except Exception as e:
                     print(e)
 
-            dfs[sheet_name] = pd.DataFrame(rows, columns=['Sample', 'Frame', 'Time', 'Pillar', 'Change_dist_from_centroid'])
-            append_to_excel(excel_output_path, dfs[sheet_name], sheet_name, 0, 'replace')
+            dfs[sheet_name] = pd.concat(tables, ignore_index=True) if tables else \
+                pd.DataFrame(columns=['Sample', 'Frame', 'Time', 'Pillar', 'Change_dist_from_centroid'])
 
             notes_list = [
                 "This sheet is in tidy/long format: one row per pillar per frame per sample.",
@@ -149,7 +459,7 @@ def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval
                 "Pillar IDs: 0 = top left, 1 = top right, 2 = bottom right, 3 = bottom left. Bugs may occasionally affect this pattern.",
                 f"To verify pillar positions for each sample, check 'pillar_positions.png' in the 'track_pillars_{image_type}' folder."
             ]
-            add_notes_to_excel_by_rows(excel_output_path, notes_list, sheet_name)
+            sheets.append(ExcelSheet(sheet_name, dfs[sheet_name], notes_list))
 
 
         # elif header_name == "relative_pillar_distances_pair_names":
@@ -188,9 +498,83 @@ def extract_data(path_input_fn: str, basename_fn: str, image_type: str, interval
     #         add_note_to_excel_by_cell(
     #             excel_output_path, pair_name_str, "rel_pillar_dist_GPR", excel_row=1, excel_column=4+pair_ind
     #             )
-    return
+    if 'xlsx' in export_formats:
+        write_excel_workbook(excel_output_path, sheets)
+    for export_format in export_formats:
+        if export_format != 'xlsx':
+            write_columnar_tables(columnar_output_folder(path_input_fn, basename_fn), sheets, export_format)
+    return {sheet.name: sheet.df for sheet in sheets}
+
+
+class ExcelSheet(NamedTuple):
+    """One sheet for write_excel_workbook. Notes fill the first rows, one per row, above the table"""
+    name: str
+    df: object
+    notes: list = None
+    index: bool = True
+
+
+def write_excel_workbook(fpath, sheets: list):
+    """Given a list of ExcelSheet. Writes them into a new workbook in a single pass, with the notes of each sheet
+    written above its table, then replaces fpath with it. Sheets already in fpath are not kept, so the
+    condition_map sheet has to be one of the sheets"""
+    import pandas as pd
+
+    if not sheets:
+        return
+    root, ext = os.path.splitext(fpath)
+    path_tmp = root + '.tmp' + ext
+    with pd.ExcelWriter(path_tmp, engine='openpyxl') as writer:
+        for sheet in sheets:
+            notes = sheet.notes or []
+            sheet.df.to_excel(writer, sheet_name=sheet.name, startrow=len(notes), index=sheet.index)
+            worksheet = writer.sheets[sheet.name]
+            for row, note in enumerate(notes, start=1):
+                worksheet.cell(row=row, column=1, value=note)
+    os.replace(path_tmp, fpath)
+
+
+def write_columnar_tables(folder, sheets: list, export_format: str = 'parquet'):
+    """Given a list of ExcelSheet. Writes each as <folder>/<sheet name>.parquet or .feather with pyarrow. Column
+    types are kept in the file schema (object columns become float when all values are numbers, else string, with
+    missing values kept as nulls) and
+    the sheet notes are stored in the schema metadata under 'woundcomputegui.notes'"""
+    import json
+    import pandas as pd
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+    except ImportError:
+        print(f"\tError: {export_format} export needs pyarrow (pip install pyarrow). Skipping...")
+        return
+
+    time_start = time.time()
+    os.makedirs(folder, exist_ok=True)
+    for sheet in sheets:
+        df = sheet.df.copy()
+        df.columns = [str(column) for column in df.columns]
+        for column in df.columns[df.dtypes == object]:
+            numbers = pd.to_numeric(df[column], errors='coerce')
+            df[column] = numbers if numbers.notna().sum() == df[column].notna().sum() else df[column].astype('string')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'woundcomputegui.notes'] = json.dumps(sheet.notes or []).encode()
+        table = table.replace_schema_metadata(metadata)
+
+        fpath = os.path.join(folder, f'{sheet.name}.{export_format}')
+        path_tmp = fpath + '.tmp'
+        if export_format == 'parquet':
+            pq.write_table(table, path_tmp)
+        else:
+            feather.write_feather(table, path_tmp)
+        os.replace(path_tmp, fpath)
+    print(f"\tWrote {len(sheets)} {export_format} tables to {folder} in {time.time() - time_start:.2f} s")
+
 
 def append_to_excel(fpath, df, sheet_name, start_row_ind=0,sheet_exists_mode='replace'):
+    import pandas as pd
+    import openpyxl
     if not os.path.exists(fpath):
         workbook = openpyxl.Workbook()
         workbook.save(fpath)
@@ -198,6 +582,7 @@ def append_to_excel(fpath, df, sheet_name, start_row_ind=0,sheet_exists_mode='re
         df.to_excel(f, sheet_name=sheet_name,startrow=start_row_ind)
 
 def add_notes_to_excel_by_rows(fpath, notes_list, sheet_name):
+    import openpyxl
 
     wb = openpyxl.load_workbook(fpath)
     ws = wb[sheet_name]
@@ -216,6 +601,7 @@ def add_notes_to_excel_by_rows(fpath, notes_list, sheet_name):
     return
 
 def add_note_to_excel_by_cell(fpath, note, sheet_name, excel_row, excel_column):
+    import openpyxl
 
     wb = openpyxl.load_workbook(fpath)
     ws = wb[sheet_name]
@@ -315,6 +701,8 @@ def visualize_data(path_output_in, basename_in, image_type_in, all_data_in, metr
        - positions_in: list, positions to be considered
        - assigned_df_in: DataFrame, contains condition assignments for positions
        """
+    import pandas as pd
+    import matplotlib.pyplot as plt
     # Create a folder to store the visualizations
     if not os.path.exists(os.path.join(path_output_in, basename_in + '_visualizations')):
         os.makedirs(os.path.join(path_output_in, basename_in + '_visualizations'))
@@ -1,14 +1,8 @@
 import os
 import io
-import time
-import yaml
 import glob
 import logging
 import warnings
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from collections import OrderedDict
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QFormLayout,QToolTip,
@@ -17,15 +11,44 @@ from PyQt5.QtWidgets import (
     QInputDialog, QDialog, QDoubleSpinBox, QGraphicsView, QGraphicsScene
 )
 from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from pathlib import Path
-from humanfriendly import format_timespan
-from PIL import Image
+import psutil
+from humanfriendly import format_size
 import woundcomputegui.wc_functions as wcf
-import woundcomputegui.wellplate_gui as wpg
 import woundcomputegui.data_management as dm
 
 
+# Organize mode dropdown text -> wcf.place_file link mode
+ORGANIZE_MODES = OrderedDict([
+    ("Copy", 'copy'),
+    ("Link (hardlink/reflink, copy across drives)", 'auto'),
+    ("Symlink", 'symlink'),
+])
+
+# Export dropdown text -> dm.extract_data export formats
+EXPORT_MODES = OrderedDict([
+    ("Excel (.xlsx)", ('xlsx',)),
+    ("Excel + Parquet", ('xlsx', 'parquet')),
+    ("Parquet only", ('parquet',)),
+    ("Feather only", ('feather',)),
+])
+
+# Image stack dropdown text -> wcf.organize_plate (pack_stacks, remove_tifs)
+STACK_MODES = OrderedDict([
+    ("Off", (False, False)),
+    ("Pack, keep .tif files", (True, False)),
+    ("Pack and remove .tif files", (True, True)),
+])
+
+# Reuse dropdown text -> wcf.hash_file mode
+DEDUP_MODES = OrderedDict([
+    ("Off", None),
+    ("Fast hash (size + first/last MB)", 'fast'),
+    ("Full hash", 'full'),
+])
+
+
 class MyWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -83,6 +106,27 @@ class MyWindow(QMainWindow):
         slider_layout.addWidget(self.slider_label)
         form_layout.addRow(QLabel("Max CPU % usage:"), slider_layout)
 
+        # Memory budget for the WoundCompute workers, with the memory currently free
+        memory_layout = QHBoxLayout()
+        self.max_memory_usage_percent = QSlider(Qt.Horizontal)
+        self.max_memory_usage_percent.setRange(1, 100)
+        self.max_memory_usage_percent.setValue(80)  # Default value
+        self.max_memory_usage_percent.setFixedWidth(320)
+        self.max_memory_usage_percent.setToolTip(
+            "Set the maximum share of RAM the WoundCompute processes may use.\n"
+            "A sample only starts when its expected memory fits in this budget."
+        )
+        self.memory_label = QLabel()
+        self.max_memory_usage_percent.valueChanged.connect(self.update_memory_label)
+
+        memory_layout.addWidget(self.max_memory_usage_percent)
+        memory_layout.addWidget(self.memory_label)
+        form_layout.addRow(QLabel("Max memory % usage:"), memory_layout)
+        self.update_memory_label()
+        self.memory_timer = QTimer(self)
+        self.memory_timer.timeout.connect(self.update_memory_label)
+        self.memory_timer.start(5000)
+
         # Add form layout to the main layout
         main_layout.addLayout(form_layout)
 
@@ -95,6 +139,14 @@ class MyWindow(QMainWindow):
         self.imaging_interval.setSuffix(" hours")  # Add units
         form_layout.addRow(QLabel("Imaging interval (hours):"), self.imaging_interval)
 
+        self.export_format_combo = QComboBox()
+        self.export_format_combo.addItems(list(EXPORT_MODES.keys()))
+        self.export_format_combo.setToolTip(
+            "Parquet and Feather write one typed table per sheet into code_output_<basename>, much faster than Excel\n"
+            "for large plates and readable by pandas, R (arrow) and other tools. They need the pyarrow package."
+        )
+        form_layout.addRow(QLabel("Export format:"), self.export_format_combo)
+
         # 5. Frame indices to skip
         self.low_quality_frames_input = QLineEdit()
         self.low_quality_frames_input.setPlaceholderText("e.g., 0,1,2")
@@ -105,18 +157,60 @@ class MyWindow(QMainWindow):
         self.run_before_after_combo.addItems(["True", "False"])
         form_layout.addRow(QLabel("Run before injury and after injury data together:"), self.run_before_after_combo)
 
-        # 6. Four Checkboxes (QCheckBox)
+        # 7. How raw images are placed in the sorted folder
+        self.organize_mode_combo = QComboBox()
+        self.organize_mode_combo.addItems(list(ORGANIZE_MODES.keys()))
+        self.organize_mode_combo.setToolTip(
+            "Link modes place each raw image directly in its final folder without duplicating data.\n"
+            "Hardlinks/reflinks need the sorted folder on the same drive as the raw images; otherwise files are copied."
+        )
+        form_layout.addRow(QLabel("Organize mode:"), self.organize_mode_combo)
+
+        self.dedup_combo = QComboBox()
+        self.dedup_combo.addItems(list(DEDUP_MODES.keys()))
+        self.dedup_combo.setToolTip(
+            "Frames identical to ones organized by an earlier run (found by content hash) are linked instead of copied."
+        )
+        form_layout.addRow(QLabel("Reuse identical frames from earlier runs:"), self.dedup_combo)
+
+        self.stack_mode_combo = QComboBox()
+        self.stack_mode_combo.addItems(list(STACK_MODES.keys()))
+        self.stack_mode_combo.setToolTip(
+            "Packs each sample's images into one stack file (.npy).\n"
+            "Removed .tif files are restored from the stack while WoundCompute runs and deleted again afterwards."
+        )
+        form_layout.addRow(QLabel("Image stacks:"), self.stack_mode_combo)
+
+        # 8. Four Checkboxes (QCheckBox)
         self.check_organize = QCheckBox("Organize .tif files and prepare .yaml files")
         self.check_run_wc = QCheckBox("Run WoundCompute in parallel")
+        self.check_force_run = QCheckBox("Re-analyze samples whose results are up to date")
+        self.check_force_run.setToolTip(
+            "Without this, samples whose images and settings are unchanged since their last complete run are skipped."
+        )
+        self.check_resume_run = QCheckBox("Resume an interrupted run (only samples not finished last time)")
+        self.check_resume_run.setToolTip(
+            "Runs only the samples that the run ledger of the sorted folder does not record as done."
+        )
+        self.check_frame_chunks = QCheckBox(
+            f"Split long time-lapses into chunks of {wcf.FRAME_CHUNK_SIZE} frames across cores"
+        )
+        self.check_frame_chunks.setToolTip(
+            "Useful for plates with few samples and many frames: each sample's frames are segmented in parallel.\n"
+            "Tracking still runs on the whole time-lapse afterwards."
+        )
         self.check_extract_data = QCheckBox("Extract metadata")
         # self.check_visualize = QCheckBox("Visualize data")
 
         main_layout.addWidget(self.check_organize)
         main_layout.addWidget(self.check_run_wc)
+        main_layout.addWidget(self.check_force_run)
+        main_layout.addWidget(self.check_resume_run)
+        main_layout.addWidget(self.check_frame_chunks)
         main_layout.addWidget(self.check_extract_data)
         # main_layout.addWidget(self.check_visualize)
 
-        # 7. Run and Exit Buttons
+        # 9. Run and Exit Buttons
         button_layout = QHBoxLayout()
 
         self.run_button = QPushButton("Run")
@@ -129,7 +223,7 @@ class MyWindow(QMainWindow):
 
         main_layout.addLayout(button_layout)
 
-        # 8. Status Message
+        # 10. Status Message
         self.status_label = QLabel("Ready")
         main_layout.addWidget(self.status_label)
 
@@ -159,6 +253,15 @@ class MyWindow(QMainWindow):
         """Update the label next to the slider to show its current value."""
         self.slider_label.setText(f"{self.max_cpu_usage_percent.value()}%")
 
+    def update_memory_label(self):
+        """Show the memory budget and the memory currently free next to the memory slider."""
+        memory = psutil.virtual_memory()
+        budget = memory.total * self.max_memory_usage_percent.value() / 100
+        self.memory_label.setText(
+            f"{self.max_memory_usage_percent.value()}% ({format_size(budget)}), "
+            f"headroom: {format_size(memory.available)} free"
+        )
+
     def run_process(self):
         """Run the main processing based on user selections."""
     
@@ -232,56 +335,17 @@ class MyWindow(QMainWindow):
         """Organize .tif files and prepare .yaml files."""
         print("Organizing .tif files and preparing .yaml files...")
 
-        image_type = self.image_type
-
         # Create new folder for sorted files
         path_output = self.create_new_folder(path_input)
-        
-        # Create yaml file for image type
-        wcf.create_wc_yaml(path_output, image_type_in=image_type, is_fl_in=False, is_pillars_in=True, low_quality_frame_inds=self.low_quality_frame_inds, run_before_injury_and_after_injury_together=self.run_before_injury_and_after_injury_together)
-#         print("\tCreated .yaml file")
 
-        basename_list, is_nd = wcf.define_basename_list(
-            path_input, path_output,self.microscope_type
+        basename_list, stage_pos_maps = wcf.organize_plate(
+            path_input, path_output, self.image_type, self.low_quality_frame_inds,
+            self.run_before_injury_and_after_injury_together, self.microscope_type.currentText(),
+            link_mode=ORGANIZE_MODES[self.organize_mode_combo.currentText()],
+            dedup=DEDUP_MODES[self.dedup_combo.currentText()],
+            pack_stacks=STACK_MODES[self.stack_mode_combo.currentText()][0],
+            remove_tifs=STACK_MODES[self.stack_mode_combo.currentText()][1],
         )
-        print("\tBasename list:", basename_list)
-        print("\t.nd file found:", is_nd)
-
-        # Sort images in input folder into Sorted/basename/ folders
-        print("\tSorting images into corresponding basename folders...")
-        wcf.sort_basename_folders(basename_list, path_input, path_output, self.microscope_type)
-        print("\tDone!")
-        
-        # # Check if the .nd file is found
-        # if not is_nd:
-        #     # Show a pop-up warning that the .nd file is missing
-        #     msg_box = QMessageBox()
-        #     msg_box.setIcon(QMessageBox.Warning)
-        #     msg_box.setText("No .nd file found in the selected directory!")
-        #     msg_box.setInformativeText("The program cannot proceed without the .nd file. Please ensure the file is present.")
-        #     msg_box.setWindowTitle("Missing .nd File")
-        #     msg_box.setStandardButtons(QMessageBox.Ok)
-
-        #     # Connect the "Ok" button to close the application
-        #     msg_box.buttonClicked.connect(self.close_app)
-        #     msg_box.exec_()
-        
-        # Extract stage position information from .nd file or from data in folder
-        stage_pos_maps = wcf.extract_nd_info(
-            basename_list, path_output, is_nd, ms_choice=self.microscope_type
-        )
-        print("\tExtracted stage position information")
-        # print(f"\t{stage_pos_maps}")
-        # import sys
-        # sys.exit("Exit code bc testing")
-        
-        #  Sort images in each basename folder into their corresponding stage position folders
-        print("\tSorting images in each basename folder into their corresponding stage position folders...")
-        print(f'stage_pos_maps = {stage_pos_maps}')
-        wcf.efficient_sort_stage_pos(
-            basename_list, path_output, stage_pos_maps, image_type, self.microscope_type, is_nd
-        )
-        print("\tDone organizing .tif files and preparing .yaml files!")
         self.basename_list = basename_list
         self.path_output = path_output
         self.stage_pos_maps = stage_pos_maps
@@ -307,6 +371,17 @@ class MyWindow(QMainWindow):
             # Create the full path for the new folder
             new_folder_path = os.path.join(path_input, folder_name)
 
+            # An interrupted organize step can be resumed in its own folder
+            if wcf.organize_unfinished(new_folder_path):
+                reply = QMessageBox.question(
+                    self, "Resume organizing",
+                    f"Folder '{folder_name}' contains an interrupted organize run.\n"
+                    "Resume it? Files that were already placed and are intact will be skipped.",
+                    QMessageBox.Yes | QMessageBox.No,
+                )
+                if reply == QMessageBox.Yes:
+                    return new_folder_path
+
             # Check if the folder already exists
             if os.path.exists(new_folder_path):
                 QMessageBox.warning(self, "Warning", f"Folder '{folder_name}' already exists! Please enter a new name.")
@@ -342,147 +417,31 @@ class MyWindow(QMainWindow):
         if not all_folders_in_path:
             QMessageBox.warning(self, "Warning", "No sorted folders found. Process cancelled.")
         
-        file_list = os.listdir(path_output)
-        if "basename_list.yaml" in file_list:
-            print("\tFound basename_list.yaml file in the input folder")
-            with open(os.path.join(path_output, 'basename_list.yaml'), 'r') as file:
-                # Load the YAML content
-                basename_list = yaml.safe_load(file)
-        else:
-            # If basename.yaml file is not found, then get the list of folders in the input folder
-            # and set it as the basename list
-            basename_list = os.listdir(path_output)
-            basename_list = [name for name in basename_list if os.path.isdir(os.path.join(path_output, name))]
-            if not basename_list:
-                QMessageBox.warning(self,"Warning","No sorted directory found. Process cancelled.")
-
-        if "stage_positions.yaml" in file_list:
-            print("\tFound stage_positions.yaml file in the input folder")
-            with open(os.path.join(path_output, 'stage_positions.yaml'), 'r') as file:
-                # Load the YAML content
-                data = yaml.safe_load(file)
-            stage_pos_maps = {}
-            for index, basename in enumerate(basename_list):
-                stage_pos_maps[basename] = data[basename]
-        else:
-            # If stage_positions.yaml file is not found, then get the list of folders in the basename folder
-            # and set it as the stage_pos_maps
-            stage_pos_maps = {}
-            for index, basename in enumerate(basename_list):
-                path_temp = os.path.join(path_output, Path(basename))
-                try:
-                    positions = os.listdir(path_temp)
-                    positions.sort()
-                    positions = [n1 for n1 in positions if not n1.endswith('.nd')]
-                    stage_pos_maps[basename] = {N: position for N, position in zip(range(1, len(positions) + 1), positions)}
-                    print(f"\tFound {len(positions)} stage positions for {basename}.")
-                except FileNotFoundError:
-                    print(f"\tNo folder found for {basename}. Skipping...")
-                    continue
+        basename_list, stage_pos_maps = wcf.load_organized_plate(path_output)
+        if not basename_list:
+            QMessageBox.warning(self,"Warning","No sorted directory found. Process cancelled.")
         self.basename_list = basename_list
         self.path_output = path_output
         self.stage_pos_maps = stage_pos_maps
 
     
     def check_yaml_files(self):
-        main_path = self.path_output
-        image_type = self.image_type
-        yaml_files = self.find_yaml_with_wc_settings(main_path)
-        for yf in yaml_files:
-            yf = Path(yf)
-            self.change_yaml_settings_by_image_type(yf,image_type)
-
-
-    def change_yaml_settings_by_image_type(self,yaml_file,image_type):
-        yaml_input_file = {
-            'version': 1.0,
-            'segment_brightfield': False,
-            'seg_bf_version': 1,
-            'seg_bf_visualize': False,
-            'segment_fluorescent': False,
-            'seg_fl_version': 1,
-            'seg_fl_visualize': False,
-            'segment_ph1': False,
-            'seg_ph1_version': 2,
-            'seg_ph1_visualize': False,
-            'track_brightfield': False,
-            'track_bf_version': 1,
-            'track_bf_visualize': False,
-            'track_ph1': False,
-            'track_ph1_version': 1,
-            'track_ph1_visualize': False,
-            'bf_seg_with_fl_seg_visualize': False,
-            'bf_track_with_fl_seg_visualize': False,
-            'ph1_seg_with_fl_seg_visualize': False,
-            'ph1_track_with_fl_seg_visualize': False,
-            'zoom_type': 2,
-            'track_pillars_ph1': False,
-            'segment_dic': False,
-            'seg_dic_version': 1,
-            'seg_dic_visualize': False,
-            'track_dic_visualize': False,
-            'track_pillars_dic': False,
-            'run_before_injury_and_after_injury_together': self.run_before_injury_and_after_injury_together,
-            'low_quality_frame_inds': self.low_quality_frame_inds
-        }
-
-        # Conditionally modify yaml file based on image_type input
-        if image_type == 'ph1':
-            yaml_input_file['segment_ph1'] = True
-            yaml_input_file['seg_ph1_visualize'] = True
-            yaml_input_file['track_pillars_ph1'] = True
-            yaml_input_file['track_ph1_visualize'] = True
-            yaml_input_file['track_ph1'] = True
-        elif image_type == 'dic':
-            yaml_input_file['segment_dic'] = True
-            yaml_input_file['seg_dic_visualize'] = True
-            yaml_input_file['track_pillars_dic'] = True
-            yaml_input_file['track_dic_visualize'] = True
-
-        parent_dir = yaml_file.parent
-        if os.path.exists(yaml_file):
-            os.remove(yaml_file)
-
-        with open(os.path.join(parent_dir, 'wc_dataset_' + image_type + '.yaml'), 'w') as file:
-            yaml.safe_dump(yaml_input_file, file, sort_keys=False)
-
-    
-    def find_yaml_with_wc_settings(self,base_path):
-        yaml_files = set()
-        
-        for root, dirs, files in os.walk(base_path):
-            for file in files:
-                if file.endswith('.yaml') and 'wc_dataset_' in file:
-                    yaml_files.add(os.path.join(root, file))
-                    break
-
-        return list(yaml_files)
+        wcf.update_wc_yamls(self.path_output, self.image_type, self.low_quality_frame_inds,
+                            self.run_before_injury_and_after_injury_together)
 
             
     def run_wound_compute(self):
         """Run WoundCompute in parallel."""
         print("Running WoundCompute...")
-        basename_list = self.basename_list
-        path_output = self.path_output
-
-        time_start = time.time()
-        print("\tStarting WoundCompute for each experiment folder...")
-        print("\tStart time:", time.ctime())
-
-        for index, basename in enumerate(basename_list):
-            if self.run_before_injury_and_after_injury_together and basename.endswith('_bi'):
-                print(f"\tSkipping {basename}: handled inside the compiled folder during the *_ai pass.")
-                continue
-            print("\tProcessing folder:", basename)
-            try:
-                wcf.wc_process_folder(os.path.join(path_output, basename), self.max_cpu_usage_percent.value())
-            except Exception as e:
-                import traceback
-                print(f"\tERROR processing {basename}: {e}")
-                traceback.print_exc()
-
-        print("\tEnd time:", time.ctime())
-        print("\tTotal time taken:", format_timespan(time.time() - time_start))
+        frame_chunk_size = wcf.FRAME_CHUNK_SIZE if self.check_frame_chunks.isChecked() else None
+        if self.check_resume_run.isChecked():
+            wcf.wc_resume_run(self.path_output, self.max_cpu_usage_percent.value(),
+                              self.max_memory_usage_percent.value(), frame_chunk_size)
+            print("\tDone running WoundCompute!")
+            return
+        wcf.run_plate(self.path_output, self.basename_list, self.max_cpu_usage_percent.value(),
+                      self.run_before_injury_and_after_injury_together, self.max_memory_usage_percent.value(),
+                      self.check_force_run.isChecked(), frame_chunk_size)
         print("\tDone running WoundCompute!")
 
 
@@ -515,15 +474,7 @@ class MyWindow(QMainWindow):
         """
         flag = self.run_before_injury_and_after_injury_together
 
-        found_compiled = []
-        missing_compiled = []
-        for bn in basename_list:
-            if bn.endswith('_ai'):
-                compiled_name = bn[:-len('_ai')] + '_compiled'
-                if os.path.isdir(os.path.join(path_output, compiled_name)):
-                    found_compiled.append(compiled_name)
-                else:
-                    missing_compiled.append(compiled_name)
+        found_compiled, missing_compiled = wcf.compiled_folder_status(basename_list, path_output)
 
         if not flag and found_compiled:
             msg = QMessageBox(self)
@@ -581,18 +532,7 @@ class MyWindow(QMainWindow):
         image_type = self.image_type
 
         if use_compiled:
-            compiled_list = []
-            for bn in basename_list:
-                if bn.endswith('_ai'):
-                    compiled_bn = bn[:-len('_ai')] + '_compiled'
-                    compiled_list.append(compiled_bn)
-                    if compiled_bn not in stage_pos_maps:
-                        stage_pos_maps[compiled_bn] = stage_pos_maps.get(bn, {})
-                elif bn.endswith('_bi'):
-                    continue
-                else:
-                    compiled_list.append(bn)
-            basename_list = compiled_list
+            basename_list = dm.compiled_basename_list(basename_list, stage_pos_maps)
             print(f"\tCompiled-mode basename list: {basename_list}")
 
         for index, basename in enumerate(basename_list):
@@ -601,42 +541,23 @@ class MyWindow(QMainWindow):
                 continue
 
             # Check if there's an existing condition map file
-            condition_map_path = os.path.join(path_output, f'code_output_{basename}.xlsx')
-            if os.path.exists(condition_map_path):
-                print("\tFound existing condition map file.")
-                try:
-                    df_assignments = pd.read_excel(condition_map_path, sheet_name='condition_map')
-                except Exception as e:
-                    print("\tError reading condition map file:", e)
-                    df_assignments = None
-            else:
-                df_assignments = None
+            df_assignments = dm.read_condition_map(path_output, basename)
 
             if df_assignments is None:
                 # Extract stage position map for the current basename
                 stage_pos_map = stage_pos_maps.get(basename, {})
 
                 # Initialize the PyQt5-based WellPlateInterface
+                import woundcomputegui.wellplate_gui as wpg
                 dialog = wpg.WellPlateInterface(stage_pos_map, basename)
 
                 # Make the dialog modal and wait for user input
                 if dialog.exec_() == QDialog.Accepted:
                     df_assignments = dialog.get_assigned_dataframe()
+                    dm.save_condition_map(path_output, basename, df_assignments)
 
-                    # Save the condition map to an Excel file
-                    df_assignments.to_excel(condition_map_path, sheet_name='condition_map', index=False)
-                    print("\tCondition map saved to Excel file")
-
-            # Extract data from the folders and create an Excel file
-            dm.extract_data(
-                path_output, basename, image_type, imaging_interval, df_assignments
-            )
-            print(f"\tData extracted to Excel file in {basename}.xlsx")
-            
-            # Move ph1_contour_all_*.png images from all samples into the same folder
-            dm.conglomerate_segmentation_images(path_output, basename, image_type)
-            dm.conglomerate_pillar_disps_images(path_output, basename, image_type)
-            print("\tDone extracting data!")
+            dm.extract_basename_outputs(path_output, basename, image_type, imaging_interval, df_assignments,
+                                        EXPORT_MODES[self.export_format_combo.currentText()])
 
 
     def visualize_data(self):
@@ -772,17 +693,29 @@ class VisualizationWindow(QDialog):
             QMessageBox.information(self, "Info", "Visualization not implemented.")
 
 
-    def load_raw_images(self, basename, sample):
+    def load_sample_images(self, basename, sample):
+        """Return the raw frames of a sample as PIL images, read from its image stack with a single file open when
+        the sample was packed, or from the individual .tif files otherwise."""
+        import numpy as np
+        from PIL import Image
         image_type = self.image_type
-        image_folder = os.path.join(self.path_output, basename, sample, f"{image_type}_images")
-        self.images = []
+        sample_path = os.path.join(self.path_output, basename, sample)
+        stack, _ = wcf.load_position_stack(sample_path, image_type)
+        if stack is not None:
+            return [Image.fromarray(np.asarray(frame)) for frame in stack]
+
+        image_folder = os.path.join(sample_path, f"{image_type}_images")
+        images = []
         for file in sorted(os.listdir(image_folder)):
             if file.lower().endswith((".tif", ".tiff")):
                 image_path = os.path.join(image_folder, file)
-                image = Image.open(image_path)
-                # Convert PIL Image to QPixmap
-                pixmap = self.pil_to_qpixmap(image)
-                self.images.append(pixmap)
+                images.append(Image.open(image_path))
+        return images
+
+
+    def load_raw_images(self, basename, sample):
+        # Convert PIL Image to QPixmap
+        self.images = [self.pil_to_qpixmap(image) for image in self.load_sample_images(basename, sample)]
 
         if self.images:
             self.frame_slider.setEnabled(True)
@@ -794,14 +727,10 @@ class VisualizationWindow(QDialog):
 
 
     def load_tissue_mask(self, basename, sample):
+        import numpy as np
+        from PIL import Image
         image_type = self.image_type
-        image_folder = os.path.join(self.path_output, basename, sample, f"{image_type}_images")
-        self.images = []
-        for file in sorted(os.listdir(image_folder)):
-            if file.lower().endswith((".tif", ".tiff")):
-                image_path = os.path.join(image_folder, file)
-                image = Image.open(image_path)
-                self.images.append(image)
+        self.images = self.load_sample_images(basename, sample)
         
         tissue_mask_folder = os.path.join(self.path_output, basename, sample, f"segment_{image_type}")
         self.tissue_masks = []
@@ -845,14 +774,10 @@ class VisualizationWindow(QDialog):
 
 
     def load_wound_mask(self, basename, sample):
+        import numpy as np
+        from PIL import Image
         image_type = self.image_type
-        image_folder = os.path.join(self.path_output, basename, sample, f"{image_type}_images")
-        self.images = []
-        for file in sorted(os.listdir(image_folder)):
-            if file.lower().endswith((".tif", ".tiff")):
-                image_path = os.path.join(image_folder, file)
-                image = Image.open(image_path)
-                self.images.append(image)
+        self.images = self.load_sample_images(basename, sample)
 
         wound_mask_folder = os.path.join(self.path_output, basename, sample, f"segment_{image_type}")
         self.wound_masks = []
@@ -903,19 +828,13 @@ class VisualizationWindow(QDialog):
 
 
     def load_wound_mask_all_frames(self, basename, sample):
+        import numpy as np
         image_type = self.image_type
-        image_folder = os.path.join(self.path_output, basename, sample, f"{image_type}_images")
         wound_mask_folder = os.path.join(self.path_output, basename, sample, f"segment_{image_type}")
 
-        images = []
+        images = self.load_sample_images(basename, sample)
         wound_masks = []
 
-        for file in sorted(os.listdir(image_folder)):
-            if file.lower().endswith((".tif", ".tiff")):
-                image_path = os.path.join(image_folder, file)
-                image = Image.open(image_path)
-                images.append(image)
-
         for file in sorted(os.listdir(wound_mask_folder)):
             if file.startswith("wound_mask"):
                 mask_path = os.path.join(wound_mask_folder, file)
@@ -937,6 +856,8 @@ class VisualizationWindow(QDialog):
 
 
     def create_wound_mask_grid(self):
+        import numpy as np
+        from PIL import Image
         num_images = len(self.wound_masked_images)
 
         # Calculate the available space for the grid
@@ -1012,6 +933,9 @@ class VisualizationWindow(QDialog):
 
 
     def wound_area_v_frame(self, basename, sample):
+        import numpy as np
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
         image_type = self.image_type
         image_folder = os.path.join(self.path_output, basename, sample, f"segment_{image_type}")
         self.wound_area_plot = None
@@ -1048,6 +972,7 @@ class VisualizationWindow(QDialog):
 
 
     def load_all_samples_grid(self, basename):
+        import numpy as np
         all_wound_masked_images, max_frames, self.cell_size = self.load_all_samples_wound_masks(basename)
         num_samples = len(all_wound_masked_images)
         self.grid_size = int(np.ceil(np.sqrt(num_samples)))
@@ -1061,6 +986,8 @@ class VisualizationWindow(QDialog):
 
 
     def load_all_samples_wound_masks(self, basename):
+        import numpy as np
+        from PIL import Image
         image_type = self.image_type
         samples = self.get_samples(basename)
         samples.sort(key=lambda x: int(''.join(filter(str.isdigit, x))))  # Sort samples numerically
@@ -1086,18 +1013,11 @@ class VisualizationWindow(QDialog):
         self.cell_size = cell_size
 
         for sample in samples:
-            image_folder = os.path.join(self.path_output, basename, sample, f"{image_type}_images")
             wound_mask_folder = os.path.join(self.path_output, basename, sample, f"segment_{image_type}")
 
-            images = []
+            images = self.load_sample_images(basename, sample)
             wound_masks = []
 
-            for file in sorted(os.listdir(image_folder)):
-                if file.lower().endswith((".tif", ".tiff")):
-                    image_path = os.path.join(image_folder, file)
-                    image = Image.open(image_path)
-                    images.append(image)
-
             for file in sorted(os.listdir(wound_mask_folder)):
                 if file.startswith("wound_mask"):
                     mask_path = os.path.join(wound_mask_folder, file)
@@ -1123,6 +1043,8 @@ class VisualizationWindow(QDialog):
 
 
     def blend_image_and_mask(self, image, wound_mask):
+        import numpy as np
+        from PIL import Image
         image_array = np.array(image)
         opacity = 0.25
 
@@ -1149,6 +1071,7 @@ class VisualizationWindow(QDialog):
 
 
     def create_grid_image(self, frame):
+        from PIL import Image
         grid_width = self.grid_width
         grid_height = self.grid_height
         cell_size = self.cell_size
@@ -3,17 +3,37 @@ import fnmatch
 import shutil
 import yaml
 import re
-from humanfriendly import format_timespan
-from woundcompute import image_analysis as ia
+from humanfriendly import format_timespan, format_size
 from pathlib import Path
 import re
 import psutil
 import time
-from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor,wait,FIRST_COMPLETED,ALL_COMPLETED
+from concurrent.futures import ThreadPoolExecutor,Future,wait,FIRST_COMPLETED
 from functools import partial
 import traceback
 import sys
-from typing import List
+import gzip
+import json
+import errno
+import queue
+import sqlite3
+import hashlib
+import filecmp
+import threading
+import heapq
+import collections
+import multiprocessing
+import multiprocessing.connection
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import List, NamedTuple
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 def create_wc_yaml(path_in: str, image_type_in: str, is_fl_in: bool, is_pillars_in: bool, low_quality_frame_inds: List, run_before_injury_and_after_injury_together: bool = False):
@@ -85,12 +105,263 @@ def create_wc_yaml(path_in: str, image_type_in: str, is_fl_in: bool, is_pillars_
 
 def copy_file(src, dest):
     try:
-        shutil.copy2(src, dest)
+        copy_file_data(src, dest)
     except OSError as e:
         # If it fails, inform the user.
         print('Error: %s - %s.' % (e.filename, e.strerror))
 
 
+# Order in which the link-based organize modes try to place a file on the output device
+LINK_MODE_ORDER = {
+    'auto': ('hardlink', 'reflink'),
+    'hardlink': ('hardlink', 'reflink'),
+    'reflink': ('reflink', 'hardlink'),
+    'symlink': ('symlink',),
+    'copy': (),
+}
+
+# ioctl request number for FICLONE on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dest) -> str:
+    """Clone src into dest with the FICLONE ioctl (btrfs, xfs, ...) so the two share their data blocks. Raises
+    OSError when the filesystem cannot clone, so the caller can fall back to the next strategy instead of silently
+    getting a full copy"""
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dest)
+    return 'reflink'
+
+
+# Files at least this large are copied inside the kernel; smaller ones are batched by the copy engine
+LARGE_FILE_BYTES = 4 * 1024 * 1024
+
+
+def kernel_copy_file(src, dest):
+    """Copy src to dest with os.copy_file_range, or os.sendfile on Linux without it, so the data is moved inside the
+    kernel instead of through Python buffers. Whatever the kernel could not copy (e.g. across filesystems on older
+    kernels) is finished with a buffered copy. Metadata is copied like shutil.copy2"""
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        offset = 0
+        try:
+            if hasattr(os, 'copy_file_range'):
+                while offset < size:
+                    copied = os.copy_file_range(infd, outfd, size - offset, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            elif sys.platform.startswith('linux'):
+                while offset < size:
+                    copied = os.sendfile(outfd, infd, offset, size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+        if offset < size:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dest)
+
+
+def copy_file_data(src, dest):
+    """copy2 for small files, kernel_copy_file for large ones"""
+    if os.path.getsize(src) >= LARGE_FILE_BYTES:
+        kernel_copy_file(src, dest)
+    else:
+        shutil.copy2(src, dest)
+
+
+def place_file(src, dest, link_mode: str = 'auto') -> str:
+    """Put src at dest using the cheapest strategy allowed by link_mode ('auto', 'hardlink', 'reflink', 'symlink'
+    or 'copy'). Hardlinks and reflinks are only attempted when src and dest are on the same device; a real copy is
+    the fallback. Returns the strategy that was used"""
+
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    strategies = LINK_MODE_ORDER[link_mode]
+    if strategies and strategies != ('symlink',):
+        same_device = os.stat(src).st_dev == os.stat(os.path.dirname(dest)).st_dev
+        if not same_device:
+            strategies = ()
+
+    for strategy in strategies:
+        try:
+            if strategy == 'hardlink':
+                os.link(src, dest)
+                return 'hardlink'
+            elif strategy == 'reflink':
+                return reflink_file(src, dest)
+            elif strategy == 'symlink':
+                os.symlink(os.path.abspath(src), dest)
+                return 'symlink'
+        except (OSError, ImportError):
+            # Filesystem or platform does not support this strategy; clean up and try the next one
+            if os.path.lexists(dest):
+                os.remove(dest)
+
+    copy_file_data(src, dest)
+    return 'copy'
+
+
+def cache_dir() -> str:
+    """Folder for data shared by every run and plate of this user (ingest index, cost model). Set the
+    WOUNDCOMPUTEGUI_CACHE_DIR environment variable to move it, e.g. to a drive shared by several workstations"""
+    path = os.environ.get('WOUNDCOMPUTEGUI_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.woundcomputegui')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Bytes read from each end of a file by the 'fast' content hash
+HASH_SAMPLE_BYTES = 1024 * 1024
+
+
+def hash_file(path, mode: str = 'fast') -> str:
+    """Content hash of a file. 'fast' hashes the size plus the first and last HASH_SAMPLE_BYTES, which is enough to
+    tell microscope frames apart while reading very little over a network share; 'full' hashes the whole file.
+    Uses xxhash when it is installed and blake2b otherwise"""
+
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        if mode == 'full' or size <= 2 * HASH_SAMPLE_BYTES:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        else:
+            hasher.update(size.to_bytes(8, 'little'))
+            hasher.update(file.read(HASH_SAMPLE_BYTES))
+            file.seek(-HASH_SAMPLE_BYTES, os.SEEK_END)
+            hasher.update(file.read(HASH_SAMPLE_BYTES))
+    return f'{mode}:{hasher.hexdigest()}'
+
+
+# Bytes read from the middle of a file for the quick fingerprint that decides whether a full content hash is needed
+FINGERPRINT_SAMPLE_BYTES = 4096
+
+
+def quick_fingerprint(path, size: int) -> str:
+    """Cheap prefilter for hash_file: the size plus FINGERPRINT_SAMPLE_BYTES from the middle of the file, past the
+    TIF header that frames of one acquisition share"""
+    with open(path, 'rb') as file:
+        file.seek(max(0, size // 2 - FINGERPRINT_SAMPLE_BYTES // 2))
+        sample = file.read(FINGERPRINT_SAMPLE_BYTES)
+    return hashlib.blake2b(size.to_bytes(8, 'little') + sample, digest_size=8).hexdigest()
+
+
+class IngestIndex:
+    """On-disk index (SQLite, in cache_dir()) from content hash to the organized copies of every frame ingested by
+    earlier runs. When a raw frame would have to be copied, an identical frame already in a previous sorted output
+    is hardlinked instead. Lookups go through the size and quick fingerprint index, so they stay O(1) as the index
+    grows, and a file is only hashed when a frame with the same fingerprint is already indexed; frames without a
+    candidate are stored with an empty hash, computed later if a candidate ever needs it. Each row also keeps the
+    mtime and inode of the indexed file, and a candidate whose file was overwritten or replaced since is indexed
+    again before it is trusted"""
+
+    def __init__(self, hash_mode: str = 'fast', path_index: str = None):
+        self.hash_mode = hash_mode
+        self.path = path_index or os.path.join(cache_dir(), 'ingest_index.sqlite')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS frames '
+                               '(path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS frames_hash ON frames(hash)')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(frames)')]
+            for column in ('fingerprint TEXT', 'mtime_ns INTEGER', 'inode INTEGER'):
+                if column.split()[0] not in columns:
+                    self._conn.execute(f'ALTER TABLE frames ADD COLUMN {column}')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS frames_size_fingerprint ON frames(size, fingerprint)')
+
+    def lookup(self, size: int, fingerprint: str) -> list:
+        """(path, hash, mtime_ns, inode) of the indexed frames that may be identical to a file; frames indexed
+        before fingerprints were stored are always candidates"""
+        with self._lock:
+            rows = self._conn.execute('SELECT path, hash, mtime_ns, inode FROM frames WHERE size = ? AND '
+                                      '(fingerprint = ? OR fingerprint IS NULL)', (size, fingerprint))
+            return rows.fetchall()
+
+    def add(self, file_hash: str, size: int, path, fingerprint: str = None, stat: os.stat_result = None):
+        """Index the file at path, recording its mtime and inode from stat (or a fresh os.stat)"""
+        stat = stat or os.stat(path)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO frames (path, hash, size, fingerprint, mtime_ns, inode) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (os.path.abspath(path), file_hash, size, fingerprint, stat.st_mtime_ns, stat.st_ino))
+
+    def forget(self, path):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM frames WHERE path = ?', (path,))
+
+    def place(self, src, dest, link_mode: str = 'copy') -> str:
+        """place_file, except that a file that would be copied is first looked up by content hash and hardlinked
+        from an identical frame of a previous run when one exists on the output drive"""
+
+        if will_link(src, os.path.dirname(dest), link_mode):
+            return place_file(src, dest, link_mode)
+
+        size = os.path.getsize(src)
+        fingerprint = quick_fingerprint(src, size)
+        candidates = [row for row in self.lookup(size, fingerprint)
+                      if os.path.abspath(row[0]) != os.path.abspath(dest)]
+        # Without a candidate no duplicate is possible, so the file is not hashed
+        file_hash = hash_file(src, self.hash_mode) if candidates else ''
+        for cached_path, cached_hash, cached_mtime_ns, cached_inode in candidates:
+            try:
+                stat = os.stat(cached_path)
+                if (stat.st_mtime_ns, stat.st_ino) != (cached_mtime_ns, cached_inode):
+                    # Overwritten or replaced since it was indexed (or indexed before stats were stored): index what
+                    # the file holds now, hashing it only if it may still match
+                    cached_fingerprint = quick_fingerprint(cached_path, stat.st_size)
+                    cached_hash = ''
+                    if stat.st_size == size and cached_fingerprint == fingerprint:
+                        cached_hash = hash_file(cached_path, self.hash_mode)
+                    self.add(cached_hash, stat.st_size, cached_path, cached_fingerprint, stat)
+                elif not cached_hash.startswith(f'{self.hash_mode}:'):
+                    cached_hash = hash_file(cached_path, self.hash_mode)
+                    self.add(cached_hash, size, cached_path, fingerprint, stat)
+                if cached_hash != file_hash:
+                    continue
+                # Hashing takes a while; do not link a frame that changed meanwhile
+                linked_stat = os.stat(cached_path)
+                if (linked_stat.st_mtime_ns, linked_stat.st_ino) != (stat.st_mtime_ns, stat.st_ino):
+                    continue
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.link(cached_path, dest)
+                return 'dedup-hardlink'
+            except FileNotFoundError:
+                # The earlier output was deleted
+                self.forget(cached_path)
+            except OSError:
+                # Other drive or filesystem without hardlinks
+                continue
+
+        strategy = place_file(src, dest, link_mode)
+        self.add(file_hash, size, dest, fingerprint)
+        return strategy
+
+    def close(self):
+        self._conn.close()
+
+
+def will_link(src, dest_dir, link_mode: str) -> bool:
+    """True if place_file would link src into dest_dir rather than copy it"""
+    if link_mode == 'symlink':
+        return True
+    if not LINK_MODE_ORDER.get(link_mode):
+        return False
+    return os.stat(src).st_dev == os.stat(dest_dir).st_dev
+
+
 def write_to_sp_yaml(path_input_fn: str, input_list_fn, name_fn: str):
     """Given the path to the input folder and a list. Will write the list to a yaml file in the input folder"""
 
@@ -98,13 +369,234 @@ def write_to_sp_yaml(path_input_fn: str, input_list_fn, name_fn: str):
         yaml.safe_dump(input_list_fn, file, sort_keys=False)
 
 
-def define_basename_list(path_input_fn: str, path_output_fn: str, ms_choice: str) -> (list, bool):
-    """Given an input path as a string. Will return a list of experiment names in the input folder"""
+# File name tokens used to sort raw images into stage position folders
+TIMEPOINT_PATTERN = re.compile(r't(\d+)')
+STAGE_PATTERN_S = re.compile(r's(\d+)')
+STAGE_PATTERN_LETTER = re.compile(r'([A-H])(\d+)')
+COORD_PATTERN = re.compile(r'^[A-Za-z]\d+$')
+
+MANIFEST_NAME = 'input_manifest.json.gz'
+
+
+def parse_image_name(file: str) -> (str, str, str):
+    """Given a raw image file name. Returns its timepoint (e.g. t5), well (e.g. B3) and stage (e.g. s2) tokens, with
+    an empty string for each token that is missing"""
+
+    timepoint_match = TIMEPOINT_PATTERN.search(file)
+    stage_wellpos_match = STAGE_PATTERN_LETTER.search(file)
+    stage_match_s = STAGE_PATTERN_S.search(file)
+    return (timepoint_match.group(0) if timepoint_match else '',
+            stage_wellpos_match.group(0) if stage_wellpos_match else '',
+            stage_match_s.group(0) if stage_match_s else '')
+
+
+class ManifestEntry(NamedTuple):
+    """One raw file of the input folder with its file name tokens parsed once"""
+    name: str
+    path: str
+    size: int
+    mtime: float
+    timepoint_token: str
+    well_token: str
+    stage_token: str
+
+    @property
+    def tokens(self) -> (str, str, str):
+        return self.timepoint_token, self.well_token, self.stage_token
+
+    @property
+    def timepoint(self) -> int:
+        return int(self.timepoint_token[1:]) if self.timepoint_token else -1
+
+    @property
+    def position(self) -> str:
+        return self.well_token or self.stage_token or self.name
+
+    def is_tif(self) -> bool:
+        return self.name.lower().endswith(('.tif', '.tiff'))
+
+
+class InputManifest:
+    """Index of the raw files in an input folder built from a single directory scan. Holds the basename list, the
+    .nd file of each basename and, per basename, every file with its size, mtime and parsed name tokens. Saved in
+    the output folder as input_manifest.json.gz so the organize steps never rescan the input folder, and reused by
+    later organize runs while the scanned folders are unchanged"""
+
+    def __init__(self, path_input: str, basename_list: list, is_nd: bool, nd_paths: dict, files: dict,
+                 ms_choice: str = '', folder_mtimes: dict = None):
+        self.path_input = path_input
+        self.basename_list = basename_list
+        self.is_nd = is_nd
+        self.nd_paths = nd_paths
+        self.files = files
+        self.ms_choice = ms_choice
+        # {folder: st_mtime_ns} of every scanned folder; adding, removing or renaming a file changes its folder's mtime
+        self.folder_mtimes = folder_mtimes or {}
+
+    @classmethod
+    def scan(cls, path_input_fn: str, path_output_fn: str, ms_choice: str) -> 'InputManifest':
+        """Scan the input folder once and assign every raw file to its basename"""
+
+        def make_entry(dir_entry):
+            stat = dir_entry.stat()
+            return ManifestEntry(dir_entry.name, dir_entry.path, stat.st_size, stat.st_mtime,
+                                 *parse_image_name(dir_entry.name))
+
+        nd_paths = {}
+        files = {}
+        # Taken before scanning, so files added during the scan make the manifest stale instead of going unnoticed
+        folder_mtimes = {str(path_input_fn): os.stat(path_input_fn).st_mtime_ns}
+
+        if ms_choice == "Cytation":
+            excluded = (os.path.normpath(str(path_output_fn)), os.path.normpath(os.path.join(path_input_fn, 'Sorted')))
+            basename_list = [entry.name for entry in os.scandir(path_input_fn)
+                             if entry.is_dir() and os.path.normpath(entry.path) not in excluded]
+            for basename_fn in basename_list:
+                path_basename = os.path.join(path_input_fn, basename_fn)
+                folder_mtimes[path_basename] = os.stat(path_basename).st_mtime_ns
+                files[basename_fn] = [make_entry(entry) for entry in os.scandir(path_basename)
+                                      if entry.is_file() and entry.name.lower().endswith(('.tif', '.tiff'))]
+            return cls(path_input_fn, basename_list, False, nd_paths, files, ms_choice, folder_mtimes)
+
+        raw_entries = []
+        for entry in os.scandir(path_input_fn):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.nd'):
+                nd_paths[os.path.splitext(entry.name)[0]] = entry.path
+            else:
+                raw_entries.append(make_entry(entry))
+
+        is_nd = bool(nd_paths)
+        if is_nd:
+            basename_list = list(nd_paths)
+        else:
+            basename_list = basenames_from_tif_names([entry.name for entry in raw_entries if entry.is_tif()])
+
+        # A file belongs to every basename that prefixes it up to an underscore, as with name.startswith(basename + '_')
+        files = {basename_fn: [] for basename_fn in basename_list}
+        for entry in raw_entries:
+            if 'thumb' in entry.name:
+                continue
+            for ind, char in enumerate(entry.name):
+                if char == '_' and entry.name[:ind] in files:
+                    files[entry.name[:ind]].append(entry)
+
+        return cls(path_input_fn, basename_list, is_nd, nd_paths, files, ms_choice, folder_mtimes)
+
+    def is_current(self, path_input_fn: str, ms_choice: str) -> bool:
+        """True if the manifest was built from path_input_fn with the same microscope choice and no file has been
+        added to, removed from or renamed in the scanned folders since"""
+        if os.path.normpath(str(self.path_input)) != os.path.normpath(str(path_input_fn)) or self.ms_choice != ms_choice:
+            return False
+        try:
+            return all(os.stat(folder).st_mtime_ns == mtime for folder, mtime in self.folder_mtimes.items())
+        except OSError:
+            return False
+
+    def tif_files(self, basename_fn: str) -> list:
+        return [entry for entry in self.files.get(basename_fn, []) if entry.is_tif()]
+
+    def positions(self, basename_fn: str) -> dict:
+        """Returns {position: [ManifestEntry, ...]} with each position's TIF files ordered by timepoint"""
+        positions = {}
+        for entry in self.tif_files(basename_fn):
+            positions.setdefault(entry.position, []).append(entry)
+        for entries in positions.values():
+            entries.sort(key=lambda entry: (entry.timepoint, entry.name))
+        return positions
+
+    def save(self, path_output_fn: str):
+        """Write the manifest to path_output/input_manifest.json.gz. File paths are stored as one folder per
+        basename plus the file names to keep the manifest compact"""
+        data = {'version': 2, 'path_input': str(self.path_input), 'basename_list': self.basename_list,
+                'is_nd': self.is_nd, 'nd_paths': self.nd_paths, 'ms_choice': self.ms_choice,
+                'folder_mtimes': self.folder_mtimes, 'files': {}}
+        for basename_fn, entries in self.files.items():
+            folders = list(dict.fromkeys(os.path.dirname(entry.path) for entry in entries))
+            data['files'][basename_fn] = {
+                'folders': folders,
+                'rows': [[folders.index(os.path.dirname(entry.path)) if len(folders) > 1 else 0, entry.name,
+                          entry.size, entry.mtime, *entry.tokens] for entry in entries],
+            }
+        path_tmp = os.path.join(path_output_fn, MANIFEST_NAME + '.tmp')
+        with gzip.open(path_tmp, 'wt', encoding='utf-8') as file:
+            json.dump(data, file, separators=(',', ':'))
+        os.replace(path_tmp, os.path.join(path_output_fn, MANIFEST_NAME))
+
+    @classmethod
+    def load(cls, path_output_fn: str):
+        """Read path_output/input_manifest.json.gz, or return None if there is none or it cannot be read"""
+        path_manifest = os.path.join(path_output_fn, MANIFEST_NAME)
+        if not os.path.isfile(path_manifest):
+            return None
+        try:
+            with gzip.open(path_manifest, 'rt', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f'\tIgnoring unreadable {MANIFEST_NAME}: {e}')
+            return None
+        # Version 1 manifests have no folder mtimes to check them against
+        if data.get('version') != 2:
+            return None
+        files = {}
+        for basename_fn, packed in data['files'].items():
+            folders = packed['folders']
+            files[basename_fn] = [ManifestEntry(name, os.path.join(folders[folder_ind], name), size, mtime, *tokens)
+                                  for folder_ind, name, size, mtime, *tokens in packed['rows']]
+        return cls(data['path_input'], data['basename_list'], data['is_nd'], data['nd_paths'], files,
+                   data['ms_choice'], data['folder_mtimes'])
+
+
+def build_input_manifest(path_input_fn: str, path_output_fn: str, ms_choice: str) -> InputManifest:
+    """Given input and output paths. Returns the manifest saved in the output folder by an earlier organize run if
+    the input folder is unchanged, otherwise scans the input folder once and saves the new manifest"""
+
+    manifest = InputManifest.load(path_output_fn)
+    if manifest is not None and manifest.is_current(path_input_fn, ms_choice):
+        print(f'\tInput folder unchanged, reusing {MANIFEST_NAME}')
+        return manifest
+
+    manifest = InputManifest.scan(path_input_fn, path_output_fn, ms_choice)
+    manifest.save(path_output_fn)
+    num_files = sum(len(entries) for entries in manifest.files.values())
+    print(f'\tIndexed {num_files} files for {len(manifest.basename_list)} basenames in {MANIFEST_NAME}')
+    return manifest
+
+
+def basenames_from_tif_names(tif_files: list) -> list:
+    """Given TIF file names without an .nd file. Returns the experiment names obtained by stripping the trailing
+    coordinate tokens (e.g. _s1_B03_t5) from each name"""
+
+    basenames_per_file = []
+    for tif in tif_files:
+        stem, _ = os.path.splitext(tif)
+        tokens = stem.split('_')
+        idx = len(tokens)
+        while idx > 0 and COORD_PATTERN.match(tokens[idx - 1]):
+            idx -= 1
+        if idx == 0:
+            print(f"\tWARNING: '{tif}' has no non-coordinate segments; using first token '{tokens[0]}' as basename.")
+            basenames_per_file.append(tokens[0])
+        else:
+            basenames_per_file.append('_'.join(tokens[:idx]))
+
+    basename = list(dict.fromkeys(basenames_per_file))
+    return [b for b in basename if 'thumb' not in b]
+
+
+def define_basename_list(path_input_fn: str, path_output_fn: str, ms_choice: str,
+                         manifest: InputManifest = None) -> (list, bool):
+    """Given an input path as a string. Will return a list of experiment names in the input folder. Reads them from
+    the input manifest when one is given"""
 
     is_nd_out = False
     basename_list_fn = []
 
-    if ms_choice == "Cytation":
+    if manifest is not None:
+        basename_list_fn, is_nd_out = list(manifest.basename_list), manifest.is_nd
+
+    elif ms_choice == "Cytation":
         basename_list_fn = [name for name in os.listdir(path_input_fn) if
                             os.path.isdir(os.path.join(path_input_fn, name))]
         basename_list_fn = [name for name in basename_list_fn if
@@ -121,86 +613,114 @@ def define_basename_list(path_input_fn: str, path_output_fn: str, ms_choice: str
         if not is_nd_out:
             file_list = os.listdir(path_input_fn)
             tif_files = [f for f in file_list if f.lower().endswith(('.tif', '.tiff'))]
-
-            coord_pattern = re.compile(r'^[A-Za-z]\d+$')
-            basenames_per_file = []
-            for tif in tif_files:
-                stem, _ = os.path.splitext(tif)
-                tokens = stem.split('_')
-                idx = len(tokens)
-                while idx > 0 and coord_pattern.match(tokens[idx - 1]):
-                    idx -= 1
-                if idx == 0:
-                    print(f"\tWARNING: '{tif}' has no non-coordinate segments; using first token '{tokens[0]}' as basename.")
-                    basenames_per_file.append(tokens[0])
-                else:
-                    basenames_per_file.append('_'.join(tokens[:idx]))
-
-            basename = list(dict.fromkeys(basenames_per_file))
-            basename_list_fn = [b for b in basename if 'thumb' not in b]
+            basename_list_fn = basenames_from_tif_names(tif_files)
 
     write_to_sp_yaml(path_output_fn, basename_list_fn, 'basename_list')
 
     return basename_list_fn, is_nd_out
 
 
-def efficient_file_copy(path_output_fn, files_to_copy):
-    # Use ThreadPoolExecutor for parallel copying
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(copy_file, file.path, os.path.join(path_output_fn, file.name)) for file in files_to_copy
-        ]
+def find_nd_file(basename_fn: str, path_input_fn: str, manifest: InputManifest = None):
+    """Returns the path of the basename's .nd file in the input folder, or None if there is none"""
 
-        # Wait for all copying tasks to complete
-        for future in futures:
-            future.result()
+    if manifest is not None:
+        return manifest.nd_paths.get(basename_fn)
+    nd_path = os.path.join(path_input_fn, basename_fn + '.nd')
+    return nd_path if os.path.isfile(nd_path) else None
 
 
-def sort_basename_folders(basename_list_fn: list, path_input_fn: str, path_output_fn: str, ms_choice: str):
-    """Given a list of experiments obtained from the .nd files in the input folder. Given input and out paths as str.
- Creates an output folder at path_output. Copies and sorts TIFF files in path_input according to basenames in output
- folder"""
+def iter_basename_files(basename_fn: str, path_input_fn: str, ms_choice: str, manifest: InputManifest = None):
+    """Given a basename and the input folder. Yields the os.DirEntry (or ManifestEntry when a manifest is given) of
+    every raw image belonging to that basename, excluding thumbnail files, while the input folder is scanned"""
 
-    for basename_fn in basename_list_fn:
-        destination_folder = os.path.join(path_output_fn, basename_fn)
-        # create folders for each expt
-        try:
-            os.makedirs(destination_folder, exist_ok=True)
-        except OSError as e:
-            # If it fails, inform the user.
-            print('Error: %s - %s.' % (e.filename, e.strerror))
+    if manifest is not None:
+        yield from manifest.files.get(basename_fn, [])
 
-        # copy files into respective basename folders
+    elif ms_choice == "Cytation":
+        path_temp = os.path.join(path_input_fn, basename_fn)
+        # Get all .tif files
+        yield from (file for file in os.scandir(path_temp) if file.name.lower().endswith(('.tif', '.tiff')))
 
+    else:
+        yield from (file for file in os.scandir(path_input_fn)
+                    if file.name.startswith(basename_fn + '_') and not fnmatch.fnmatch(file.name, '*thumb*'))
 
-        if ms_choice == "Cytation":
-            path_temp = os.path.join(path_input_fn, basename_fn)
 
-            # Get all .tif files
-            tif_files = [file for file in os.scandir(path_temp) if file.name.lower().endswith(('.tif', '.tiff'))]
+class NDInfo(NamedTuple):
+    """Metadata read from a MetaMorph .nd file"""
+    stage_positions: dict  # {N: stage label, e.g. 'A01'}
+    timepoints: int
+    wavelengths: list
+    fields: dict  # every "key", value pair in the file
 
-            # for file in os.listdir(path_temp):
-            #     if file.endswith('.tif' or '.TIF'):
-            #         copy_file(os.path.join(path_temp, file), os.path.join(path_output_fn, basename_fn, file))
+    @property
+    def wells(self) -> dict:
+        """{N: well label} with the well (e.g. B03) extracted from each stage label"""
+        wells = {}
+        for stage_num, label in self.stage_positions.items():
+            well_match = re.search(r'[A-H]\d{2}', label)
+            wells[stage_num] = well_match.group(0) if well_match else label
+        return wells
 
-        else:
-            # copy .nd file into respective basename folder
-            if os.path.isfile(os.path.join(path_input_fn, basename_fn + '.nd')):
-                copy_file(os.path.join(path_input_fn, basename_fn + '.nd'),
-                          os.path.join(destination_folder, basename_fn + '.nd'))
 
-            # copy TIF files to respective basename folders, excludes thumbnail files
+# Parsed .nd files keyed by (path, mtime, size) so each file is only read again after it changes
+_ND_CACHE = {}
+
+
+def _nd_value(value: str):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    if value in ('TRUE', 'FALSE'):
+        return value == 'TRUE'
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_nd_file(path_nd: str) -> NDInfo:
+    """Given the path to a .nd file. Reads it once, line by line, into an NDInfo. Results are cached until the file's
+    mtime or size changes"""
+
+    stat = os.stat(path_nd)
+    cache_key = (os.path.abspath(path_nd), stat.st_mtime_ns, stat.st_size)
+    if cache_key in _ND_CACHE:
+        return _ND_CACHE[cache_key]
+
+    fields = {}
+    with open(path_nd, 'r', errors='replace') as nd_file:
+        for line in nd_file:
+            key, sep, value = line.partition(',')
+            key = key.strip().strip('"')
+            if key:
+                fields[key] = _nd_value(value) if sep else None
+
+    num_stages = fields.get('NStagePositions') if fields.get('DoStage', True) else 0
+    num_stages = num_stages if isinstance(num_stages, int) else 0
+    stage_positions = {N: str(fields['Stage' + str(N)]) for N in range(1, num_stages + 1) if 'Stage' + str(N) in fields}
+
+    num_timepoints = fields.get('NTimePoints') if fields.get('DoTimelapse', True) else 1
+    num_timepoints = num_timepoints if isinstance(num_timepoints, int) else 1
+
+    num_waves = fields.get('NWavelengths') if fields.get('DoWave', True) else 0
+    num_waves = num_waves if isinstance(num_waves, int) else 0
+    wavelengths = [str(fields.get('WaveName' + str(N), N)) for N in range(1, num_waves + 1)]
+
+    nd_info = NDInfo(stage_positions, num_timepoints, wavelengths, fields)
+    _ND_CACHE[cache_key] = nd_info
+    return nd_info
+
 
-            # Prepare the file list
-            tif_files = [ file for file in os.scandir(path_input_fn)
-                    if file.name.startswith(basename_fn + '_') and not fnmatch.fnmatch(file.name, '*thumb*')
-                ]
+def parse_nd_files(nd_paths: list, max_workers: int = None) -> dict:
+    """Given a list of .nd paths. Parses them concurrently and returns {path: NDInfo}"""
 
-        # Copy all .tif files to the destination folder
-        efficient_file_copy(destination_folder, tif_files)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(nd_paths, executor.map(parse_nd_file, nd_paths)))
 
 
-def extract_nd_info(basename_list_fn: list, path_output_fn: str, is_nd: bool, ms_choice: str) -> dict:
+def extract_nd_info(basename_list_fn: list, path_output_fn: str, is_nd: bool, ms_choice: str,
+                    manifest: InputManifest = None) -> dict:
     """Given a basename list and an output path. Will extract number of stage positions for each list and create
     position map lists for each basename"""
     #Stage position and timepoint information is extracted from the .nd file or from the files in the folder - can be returned from this function if needed
@@ -208,49 +728,23 @@ def extract_nd_info(basename_list_fn: list, path_output_fn: str, is_nd: bool, ms
     stage_positions = []
     timepoints_list = []
     stage_pos_maps = {}
-    stage_pos_submap = {}
     if is_nd:
-        for index_fn, basename_fn in enumerate(basename_list_fn):
-            with open(os.path.join(path_output_fn, basename_fn, basename_fn + '.nd'), 'r') as nd_file:
-                print("\tOpened .nd")
-                for l_no, line in enumerate(nd_file):
-                    if '"NStagePositions"' in line:
-                        spos_int = [int(s) for s in line.split() if s.isdigit()][-1]
-                        stage_positions.append(spos_int)
-                        stage_pos_submap = {}
-                        for l_no1, line1 in enumerate(nd_file):
-                            for N in range(1, spos_int+1):
-                                if '"Stage' + str(N) + '"' in line1:
-                                    sp_well = line1.split('"')[-2]
-                                    stage_pos_submap[N] = sp_well
-                        break
-            stage_pos_maps[basename_fn] = stage_pos_submap
-            print("\tExtracted information from .nd file")
+        nd_paths = [os.path.join(path_output_fn, basename_fn, basename_fn + '.nd') for basename_fn in basename_list_fn]
+        nd_infos = parse_nd_files(nd_paths)
+        for basename_fn, nd_path in zip(basename_list_fn, nd_paths):
+            nd_info = nd_infos[nd_path]
+            stage_positions.append(len(nd_info.stage_positions))
+            timepoints_list.append(nd_info.timepoints)
+            stage_pos_maps[basename_fn] = dict(nd_info.stage_positions)
+            print(f"\tExtracted information from .nd file for {basename_fn}")
     else:
         for index_fn,basename_fn in enumerate(basename_list_fn):
-            file_list = os.listdir(os.path.join(path_output_fn,basename_fn))
-
-            positions = []
-            for file in file_list:
-                spos = file
-                stage_pattern_s = r's(\d+)'
-                stage_pattern_letter = r'([A-H])(\d+)'
-
-                stage_wellpos_match = re.search(stage_pattern_letter, file)
-                stage_match_s = re.search(stage_pattern_s,file)
-
-                if stage_wellpos_match:
-                    spos = stage_wellpos_match.group(0)
-                elif stage_match_s:
-                    spos = stage_match_s.group(0)
-                positions.append(spos)
-            positions = list(dict.fromkeys(positions))
-            print('\tPositions:',positions)
-            stage_positions.append(len(positions))
-
-            positions = [pos[:1] + pos[1:].zfill(2) for pos in positions]
-            positions.sort()
-            stage_pos_submaps = {N: position for N,position in zip(range(1,len(positions)+1), positions)}
+            if manifest is not None:
+                stage_pos_submaps = stage_position_map([entry.position for entry in manifest.files.get(basename_fn, [])])
+            else:
+                file_list = os.listdir(os.path.join(path_output_fn,basename_fn))
+                stage_pos_submaps = positions_from_filenames(file_list)
+            stage_positions.append(len(stage_pos_submaps))
             stage_pos_maps[basename_fn]=stage_pos_submaps
             print('\tExtracted information from files in folder')
 
@@ -259,83 +753,1040 @@ def extract_nd_info(basename_list_fn: list, path_output_fn: str, is_nd: bool, ms
     return stage_pos_maps
 
 
-def move_rename_files(file, basename_fn: str, parent_output_fn: str,
-                      stage_pos_maps_fn: dict, image_type_fn: str, ms_choice: str, is_nd: bool):
-    if not file.lower().endswith(('.tif', '.tiff')):
-        return f"Skipped non-TIF file: {file}"
+def positions_from_filenames(file_list: list) -> dict:
+    """Given a list of file names without an .nd file. Returns the stage position map {N: position} built from the
+    well (e.g. B03) or stage (e.g. s3) token in each name"""
 
-    timepoint_pattern = r't(\d+)'
-    stage_pattern_s = r's(\d+)'
-    stage_pattern_letter = r'([A-H])(\d+)'
+    positions = []
+    for file in file_list:
+        _, well_token, stage_token = parse_image_name(file)
+        positions.append(well_token or stage_token or file)
+    return stage_position_map(positions)
 
-    new_filename = file
-    timepoint_match = re.search(timepoint_pattern, file)
-    stage_wellpos_match = re.search(stage_pattern_letter, file)
-    stage_match_s = re.search(stage_pattern_s, file)
 
-    if timepoint_match:
-        timepoint_num = int(timepoint_match.group(1))
+def stage_position_map(positions: list) -> dict:
+    """Given the position token of every file. Returns the sorted, zero-padded stage position map {N: position}"""
+
+    positions = list(dict.fromkeys(positions))
+    print('\tPositions:',positions)
+
+    positions = [pos[:1] + pos[1:].zfill(2) for pos in positions]
+    positions.sort()
+    return {N: position for N,position in zip(range(1,len(positions)+1), positions)}
+
+
+def rename_for_position(file: str, basename_fn: str, stage_pos_maps_fn: dict, is_nd: bool,
+                        tokens: tuple = None) -> (str, str):
+    """Given a raw TIF file name. Returns the stage position folder name and the zero-padded file name it is stored
+    under inside <position>/<type>_images. The position is None if the name has no well or stage token. Pass the
+    tokens from a ManifestEntry to skip parsing the name again"""
+
+    timepoint_token, well_token, stage_token = tokens if tokens is not None else parse_image_name(file)
+
+    new_filename = file
+    if timepoint_token:
+        timepoint_num = int(timepoint_token[1:])
         new_timepoint = f't{timepoint_num:03d}'
-        new_filename = new_filename.replace(timepoint_match.group(0), new_timepoint)
+        new_filename = new_filename.replace(timepoint_token, new_timepoint)
 
-    if stage_wellpos_match:
-        spos = stage_wellpos_match.group(0)
-    elif stage_match_s:
-        stage_num = int(stage_match_s.group(1))
+    spos = None
+    if well_token:
+        spos = well_token
+    elif stage_token:
+        stage_num = int(stage_token[1:])
         spos = f's{stage_num:03d}'
         if is_nd:
             spos += '_' + str(stage_pos_maps_fn[basename_fn][stage_num])
-        new_filename = new_filename.replace(stage_match_s.group(0), spos)
+        new_filename = new_filename.replace(stage_token, spos)
+
+    return spos, new_filename
+
+
+class AdaptiveCopyEngine:
+    """Thread pool for copying or linking files that tunes its own concurrency. Every window seconds it measures the
+    throughput and moves the number of active workers up or down (hill climbing), so local SSDs get many parallel
+    small-file copies while network shares are not thrashed by too many streams. Small files are grouped into
+    batches to cut per-task overhead. submit() blocks when max_queued batches are waiting, so the producer never
+    runs far ahead of the disk. Failed operations are counted and reported separately and do not add to the measured
+    throughput. Callbacks run on the worker threads; the first exception raised by a callback is raised again by
+    the next submit() or by close()"""
+
+    # Per-file overhead counted as this many bytes when comparing throughput, so small-file workloads also register
+    file_cost_bytes = 64 * 1024
+
+    def __init__(self, max_workers: int = None, min_workers: int = 1, initial_workers: int = None,
+                 window: float = 2.0, batch_files: int = 32, batch_bytes: int = 16 * 1024 * 1024,
+                 max_queued: int = 64):
+        self.max_workers = max_workers or min(64, 4 * (os.cpu_count() or 1))
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.limit = max(self.min_workers, min(initial_workers or 4, self.max_workers))
+        self.window = window
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+
+        self.bytes_done = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.time_start = time.time()
+        self._lock = threading.Lock()
+        self._callback_error = None
+        # Workers above the current limit wait here until the tuner raises the limit or the engine closes
+        self._limit_changed = threading.Condition()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._closed = threading.Event()
+        self._batch = []
+        self._batch_size = 0
+
+        self._threads = [threading.Thread(target=self._worker, args=(ind,), daemon=True)
+                         for ind in range(self.max_workers)]
+        for thread in self._threads:
+            thread.start()
+        self._tuner = threading.Thread(target=self._tune, daemon=True)
+        self._tuner.start()
+
+    def submit(self, fn, size: int, *args, callback=None, error_callback=None):
+        """Queue fn(*args) for a file of the given size. callback(result) is called when it finishes, or
+        error_callback(exception) when it raises"""
+        if self._callback_error is not None:
+            raise self._callback_error
+        task = (fn, args, size, callback, error_callback)
+        if size >= LARGE_FILE_BYTES:
+            self._queue.put([task])
+            return
+        self._batch.append(task)
+        self._batch_size += size
+        if len(self._batch) >= self.batch_files or self._batch_size >= self.batch_bytes:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+            self._batch_size = 0
+
+    def _set_limit(self, limit: int):
+        with self._limit_changed:
+            self.limit = limit
+            self._limit_changed.notify_all()
+
+    def _worker(self, ind: int):
+        while True:
+            with self._limit_changed:
+                while ind >= self.limit:
+                    if self._closed.is_set():
+                        return
+                    self._limit_changed.wait()
+            try:
+                batch = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._closed.is_set():
+                    return
+                continue
+            try:
+                for fn, args, size, callback, error_callback in batch:
+                    try:
+                        result = fn(*args)
+                    except Exception as e:
+                        with self._lock:
+                            self.files_failed += 1
+                        if error_callback is not None:
+                            self._run_callback(error_callback, e)
+                        else:
+                            print(f'\tError in file operation {args[:2]}: {e}')
+                        continue
+                    with self._lock:
+                        self.bytes_done += size
+                        self.files_done += 1
+                    if callback is not None:
+                        self._run_callback(callback, result)
+            finally:
+                # close() waits on the queue, so every batch is marked done even if a callback raised
+                self._queue.task_done()
+
+    def _run_callback(self, callback, arg):
+        # Keep the worker alive and hand the first error to the producer; later files are still processed
+        try:
+            callback(arg)
+        except Exception as e:
+            with self._lock:
+                if self._callback_error is None:
+                    self._callback_error = e
+
+    def _tune(self):
+        direction = 1
+        last_rate = None
+        last_work = 0
+        while not self._closed.wait(self.window):
+            with self._lock:
+                work = self.bytes_done + self.files_done * self.file_cost_bytes
+            rate = (work - last_work) / self.window
+            last_work = work
+            # Only tune while the workers are the bottleneck, not the producer
+            if self._queue.qsize() < self.limit:
+                last_rate = None
+                continue
+            if last_rate is not None and rate < 0.95 * last_rate:
+                direction = -direction
+            step = max(1, self.limit // 4)
+            self._set_limit(max(self.min_workers, min(self.max_workers, self.limit + direction * step)))
+            if self.limit in (self.min_workers, self.max_workers):
+                direction = 1 if self.limit == self.min_workers else -1
+            last_rate = rate
+
+    def stats(self) -> dict:
+        elapsed = max(time.time() - self.time_start, 1e-9)
+        return {'files': self.files_done, 'failed': self.files_failed, 'megabytes': self.bytes_done / 1e6,
+                'seconds': elapsed,
+                'mb_per_s': self.bytes_done / 1e6 / elapsed, 'files_per_s': self.files_done / elapsed,
+                'workers': self.limit}
+
+    def close(self):
+        """Wait for every queued operation to finish and print the throughput"""
+        self._flush_batch()
+        self._queue.join()
+        with self._limit_changed:
+            self._closed.set()
+            self._limit_changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._tuner.join()
+        stats = self.stats()
+        print(f"\tProcessed {stats['files']} files ({stats['megabytes']:.1f} MB) in {format_timespan(stats['seconds'])}: "
+              f"{stats['mb_per_s']:.1f} MB/s, {stats['files_per_s']:.1f} files/s, {stats['workers']} workers")
+        if stats['failed']:
+            print(f"\tWARNING: {stats['failed']} file operations failed")
+        if self._callback_error is not None:
+            raise self._callback_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the exception that is already leaving the with block
+            if exc_type is None:
+                raise
+
+
+JOURNAL_NAME = 'organize_journal.tsv'
+
+
+class OrganizeJournal:
+    """Append-only record of the file operations completed by the organize step, stored in the output folder as
+    organize_journal.tsv. Each line holds the source, destination, strategy and the source size and mtime, so a
+    re-run against the same output folder can skip every file that was already placed and is still intact. A run
+    that placed every file ends the journal with a finished marker"""
+
+    header = 'source\tdestination\tstrategy\tsize\tmtime\n'
+    finished_marker = '# finished\n'
+
+    def __init__(self, path_output_fn: str):
+        self.path = os.path.join(path_output_fn, JOURNAL_NAME)
+        self.completed = self._read()
+        self._lock = threading.Lock()
+        is_new = not os.path.exists(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if is_new:
+            self._file.write(self.header)
+            self._file.flush()
+
+    def _read(self) -> dict:
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as file:
+            next(file, None)
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                # A line cut short by a crash is ignored, its file is placed again
+                if len(fields) != 5 or not line.endswith('\n'):
+                    continue
+                source, destination, strategy, size, mtime = fields
+                completed[destination] = (source, strategy, int(size), float(mtime))
+        return completed
+
+    def is_complete(self, src, dest, size: int, mtime: float) -> bool:
+        """True if dest was placed from this unchanged src and still has the source's size and mtime"""
+        record = self.completed.get(dest)
+        if record is None or record[0] != src or record[2] != size or record[3] != mtime:
+            return False
+        try:
+            stat = os.stat(dest)
+        except OSError:
+            return False
+        # copy2, links and copystat keep the source mtime; allow for coarse timestamps on network/FAT drives
+        return stat.st_size == size and abs(stat.st_mtime - mtime) <= 2.0
+
+    def record(self, src, dest, strategy: str, size: int, mtime: float):
+        with self._lock:
+            self._file.write(f'{src}\t{dest}\t{strategy}\t{size}\t{mtime!r}\n')
+            self._file.flush()
+
+    def mark_finished(self):
+        """Record that every file of the plate was placed, so the output folder is not resumed again"""
+        with self._lock:
+            self._file.write(self.finished_marker)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def organize_unfinished(path_output_fn) -> bool:
+    """True if path_output holds an organize journal without the finished marker, i.e. an organize or watch run
+    that was interrupted or could not place every file and can be resumed"""
+    path_journal = os.path.join(path_output_fn, JOURNAL_NAME)
+    if not os.path.isfile(path_journal):
+        return False
+    marker = OrganizeJournal.finished_marker.encode()
+    with open(path_journal, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(0, file.tell() - len(marker)))
+        return file.read() != marker
+
+
+def place_file_task(src, dest, link_mode: str, size: int = None, mtime: float = None,
+                    ingest_index: IngestIndex = None) -> tuple:
+    """place_file (or IngestIndex.place when an index is given) for the copy engine. Returns (source, destination,
+    strategy, size, mtime); errors are raised to the engine, which counts the file as failed"""
+    if ingest_index is not None:
+        return src, dest, ingest_index.place(src, dest, link_mode), size, mtime
+    return src, dest, place_file(src, dest, link_mode), size, mtime
+
+
+def stream_sort_stage_pos(basename_list_fn: list, path_input_fn: str, parent_output_fn: str, image_type_fn: str,
+                          ms_choice: str, is_nd: bool, link_mode: str = 'copy', manifest: InputManifest = None,
+                          max_workers: int = None, dedup: str = None) -> dict:
+    """Single-pass organize. Computes the final <basename>/<position>/<type>_images/<renamed> path of every raw TIF
+    while iterating the input files, creates each position folder and copies its wc_dataset_*.yaml once, and feeds a
+    AdaptiveCopyEngine that copies or links (see place_file) each file straight to that path. Nothing is staged in the
+    basename folder, so the output never holds a second copy of the plate. Every completed file is appended to the
+    OrganizeJournal; files the journal shows as already placed and intact are skipped, so an interrupted organize
+    can be re-run on the same output folder. With dedup set to 'fast' or 'full', files that would be copied are
+    looked up in the IngestIndex by content hash and linked to identical frames of earlier runs. Returns the stage
+    position maps and writes organize_report.tsv with the strategy used for each file"""
 
-    path_input_fn = os.path.join(parent_output_fn, basename_fn)
-    path_pos_output_fn = os.path.join(parent_output_fn, basename_fn, spos)
-    target_dir = os.path.join(path_pos_output_fn, f'{image_type_fn}_images')
+    stage_pos_maps = {}
+    report = []
+    yaml_src = os.path.join(parent_output_fn, f'wc_dataset_{image_type_fn}.yaml')
+    time_start = time.time()
 
-    #print(f'Creating directory: {target_dir}')
-    os.makedirs(target_dir, exist_ok=True)
+    journal = OrganizeJournal(parent_output_fn)
+    ingest_index = IngestIndex(dedup) if dedup else None
+    if journal.completed:
+        print(f'\tFound {len(journal.completed)} completed operations in {JOURNAL_NAME}, resuming')
 
-    yaml_src = os.path.join(parent_output_fn, f'wc_dataset_{image_type_fn}.yaml')
-    yaml_dst = os.path.join(path_pos_output_fn, f'wc_dataset_{image_type_fn}.yaml')
-    if not os.path.exists(yaml_dst):
-        #print(f'Copying YAML file to: {yaml_dst}')
-        shutil.copy2(yaml_src, yaml_dst)
-
-    source_path = os.path.join(path_input_fn, file)
-    target_path = os.path.join(target_dir, new_filename)
-    #print(f'Moving file from {source_path} to {target_path}')
-    try:
-        shutil.move(source_path, target_path)
-        #return f"Successfully moved: {file} to {target_path}"
-    except OSError as e:
-        error_msg = f'Error: {e.filename} - {e.strerror}'
-        print(error_msg)
+    def on_placed(result):
+        src, dest, strategy, size, mtime = result
+        report.append((src, dest, strategy))
+        journal.record(src, dest, strategy, size, mtime)
 
+    def on_failed(src, dest, error):
+        report.append((src, dest, 'failed'))
+        print(f'\tError placing {src}: {error}')
 
-def efficient_sort_stage_pos(basename_list_fn: list, parent_output_fn: str,
-                             stage_pos_maps_fn: dict, image_type_fn: str, ms_choice: str, is_nd: bool):
-    """Given basename list, parent output folder and number of stage positions list extracted from nd files. Sorts
-    files into stage position folders"""
-    print('\tEntered efficient_sort_stage_pos')
-    with ThreadPoolExecutor() as executor:
+    with AdaptiveCopyEngine(max_workers=max_workers) as engine:
         for basename_fn in basename_list_fn:
             print(f'\tProcessing basename: {basename_fn}')
-            file_list = [entry.name for entry in os.scandir(os.path.join(parent_output_fn, basename_fn))
-                         if entry.is_file() and entry.name.lower().endswith(('.tif', '.tiff'))]
-            print(f'\tFound {len(file_list)} TIF files for {basename_fn}')
+            destination_folder = os.path.join(parent_output_fn, basename_fn)
+            os.makedirs(destination_folder, exist_ok=True)
 
-            # Use list() to force execution of all tasks
-            results = list(
-                executor.map(partial(move_rename_files, basename_fn=basename_fn, parent_output_fn=parent_output_fn,
-                                     stage_pos_maps_fn=stage_pos_maps_fn, image_type_fn=image_type_fn,
-                                     ms_choice=ms_choice, is_nd=is_nd), file_list))
+            # The .nd file is small and provides the stage map used to name the files, so it is copied first
+            nd_src = find_nd_file(basename_fn, path_input_fn, manifest)
+            if ms_choice != "Cytation" and nd_src:
+                copy_file(nd_src, os.path.join(destination_folder, basename_fn + '.nd'))
+            if is_nd:
+                stage_pos_maps.update(extract_nd_info([basename_fn], parent_output_fn, is_nd, ms_choice))
+
+            prepared_positions = set()
+            position_tokens = []
+            num_files = 0
+            for file in iter_basename_files(basename_fn, path_input_fn, ms_choice, manifest):
+                tokens = file.tokens if isinstance(file, ManifestEntry) else parse_image_name(file.name)
+                position_tokens.append(tokens[1] or tokens[2] or file.name)
+                if not file.name.lower().endswith(('.tif', '.tiff')):
+                    continue
+
+                spos, new_filename = rename_for_position(file.name, basename_fn, stage_pos_maps, is_nd, tokens)
+                if spos is None:
+                    print(f'\tSkipped {file.name}: no stage position found in file name')
+                    continue
+
+                path_pos_output_fn = os.path.join(destination_folder, spos)
+                target_dir = os.path.join(path_pos_output_fn, f'{image_type_fn}_images')
+                if spos not in prepared_positions:
+                    os.makedirs(target_dir, exist_ok=True)
+                    shutil.copy2(yaml_src, os.path.join(path_pos_output_fn, f'wc_dataset_{image_type_fn}.yaml'))
+                    prepared_positions.add(spos)
+
+                target_path = os.path.join(target_dir, new_filename)
+                if isinstance(file, ManifestEntry):
+                    size, mtime = file.size, file.mtime
+                else:
+                    stat = file.stat()
+                    size, mtime = stat.st_size, stat.st_mtime
+                if journal.is_complete(file.path, target_path, size, mtime):
+                    report.append((file.path, target_path, 'journaled'))
+                    continue
+
+                engine.submit(place_file_task, size, file.path, target_path, link_mode, size, mtime, ingest_index,
+                              callback=on_placed, error_callback=partial(on_failed, file.path, target_path))
+                num_files += 1
+
+            if not is_nd:
+                stage_pos_maps[basename_fn] = stage_position_map(position_tokens)
+            print(f'\tQueued {num_files} TIF files in {len(prepared_positions)} positions for {basename_fn}')
+
+    if not any(strategy == 'failed' for _, _, strategy in report):
+        journal.mark_finished()
+    journal.close()
+    if ingest_index is not None:
+        ingest_index.close()
+
+    with open(os.path.join(parent_output_fn, 'organize_report.tsv'), 'w') as file:
+        file.write('source\tdestination\tstrategy\n')
+        for row in report:
+            file.write('\t'.join(row) + '\n')
+
+    strategy_counts = {}
+    for _, _, strategy in report:
+        strategy_counts[strategy] = strategy_counts.get(strategy, 0) + 1
+    print(f'\tPlaced {len(report)} files in {format_timespan(time.time() - time_start)}: {strategy_counts}')
+
+    return stage_pos_maps
+
+
+def organize_plate(path_input_fn: str, path_output_fn: str, image_type_fn: str, low_quality_frame_inds: List,
+                   run_before_injury_and_after_injury_together: bool, ms_choice: str = '', link_mode: str = 'copy',
+                   dedup: str = None, pack_stacks: bool = False, remove_tifs: bool = False) -> (list, dict):
+    """Organize .tif files and prepare .yaml files. Given the input folder and an existing output folder. Writes the
+    wc_dataset yaml, indexes the input folder, sorts every raw image into its stage position folder and optionally
+    packs image stacks, removing the sorted TIFs with remove_tifs. Returns the basename list and stage position
+    maps"""
+
+    # Create yaml file for image type
+    create_wc_yaml(path_output_fn, image_type_in=image_type_fn, is_fl_in=False, is_pillars_in=True,
+                   low_quality_frame_inds=low_quality_frame_inds,
+                   run_before_injury_and_after_injury_together=run_before_injury_and_after_injury_together)
+
+    # Index the input folder once; every organize step below reads from this manifest
+    manifest = build_input_manifest(path_input_fn, path_output_fn, ms_choice)
+
+    basename_list, is_nd = define_basename_list(path_input_fn, path_output_fn, ms_choice, manifest)
+    print("\tBasename list:", basename_list)
+    print("\t.nd file found:", is_nd)
+
+    # Copy or link every raw image straight into its stage position folder in a single streaming pass
+    print(f"\tSorting images into their stage position folders (mode: {link_mode})...")
+    stage_pos_maps = stream_sort_stage_pos(basename_list, path_input_fn, path_output_fn, image_type_fn, ms_choice,
+                                           is_nd, link_mode, manifest, dedup=dedup)
+    if pack_stacks:
+        print("\tPacking images of each stage position into a stack...")
+        pack_position_stacks(basename_list, path_output_fn, image_type_fn, remove_tifs)
+    print("\tDone organizing .tif files and preparing .yaml files!")
+    return basename_list, stage_pos_maps
+
+
+def load_organized_plate(path_output_fn: str) -> (list, dict):
+    """Given a folder organized earlier. Returns its basename list (from basename_list.yaml, or the sub folders) and
+    stage position maps (from stage_positions.yaml, the .nd files or the position folders)"""
+
+    file_list = os.listdir(path_output_fn)
+    if "basename_list.yaml" in file_list:
+        print("\tFound basename_list.yaml file in the input folder")
+        with open(os.path.join(path_output_fn, 'basename_list.yaml'), 'r') as file:
+            # Load the YAML content
+            basename_list = yaml.safe_load(file)
+    else:
+        # If basename.yaml file is not found, then get the list of folders in the input folder
+        # and set it as the basename list
+        basename_list = os.listdir(path_output_fn)
+        basename_list = [name for name in basename_list if os.path.isdir(os.path.join(path_output_fn, name))]
+
+    if "stage_positions.yaml" in file_list:
+        print("\tFound stage_positions.yaml file in the input folder")
+        with open(os.path.join(path_output_fn, 'stage_positions.yaml'), 'r') as file:
+            # Load the YAML content
+            data = yaml.safe_load(file)
+        stage_pos_maps = {}
+        for index, basename in enumerate(basename_list):
+            stage_pos_maps[basename] = data[basename]
+        return basename_list, stage_pos_maps
+
+    # If stage_positions.yaml file is not found, use the .nd file copied into each basename folder, or else
+    # get the list of folders in the basename folder and set it as the stage_pos_maps
+    stage_pos_maps = {}
+    nd_paths = {basename: os.path.join(path_output_fn, basename, basename + '.nd') for basename in basename_list}
+    nd_paths = {basename: path for basename, path in nd_paths.items() if os.path.isfile(path)}
+    nd_infos = parse_nd_files(list(nd_paths.values()))
+    for index, basename in enumerate(basename_list):
+        if basename in nd_paths and nd_infos[nd_paths[basename]].stage_positions:
+            stage_pos_maps[basename] = dict(nd_infos[nd_paths[basename]].stage_positions)
+            print(f"\tFound {len(stage_pos_maps[basename])} stage positions for {basename} in its .nd file.")
+            continue
+        path_temp = os.path.join(path_output_fn, Path(basename))
+        try:
+            positions = os.listdir(path_temp)
+            positions.sort()
+            positions = [n1 for n1 in positions if not n1.endswith('.nd')]
+            stage_pos_maps[basename] = {N: position for N, position in zip(range(1, len(positions) + 1), positions)}
+            print(f"\tFound {len(positions)} stage positions for {basename}.")
+        except FileNotFoundError:
+            print(f"\tNo folder found for {basename}. Skipping...")
+            continue
+    return basename_list, stage_pos_maps
+
+
+def find_wc_yaml_files(base_path) -> list:
+    """Returns one wc_dataset_*.yaml per folder under base_path"""
+
+    yaml_files = set()
+    for root, dirs, files in os.walk(base_path):
+        for file in files:
+            if file.endswith('.yaml') and 'wc_dataset_' in file:
+                yaml_files.add(os.path.join(root, file))
+                break
+
+    return list(yaml_files)
+
+
+def update_wc_yamls(base_path, image_type_fn: str, low_quality_frame_inds: List,
+                    run_before_injury_and_after_injury_together: bool):
+    """Rewrite every wc_dataset_*.yaml under base_path with the settings for image_type"""
+
+    for yaml_file in find_wc_yaml_files(base_path):
+        if os.path.exists(yaml_file):
+            os.remove(yaml_file)
+        create_wc_yaml(os.path.dirname(yaml_file), image_type_fn, False, True, low_quality_frame_inds,
+                       run_before_injury_and_after_injury_together)
+
+
+def compiled_folder_status(basename_list_fn: list, path_output_fn) -> (list, list):
+    """Returns the *_compiled folders that exist and those that are missing for the *_ai basenames"""
+
+    found_compiled = []
+    missing_compiled = []
+    for bn in basename_list_fn:
+        if bn.endswith('_ai'):
+            compiled_name = bn[:-len('_ai')] + '_compiled'
+            if os.path.isdir(os.path.join(path_output_fn, compiled_name)):
+                found_compiled.append(compiled_name)
+            else:
+                missing_compiled.append(compiled_name)
+    return found_compiled, missing_compiled
 
 
-def wc_run(input_path_fn: str):
+def stack_paths(position_path: str, image_type_fn: str) -> (str, str):
+    """Paths of a position's image stack and its frame index"""
+    return (os.path.join(position_path, f'{image_type_fn}_stack.npy'),
+            os.path.join(position_path, f'{image_type_fn}_stack_index.json'))
+
+
+def pack_position_stack(position_path: str, image_type_fn: str, remove_tifs: bool = False) -> str:
+    """Given a stage position folder. Packs the TIFs of <type>_images into a single <type>_stack.npy of shape
+    (frames, height, width) with a <type>_stack_index.json frame index, so the whole time-lapse can be opened as one
+    memory map (see load_position_stack). Frames are stored contiguously, one chunk per frame. TIFs are decoded in
+    parallel. With remove_tifs the per-frame TIFs are deleted afterwards, which the index records; wc_run restores
+    them from the stack while WoundCompute runs and deletes them again afterwards. Returns the stack path, or None
+    if the folder has no TIFs, a frame cannot be read or the frames differ in shape"""
+    import numpy as np
+    from PIL import Image
+
+    image_folder = os.path.join(position_path, f'{image_type_fn}_images')
+    frame_names = sorted(f for f in os.listdir(image_folder) if f.lower().endswith(('.tif', '.tiff')))
+    if not frame_names:
+        return None
+
+    try:
+        with Image.open(os.path.join(image_folder, frame_names[0])) as first_frame:
+            first_array = np.asarray(first_frame)
+    except OSError as e:
+        print(f'\tNot packing {position_path}: {e}')
+        return None
+    path_stack, path_index = stack_paths(position_path, image_type_fn)
+    stack = None
+
+    def read_frame(frame_ind):
+        with Image.open(os.path.join(image_folder, frame_names[frame_ind])) as frame:
+            frame_array = np.asarray(frame)
+        if frame_array.shape != first_array.shape:
+            raise ValueError(f'{frame_names[frame_ind]} has shape {frame_array.shape}, expected {first_array.shape}')
+        stack[frame_ind] = frame_array
+
+    packed = False
+    try:
+        stack = np.lib.format.open_memmap(path_stack + '.tmp', mode='w+', dtype=first_array.dtype,
+                                          shape=(len(frame_names),) + first_array.shape)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(read_frame, range(len(frame_names))))
+        stack.flush()
+        packed = True
+    except (ValueError, OSError) as e:
+        # OSError also covers frames PIL cannot decode (UnidentifiedImageError)
+        print(f'\tNot packing {position_path}: {e}')
+    finally:
+        # The memory map must be closed before its file is removed or renamed
+        stack = None
+        if not packed and os.path.exists(path_stack + '.tmp'):
+            os.remove(path_stack + '.tmp')
+    if not packed:
+        return None
+
+    os.replace(path_stack + '.tmp', path_stack)
+    with open(path_index, 'w') as file:
+        json.dump({'frames': frame_names, 'shape': list(first_array.shape), 'dtype': str(first_array.dtype),
+                   'tifs_removed': remove_tifs}, file)
+
+    if remove_tifs:
+        for frame_name in frame_names:
+            os.remove(os.path.join(image_folder, frame_name))
+    return path_stack
+
+
+def pack_position_stacks(basename_list_fn: list, parent_output_fn: str, image_type_fn: str, remove_tifs: bool = False):
+    """Packs every stage position folder of each basename with pack_position_stack"""
+
+    for basename_fn in basename_list_fn:
+        basename_path = os.path.join(parent_output_fn, basename_fn)
+        if not os.path.isdir(basename_path):
+            continue
+        positions = [entry.path for entry in os.scandir(basename_path)
+                     if entry.is_dir() and os.path.isdir(os.path.join(entry.path, f'{image_type_fn}_images'))]
+        packed = [pack_position_stack(position, image_type_fn, remove_tifs) for position in positions]
+        print(f'\tPacked {sum(p is not None for p in packed)} of {len(positions)} positions of {basename_fn} into stacks')
+
+
+def load_position_stack(position_path: str, image_type_fn: str):
+    """Returns (stack, frame_names) for a packed position, with the stack opened as a read-only np.memmap, or
+    (None, []) if the position has no stack"""
+    import numpy as np
+
+    path_stack, path_index = stack_paths(position_path, image_type_fn)
+    if not (os.path.isfile(path_stack) and os.path.isfile(path_index)):
+        return None, []
+    with open(path_index, 'r') as file:
+        frame_names = json.load(file)['frames']
+    return np.load(path_stack, mmap_mode='r'), frame_names
+
+
+def unpack_position_stack(position_path: str, image_type_fn: str, output_folder: str = None) -> int:
+    """Adapter for tools that need per-frame TIFs. Writes each frame of a packed position as a TIF with its
+    original name into output_folder (default: the position's <type>_images folder), skipping frames that already
+    exist. Returns the number of frames written"""
+    from PIL import Image
+
+    stack, frame_names = load_position_stack(position_path, image_type_fn)
+    if stack is None:
+        return 0
+    output_folder = output_folder or os.path.join(position_path, f'{image_type_fn}_images')
+    os.makedirs(output_folder, exist_ok=True)
+
+    written = 0
+    for frame_ind, frame_name in enumerate(frame_names):
+        frame_path = os.path.join(output_folder, frame_name)
+        if not os.path.exists(frame_path):
+            Image.fromarray(stack[frame_ind]).save(frame_path)
+            written += 1
+    return written
+
+
+def packed_image_types(position_path: str) -> list:
+    """Image types of a position folder whose TIFs were removed after packing them into a stack"""
+    image_types = []
+    for file in os.listdir(position_path):
+        if file.endswith('_stack_index.json'):
+            try:
+                with open(os.path.join(position_path, file), 'r') as index_file:
+                    if json.load(index_file).get('tifs_removed'):
+                        image_types.append(file[:-len('_stack_index.json')])
+            except (OSError, ValueError):
+                continue
+    return image_types
+
+
+def ensure_position_tifs(position_path: str):
+    """Restore the per-frame TIFs of every image stack in a position folder whose TIFs were removed"""
+
+    for image_type in packed_image_types(position_path):
+        unpack_position_stack(position_path, image_type)
+
+
+def remove_restored_tifs(position_path: str):
+    """Delete the TIFs ensure_position_tifs restored, so a packed position only keeps its stack"""
+
+    for image_type in packed_image_types(position_path):
+        _, frame_names = load_position_stack(position_path, image_type)
+        image_folder = os.path.join(position_path, f'{image_type}_images')
+        for frame_name in frame_names:
+            try:
+                os.remove(os.path.join(image_folder, frame_name))
+            except FileNotFoundError:
+                pass
+
+
+# Written into a stage position folder, next to segment_<type> and track_pillars_<type>, after a successful run
+FINGERPRINT_NAME = 'wc_fingerprint.json'
+
+
+def position_fingerprint(position_path: str) -> str:
+    """Given a stage position folder. Returns a hash of the names, sizes and mtimes of the TIFs in its *_images
+    folders (or of the stack and index that replace them, see pack_position_stack) and of the content of its
+    wc_dataset_*.yaml files, so that rewriting an unchanged yaml file does not change it"""
+
+    digest = hashlib.sha256()
+    packed = packed_image_types(position_path)
+    for entry in sorted(os.scandir(position_path), key=lambda e: e.name):
+        if entry.is_dir() and entry.name.endswith('_images') and entry.name[:-len('_images')] in packed:
+            # TIFs restored for a run get new mtimes; the stack they come from identifies the frames
+            for path in stack_paths(position_path, entry.name[:-len('_images')]):
+                stat = os.stat(path)
+                digest.update(f'{os.path.basename(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+        elif entry.is_dir() and entry.name.endswith('_images'):
+            for image in sorted(os.scandir(entry.path), key=lambda e: e.name):
+                if image.name.lower().endswith(('.tif', '.tiff')):
+                    stat = image.stat()
+                    digest.update(f'{entry.name}/{image.name}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+        elif entry.name.startswith('wc_dataset_') and entry.name.endswith('.yaml'):
+            digest.update(entry.name.encode() + b'\n')
+            with open(entry.path, 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+
+def position_outputs_complete(position_path: str) -> bool:
+    """Given a stage position folder. Returns True when every output its wc_dataset_*.yaml asks for exists: the
+    is_broken_vs_frame.txt of segment_<type> and the pillar .txt files of track_pillars_<type>. False when there is
+    no wc_dataset_*.yaml"""
+
+    yaml_files = [file for file in os.listdir(position_path)
+                  if file.startswith('wc_dataset_') and file.endswith('.yaml')]
+    for file in yaml_files:
+        image_type = file[len('wc_dataset_'):-len('.yaml')]
+        try:
+            with open(os.path.join(position_path, file), 'r') as yaml_file:
+                settings = yaml.safe_load(yaml_file) or {}
+        except (OSError, yaml.YAMLError):
+            return False
+        if settings.get(f'segment_{image_type}'):
+            if not os.path.isfile(os.path.join(position_path, f'segment_{image_type}', 'is_broken_vs_frame.txt')):
+                return False
+        if settings.get(f'track_pillars_{image_type}'):
+            path_pillars = os.path.join(position_path, f'track_pillars_{image_type}')
+            if not os.path.isdir(path_pillars) or not any(f.endswith('.txt') for f in os.listdir(path_pillars)):
+                return False
+    return bool(yaml_files)
+
+
+def read_position_fingerprint(position_path: str):
+    """Returns the fingerprint stored by the last successful run of a stage position folder, or None"""
+    try:
+        with open(os.path.join(position_path, FINGERPRINT_NAME), 'r') as file:
+            return json.load(file).get('fingerprint')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def write_position_fingerprint(position_path: str, fingerprint: str):
+    with open(os.path.join(position_path, FINGERPRINT_NAME), 'w') as file:
+        json.dump({'fingerprint': fingerprint, 'finished': time.ctime()}, file)
+
+
+def position_up_to_date(position_path: str) -> bool:
+    """True when the outputs of a stage position folder are complete and its inputs and settings have not changed
+    since they were computed"""
+    stored = read_position_fingerprint(position_path)
+    return stored is not None and stored == position_fingerprint(position_path) and \
+        position_outputs_complete(position_path)
+
+
+class PositionWorkload(NamedTuple):
+    """Size of the WoundCompute job for one stage position folder. stage is '' for a full run, 'segment' for a frame
+    chunk and 'track' for the whole-time-lapse pass after chunked segmentation, which cost far less than a full run
+    of the same frames"""
+    image_type: str
+    frames: int
+    height: int
+    width: int
+    nbytes: int
+    stage: str = ''
+
+    @property
+    def key(self) -> str:
+        key = f'{self.image_type}|{self.frames}|{self.height}x{self.width}'
+        return f'{key}|{self.stage}' if self.stage else key
+
+
+def position_workload(position_path: str, stage: str = '') -> PositionWorkload:
+    """Given a stage position folder. Returns its image type (from the wc_dataset_*.yaml), frame count, frame
+    dimensions (read from the first TIF header or the stack index) and total image bytes, for the given stage"""
+
+    image_type = ''
+    for file in os.listdir(position_path):
+        if file.startswith('wc_dataset_') and file.endswith('.yaml'):
+            image_type = file[len('wc_dataset_'):-len('.yaml')]
+            break
+
+    frames, height, width, nbytes = 0, 0, 0, 0
+    image_folder = os.path.join(position_path, f'{image_type}_images')
+    frame_paths = []
+    if os.path.isdir(image_folder):
+        for entry in os.scandir(image_folder):
+            if entry.name.lower().endswith(('.tif', '.tiff')):
+                frame_paths.append(entry.path)
+                nbytes += entry.stat().st_size
+    frames = len(frame_paths)
+
+    path_stack, path_index = stack_paths(position_path, image_type)
+    if os.path.isfile(path_index):
+        with open(path_index, 'r') as file:
+            index = json.load(file)
+        if not frames:
+            frames, nbytes = len(index['frames']), os.path.getsize(path_stack)
+        height, width = index['shape'][:2]
+    elif frame_paths:
+        try:
+            from PIL import Image
+            with Image.open(frame_paths[0]) as first_frame:
+                width, height = first_frame.size
+        except Exception:
+            pass
+    return PositionWorkload(image_type, frames, height, width, nbytes, stage)
+
+
+class ResourceMonitor:
+    """Measures the CPU time, wall time and peak RSS of this process and its children between start and stop.
+    RSS is sampled by a background thread every interval seconds"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _rss(self) -> int:
+        process = psutil.Process(os.getpid())
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def _sample(self):
+        while True:
+            try:
+                self.peak_rss = max(self.peak_rss, self._rss())
+            except psutil.Error:
+                pass
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._times = os.times()
+        self._wall = time.time()
+        self._thread.start()
+        return self
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        times = os.times()
+        cpu_seconds = sum(times[:4]) - sum(self._times[:4])
+        return {'cpu_seconds': cpu_seconds, 'wall_seconds': time.time() - self._wall, 'peak_rss': self.peak_rss}
+
+
+COST_MODEL_NAME = 'cost_model.json'
+
+
+class CostModel:
+    """Resource usage of completed wc_run calls, keyed by PositionWorkload.key and stored in cache_dir() as
+    cost_model.json so it carries over between sessions and plates. Each entry holds the running mean CPU-seconds
+    and wall time of up to the last history runs and the largest peak RSS seen. estimate falls back to entries of the
+    same image type and frame size, then of the same image type, scaled by the number of pixels processed. Entries
+    of chunks and tracking passes (PositionWorkload.stage) are only used for workloads of the same stage"""
+
+    history = 20
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(cache_dir(), COST_MODEL_NAME)
+        self.entries = self._load()
+        self._updated = set()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, workload: PositionWorkload, stats: dict):
+        entry = self.entries.setdefault(workload.key, {
+            'image_type': workload.image_type, 'frames': workload.frames, 'height': workload.height,
+            'width': workload.width, 'stage': workload.stage, 'runs': 0, 'cpu_seconds': 0.0, 'wall_seconds': 0.0,
+            'peak_rss': 0})
+        entry['runs'] = min(entry['runs'] + 1, self.history)
+        for field in ('cpu_seconds', 'wall_seconds'):
+            entry[field] += (stats[field] - entry[field]) / entry['runs']
+        entry['peak_rss'] = max(entry['peak_rss'], stats['peak_rss'])
+        self._updated.add(workload.key)
+
+    def estimate(self, workload: PositionWorkload):
+        """Returns {'cpu_seconds', 'wall_seconds', 'peak_rss'} expected for workload, or None without history"""
+        entry = self.entries.get(workload.key)
+        if entry is not None:
+            return {field: entry[field] for field in ('cpu_seconds', 'wall_seconds', 'peak_rss')}
+
+        def pixels(item):
+            return max(1, item['frames'] * item['height'] * item['width'])
+
+        same_stage = [e for e in self.entries.values()
+                      if e['image_type'] == workload.image_type and e.get('stage', '') == workload.stage]
+        same_size = [e for e in same_stage if (e['height'], e['width']) == (workload.height, workload.width)]
+        candidates = same_size or same_stage
+        if not candidates or not workload.frames:
+            return None
+        # Time scales with the pixels processed; memory with the size of one time-lapse in memory
+        scale = pixels(workload._asdict()) / (sum(pixels(e) for e in candidates) / len(candidates))
+        mean = {field: sum(e[field] for e in candidates) / len(candidates)
+                for field in ('cpu_seconds', 'wall_seconds', 'peak_rss')}
+        return {'cpu_seconds': mean['cpu_seconds'] * scale, 'wall_seconds': mean['wall_seconds'] * scale,
+                'peak_rss': int(mean['peak_rss'] * scale)}
+
+    def cores_per_task(self, workloads: list):
+        """Mean number of cores one wc_run keeps busy (CPU-seconds over wall time) for workloads, from history"""
+        estimates = [self.estimate(workload) for workload in workloads]
+        estimates = [e for e in estimates if e is not None and e['wall_seconds'] > 0]
+        if not estimates:
+            return None
+        return sum(e['cpu_seconds'] for e in estimates) / sum(e['wall_seconds'] for e in estimates)
+
+    def save(self):
+        """Write the entries updated by this session, keeping entries another session saved in the meantime"""
+        if not self._updated:
+            return
+        entries = self._load()
+        entries.update({key: self.entries[key] for key in self._updated})
+        path_tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(path_tmp, 'w') as file:
+            json.dump(entries, file, indent=1)
+        os.replace(path_tmp, self.path)
+        self.entries = entries
+        self._updated = set()
+
+
+def estimate_position_seconds(workloads: dict, cost_model: CostModel) -> dict:
+    """Given {position path: PositionWorkload}. Returns {position path: expected wall seconds} from the cost model.
+    Positions without history are estimated from their image bytes at the seconds per byte of the positions that
+    have history. Returns None for every position when there is no history at all"""
+
+    seconds = {}
+    for path, workload in workloads.items():
+        estimate = cost_model.estimate(workload)
+        seconds[path] = estimate['wall_seconds'] if estimate is not None else None
+
+    known = [path for path, value in seconds.items() if value is not None]
+    if len(known) == len(seconds):
+        return seconds
+    known_bytes = sum(workloads[path].nbytes for path in known)
+    if not known_bytes:
+        return {path: None for path in seconds}
+    seconds_per_byte = sum(seconds[path] for path in known) / known_bytes
+    return {path: value if value is not None else workloads[path].nbytes * seconds_per_byte
+            for path, value in seconds.items()}
+
+
+def lpt_makespan(costs: list, slots: int) -> float:
+    """Makespan of running costs largest first on slots identical workers, each job going to the first free one"""
+    finish_times = [0.0] * max(1, slots)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + cost)
+    return max(finish_times)
+
+
+# Peak RSS assumed for a position without history, per byte of its raw images (frames decoded to float plus masks)
+RSS_PER_IMAGE_BYTE = 4
+
+
+class MemoryAdmission:
+    """Admission control for WoundCompute workers. A position is only started when the projected peak RSS of every
+    running position plus its own stays within memory_percent of the total RAM, and its projected growth fits in the
+    memory available right now. Projections come from the cost model, else from the largest worker RSS seen this
+    run, else from RSS_PER_IMAGE_BYTE times the position's image bytes. The memory actually held by the pool's
+    workers (psutil RSS) is used instead of the projection whenever it is larger"""
+
+    def __init__(self, memory_percent: float, cost_model: CostModel):
+        self.total = psutil.virtual_memory().total
+        self.budget = self.total * memory_percent / 100
+        self.cost_model = cost_model
+        self.running = {}
+        self.largest_observed = 0
+
+    def projected_rss(self, workload: PositionWorkload) -> int:
+        estimate = self.cost_model.estimate(workload)
+        if estimate is not None and estimate['peak_rss']:
+            return estimate['peak_rss']
+        return max(self.largest_observed, RSS_PER_IMAGE_BYTE * workload.nbytes)
+
+    def workers_rss(self) -> int:
+        rss = 0
+        for child in psutil.Process(os.getpid()).children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return rss
+
+    def admits(self, workload: PositionWorkload) -> bool:
+        """True if workload can start now. A position is always admitted when nothing else is running"""
+        if not self.running:
+            return True
+        projected = self.projected_rss(workload)
+        committed = sum(self.running.values())
+        in_use = self.workers_rss()
+        if max(committed, in_use) + projected > self.budget:
+            return False
+        # Memory the running positions are still expected to claim on top of what they hold
+        pending_growth = max(0, committed - in_use)
+        return projected + pending_growth <= psutil.virtual_memory().available
+
+    def start(self, key, workload: PositionWorkload):
+        self.running[key] = self.projected_rss(workload)
+
+    def finish(self, key, stats: dict = None):
+        self.running.pop(key, None)
+        if stats:
+            self.largest_observed = max(self.largest_observed, stats['peak_rss'])
+
+    def headroom(self) -> str:
+        memory = psutil.virtual_memory()
+        return f'{format_size(memory.available)} free of {format_size(memory.total)}'
+
+
+def wc_run(input_path_fn: str) -> dict:
+    """Run WoundCompute on one stage position folder. Returns its CPU-seconds, wall time and peak RSS"""
     # ** Section 3: Execute woundcompute for all basename folders in the Sorted folder ** #
     time_all = []
     current = time.time()
+    # Imported here so organizing and the GUI start without loading woundcompute and its dependencies
+    from woundcompute import image_analysis as ia
+    # Outputs are about to be overwritten; the fingerprint is only stored again once the run succeeds
+    path_fingerprint = os.path.join(input_path_fn, FINGERPRINT_NAME)
+    if os.path.exists(path_fingerprint):
+        os.remove(path_fingerprint)
+    fingerprint = position_fingerprint(input_path_fn)
+    # WoundCompute reads per-frame TIFs; those of packed positions only exist while it runs
+    ensure_position_tifs(input_path_fn)
+    monitor = ResourceMonitor().start()
     # ~ try:
-    time_all, action_all = ia.run_all(Path(input_path_fn))
+    try:
+        time_all, action_all = ia.run_all(Path(input_path_fn))
+    finally:
+        remove_restored_tifs(input_path_fn)
+    stats = monitor.stop()
+    write_position_fingerprint(input_path_fn, fingerprint)
     secondsPassed = time.time() - current
     print("\tProcessing: ", input_path_fn, "  Tissue: ", os.path.basename(os.path.normpath(input_path_fn)), "     time: ",
                 format_timespan(secondsPassed))
@@ -349,85 +1800,1281 @@ def wc_run(input_path_fn: str):
         # ~ # print("An error occurred:", file=sys.stderr)
         # ~ # traceback.print_exc(file=sys.stderr)
         # ~ print("------------------------------------------------------")
+    return stats
+
+
+# Frame chunks of a position are analyzed in <position>/wc_chunks, see split_position_frames
+CHUNKS_FOLDER = 'wc_chunks'
+# Frames per chunk when a long time-lapse is split across cores
+FRAME_CHUNK_SIZE = 100
+# Per-frame outputs of the segmentation steps that run in chunks, e.g. segment_ph1/visualizations/ph1_0012.png or a
+# mask_00012.npy; only series of such files in a segment_<type> folder are renumbered when chunks are merged
+FRAME_OUTPUT = re.compile(r'^(.*_)(\d{3,})(\.(?:png|jpe?g|tiff?|npy))$', re.IGNORECASE)
+
+
+def read_position_settings(position_path: str) -> (str, str, dict):
+    """Given a stage position folder. Returns its image type, the name of its wc_dataset_*.yaml and its settings"""
+    for file in sorted(os.listdir(position_path)):
+        if file.startswith('wc_dataset_') and file.endswith('.yaml'):
+            with open(os.path.join(position_path, file), 'r') as yaml_file:
+                return file[len('wc_dataset_'):-len('.yaml')], file, yaml.safe_load(yaml_file) or {}
+    return '', None, {}
+
+
+def is_sequence_step(key: str) -> bool:
+    """True for the yaml steps that need the whole time-lapse (tracking), False for per-frame segmentation"""
+    return key.startswith('track') or '_track_' in key
+
+
+def split_position_frames(position_path: str, chunk_size: int) -> list:
+    """Given a stage position folder. Splits its frames into consecutive chunks of chunk_size frames, each in a
+    folder <position>/wc_chunks/cNNN with hardlinks (or copies) of its TIFs and a yaml that only asks for the
+    per-frame segmentation steps, with low_quality_frame_inds shifted to the chunk. Returns (chunk folder, first
+    frame) pairs, or [] when the position has fewer than two chunks of frames"""
+
+    ensure_position_tifs(position_path)
+    image_type, yaml_name, settings = read_position_settings(position_path)
+    image_folder = os.path.join(position_path, f'{image_type}_images')
+    if yaml_name is None or not os.path.isdir(image_folder):
+        return []
+    frame_names = sorted(f for f in os.listdir(image_folder) if f.lower().endswith(('.tif', '.tiff')))
+    if len(frame_names) < 2 * chunk_size:
+        return []
+
+    path_chunks = os.path.join(position_path, CHUNKS_FOLDER)
+    shutil.rmtree(path_chunks, ignore_errors=True)
+    chunks = []
+    for start in range(0, len(frame_names), chunk_size):
+        chunk_path = os.path.join(path_chunks, f'c{len(chunks):03d}')
+        os.makedirs(os.path.join(chunk_path, f'{image_type}_images'))
+        for frame_name in frame_names[start:start + chunk_size]:
+            place_file(os.path.join(image_folder, frame_name),
+                       os.path.join(chunk_path, f'{image_type}_images', frame_name), 'hardlink')
+        chunk_settings = {key: False if is_sequence_step(key) and isinstance(value, bool) else value
+                          for key, value in settings.items()}
+        chunk_settings['low_quality_frame_inds'] = [ind - start for ind in settings.get('low_quality_frame_inds') or []
+                                                    if start <= ind < start + chunk_size]
+        with open(os.path.join(chunk_path, yaml_name), 'w') as yaml_file:
+            yaml.safe_dump(chunk_settings, yaml_file, sort_keys=False)
+        chunks.append((chunk_path, start))
+    return chunks
+
+
+def merge_position_chunks(position_path: str, chunks: list):
+    """Given a stage position folder and its (chunk folder, first frame) pairs. Merges the chunk outputs back into the
+    position in frame order: *_vs_frame.txt files are concatenated and per-frame images and arrays of the
+    segment_<type> folders (series of FRAME_OUTPUT files sharing a name and extension) are renumbered by the chunk's
+    first frame. Any other output must be identical in every chunk and is taken from the first one; an output that
+    differs between chunks, e.g. a *_contour_all_* image summarizing the chunk's frames, cannot be merged and raises
+    ValueError before the position is changed. Outputs of an earlier run are replaced and the chunk folders removed"""
+
+    inputs = {FINGERPRINT_NAME}
+    image_type, yaml_name, _ = read_position_settings(position_path)
+    inputs.update({yaml_name, f'{image_type}_images'})
+
+    def chunk_outputs(chunk_path):
+        """(relative path, kind, FRAME_OUTPUT match) of every output of a chunk; kind is 'vs_frame', 'frame' or
+        'other'"""
+        outputs = []
+        single_frame = len(os.listdir(os.path.join(chunk_path, f'{image_type}_images'))) == 1
+        for root, dirs, files in os.walk(chunk_path):
+            rel_root = os.path.relpath(root, chunk_path)
+            if rel_root == '.':
+                dirs[:] = [d for d in dirs if d not in inputs]
+                files = [f for f in files if f not in inputs]
+            # A single numbered file is a per-position output that happens to end in a number, not a frame series
+            frame_outputs = {}
+            if rel_root.split(os.sep)[0].startswith('segment_'):
+                series = {}
+                for file in files:
+                    match = FRAME_OUTPUT.match(file)
+                    if match:
+                        series.setdefault((match.group(1), match.group(3)), []).append((file, match))
+                frame_outputs = {file: match for members in series.values() if len(members) > 1 or single_frame
+                                 for file, match in members}
+            for file in files:
+                rel_path = os.path.normpath(os.path.join(rel_root, file))
+                if file.endswith('_vs_frame.txt'):
+                    outputs.append((rel_path, 'vs_frame', None))
+                elif file in frame_outputs:
+                    outputs.append((rel_path, 'frame', frame_outputs[file]))
+                else:
+                    outputs.append((rel_path, 'other', None))
+        return outputs
+
+    outputs = [(chunk_path, start, chunk_outputs(chunk_path)) for chunk_path, start in chunks]
+    first_path = chunks[0][0]
+    first_other = {rel_path for rel_path, kind, _ in outputs[0][2] if kind == 'other'}
+    differing = set()
+    for chunk_path, _, chunk_files in outputs[1:]:
+        other = {rel_path for rel_path, kind, _ in chunk_files if kind == 'other'}
+        differing |= other ^ first_other
+        differing |= {rel_path for rel_path in other & first_other
+                      if not filecmp.cmp(os.path.join(first_path, rel_path), os.path.join(chunk_path, rel_path),
+                                         shallow=False)}
+    if differing:
+        raise ValueError(f"outputs that are not per frame differ between chunks: {', '.join(sorted(differing)[:5])}")
+
+    for entry in os.listdir(first_path):
+        if entry not in inputs:
+            path_old = os.path.join(position_path, entry)
+            if os.path.isdir(path_old):
+                shutil.rmtree(path_old)
+            elif os.path.exists(path_old):
+                os.remove(path_old)
+
+    vs_frame = {}
+    for chunk_path, start, chunk_files in outputs:
+        for rel_path, kind, match in chunk_files:
+            src = os.path.join(chunk_path, rel_path)
+            dest = os.path.join(position_path, rel_path)
+            if kind == 'vs_frame':
+                with open(src, 'r') as txt:
+                    vs_frame.setdefault(dest, []).extend(txt.read().splitlines())
+                continue
+            if kind == 'frame':
+                prefix, number, ext = match.groups()
+                dest = os.path.join(os.path.dirname(dest), f'{prefix}{int(number) + start:0{len(number)}d}{ext}')
+            elif chunk_path != first_path:
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(src, dest)
+
+    for dest, lines in vs_frame.items():
+        with open(dest, 'w') as txt:
+            txt.write('\n'.join(lines) + '\n')
+    shutil.rmtree(os.path.join(position_path, CHUNKS_FOLDER), ignore_errors=True)
+
+
+def discard_position_chunks(position_path: str):
+    """Remove the chunk folders of a position whose chunked run failed, and TIFs restored for it from a stack"""
+    shutil.rmtree(os.path.join(position_path, CHUNKS_FOLDER), ignore_errors=True)
+    remove_restored_tifs(position_path)
+
+
+def needs_sequence_pass(position_path: str) -> bool:
+    """True when the yaml of a stage position asks for steps that need the whole time-lapse"""
+    _, _, settings = read_position_settings(position_path)
+    return any(value is True and is_sequence_step(key) for key, value in settings.items())
+
+
+def wc_run_sequence_steps(position_path: str) -> dict:
+    """Run the whole-time-lapse steps (tracking) of a stage position whose segmentation was merged from frame
+    chunks. run_all is called on <position>/wc_chunks/sequence, which holds links to all frames and merged outputs
+    and a yaml with the segmentation steps turned off; the files it adds or rewrites are moved into the position"""
+
+    ensure_position_tifs(position_path)
+    image_type, yaml_name, settings = read_position_settings(position_path)
+    path_sequence = os.path.join(position_path, CHUNKS_FOLDER, 'sequence')
+    shutil.rmtree(path_sequence, ignore_errors=True)
+    os.makedirs(path_sequence)
+    for entry in os.scandir(position_path):
+        if entry.name in (CHUNKS_FOLDER, yaml_name, FINGERPRINT_NAME):
+            continue
+        dest = os.path.join(path_sequence, entry.name)
+        if entry.is_dir():
+            shutil.copytree(entry.path, dest, copy_function=lambda src, dst: place_file(src, dst, 'hardlink'))
+        else:
+            place_file(entry.path, dest, 'hardlink')
+    sequence_settings = {key: False if key.startswith('segment_') and isinstance(value, bool) else value
+                         for key, value in settings.items()}
+    with open(os.path.join(path_sequence, yaml_name), 'w') as yaml_file:
+        yaml.safe_dump(sequence_settings, yaml_file, sort_keys=False)
 
+    def snapshot():
+        return {os.path.relpath(os.path.join(root, file), path_sequence): os.stat(os.path.join(root, file)).st_mtime_ns
+                for root, _, files in os.walk(path_sequence) for file in files}
 
-def wc_process_folder(main_folder:str, cpu_threshold:int):
-    if not os.path.exists(main_folder):
-        print(f"Folder {main_folder} does not exist. Skipping...")
+    existing = snapshot()
+    try:
+        stats = wc_run(path_sequence)
+        for rel_path, mtime in snapshot().items():
+            if existing.get(rel_path) == mtime or rel_path in (FINGERPRINT_NAME, yaml_name):
+                continue
+            dest = os.path.join(position_path, rel_path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(os.path.join(path_sequence, rel_path), dest)
+    finally:
+        shutil.rmtree(os.path.join(position_path, CHUNKS_FOLDER), ignore_errors=True)
+        remove_restored_tifs(position_path)
+    return stats
+
+
+class ConcurrencyController:
+    """Feedback control of the number of wc_run tasks in flight. Every interval seconds the CPU used by the pool's
+    worker processes (as a share of total capacity, so background programs do not count) is compared with the
+    cpu_threshold target. Without history the limit starts at 1 and doubles while the workers are under target (slow
+    start); after that it grows by one task while there is room for another worker and is halved when the workers
+    overshoot the target or memory runs out. While other programs saturate the CPU beyond the target the limit is
+    held rather than lowered, so a 100% target can be reached. Lowering the limit never stops running tasks, it only
+    holds back new ones"""
+
+    interval = 3.0
+    # Overshoot tolerated before backing off, in % of total CPU capacity
+    margin = 5.0
+
+    def __init__(self, cpu_threshold: float, cores_per_task: float = None):
+        self.target = cpu_threshold
+        self.cpu_count = psutil.cpu_count() or 1
+        if cores_per_task:
+            self.limit = max(1, min(self.cpu_count, int(self.cpu_count * cpu_threshold / 100 / cores_per_task)))
+            self.slow_start = False
+        else:
+            self.limit = 1
+            self.slow_start = True
+        self._processes = {}
+        self._last_update = time.time()
+        psutil.cpu_percent(interval=None)  # prime; first call always returns 0.0
+
+    def worker_share(self):
+        """CPU used by the worker processes since the previous call, in % of total capacity, or None when no worker
+        was running at the previous call"""
+        processes = {}
+        total = 0.0
+        measured = False
+        for child in psutil.Process(os.getpid()).children(recursive=True):
+            process = self._processes.get(child.pid, child)
+            try:
+                # A process seen for the first time only primes its counter
+                share = process.cpu_percent(interval=None)
+            except psutil.NoSuchProcess:
+                continue
+            if child.pid in self._processes:
+                total += share
+                measured = True
+            processes[child.pid] = process
+        self._processes = processes
+        return total / self.cpu_count if measured else None
+
+    def update(self, in_flight: int, queued: int) -> int:
+        """Adjust and return the limit, at most once per interval"""
+        if time.time() - self._last_update < self.interval:
+            return self.limit
+        self._last_update = time.time()
+
+        share = self.worker_share()
+        system = psutil.cpu_percent(interval=None)
+        memory = psutil.virtual_memory().percent
+        if share is None:
+            return self.limit
+        per_task = share / in_flight if in_flight else 0.0
+        limit = self.limit
+
+        if share > self.target + self.margin or memory > 95:
+            limit = max(1, limit // 2)
+            self.slow_start = False
+        elif system > max(98, self.target + self.margin):
+            # Saturated by other programs; adding workers would not get them more CPU
+            pass
+        elif queued and in_flight >= limit and share < self.target:
+            if self.slow_start:
+                limit *= 2
+                if per_task > 0:
+                    # Do not double past what the measured per-task share says fits
+                    limit = min(limit, max(limit // 2 + 1, int(self.target / per_task)))
+                if share >= 0.9 * self.target:
+                    self.slow_start = False
+            elif per_task > 0 and share + per_task <= self.target:
+                limit += 1
+        limit = min(limit, self.cpu_count)
+
+        if limit != self.limit:
+            print(f'\tConcurrency {self.limit} -> {limit} (workers {share:.0f}% of CPU, target {self.target:g}%, '
+                  f'system {system:.0f}%, memory {memory:.0f}%)')
+            self.limit = limit
+        return self.limit
+
+
+class TaskTimeout(Exception):
+    """A WorkerPool task ran past its timeout; its worker was killed"""
+
+
+class WorkerCrashed(Exception):
+    """A WorkerPool worker exited while running a task, e.g. killed by the OOM killer"""
+
+
+def _pool_worker(conn):
+    """Main loop of a WorkerPool worker process: run (task_id, fn, args) tasks until told to stop"""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        task_id, fn, args = task
+        try:
+            conn.send((task_id, True, fn(*args)))
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                conn.send((task_id, False, e))
+            except Exception:
+                # The exception itself could not be pickled
+                conn.send((task_id, False, RuntimeError(f'{type(e).__name__}: {e}')))
+
+
+class _PoolWorker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_pool_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.future = None
+        self.task_id = None
+        self.timeout = None
+        self.deadline = None
+        self.tasks_done = 0
+
+    def rss(self) -> int:
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss
+        except psutil.Error:
+            return 0
+
+    def stop(self, kill: bool = False):
+        if not kill:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Process pool for long WoundCompute tasks. Unlike ProcessPoolExecutor, a task can be given a timeout after
+    which its worker is killed (TaskTimeout), a worker that dies only fails its own task (WorkerCrashed), and workers
+    are replaced after max_tasks_per_worker tasks or when their RSS exceeds rss_ceiling bytes, so memory fragmented
+    by earlier positions is returned to the system. submit returns a concurrent.futures.Future; its on_start callback
+    is called with the worker's pid, in the parent process, when the task is handed to a worker"""
+
+    def __init__(self, max_workers: int, max_tasks_per_worker: int = None, rss_ceiling: int = None):
+        self.max_workers = max_workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.rss_ceiling = rss_ceiling
+        self.recycled = 0
+        # Workers are started from the manager thread; forking a multithreaded process can deadlock
+        self._context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        self._workers = []
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._task_ids = iter(range(1, sys.maxsize))
+        self._wakeup_reader, self._wakeup_writer = self._context.Pipe(duplex=False)
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._manage, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, timeout: float = None, on_start=None) -> Future:
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit to a WorkerPool after shutdown')
+            self._pending.append((future, fn, args, timeout, on_start))
+        self._wakeup_writer.send(None)
+        return future
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            while self._pending:
+                worker = next((w for w in self._workers if w.future is None), None)
+                if worker is None:
+                    if len(self._workers) >= self.max_workers:
+                        break
+                    worker = _PoolWorker(self._context)
+                    self._workers.append(worker)
+                future, fn, args, timeout, on_start = self._pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                worker.task_id = next(self._task_ids)
+                worker.future = future
+                worker.timeout = timeout
+                worker.deadline = time.time() + timeout if timeout else None
+                worker.conn.send((worker.task_id, fn, args))
+                if on_start is not None:
+                    started.append((on_start, worker.process.pid))
+        # Outside the lock, so a slow callback does not hold up submit
+        for on_start, pid in started:
+            on_start(pid)
+
+    def _retire(self, worker, kill: bool = False):
+        self._workers.remove(worker)
+        worker.stop(kill)
+
+    def _manage(self):
+        while True:
+            self._dispatch()
+            busy = [w for w in self._workers if w.future is not None]
+            if self._shutdown and not busy and not self._pending:
+                break
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            wait_time = min([max(0.0, d - time.time()) for d in deadlines] + [1.0])
+            ready = multiprocessing.connection.wait([w.conn for w in busy] + [self._wakeup_reader], wait_time)
+
+            for conn in ready:
+                if conn is self._wakeup_reader:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv()
+                    continue
+                worker = next(w for w in busy if w.conn is conn)
+                future = worker.future
+                try:
+                    task_id, ok, value = conn.recv()
+                except (EOFError, OSError):
+                    worker.future = None
+                    with self._lock:
+                        self._retire(worker, kill=True)
+                    future.set_exception(WorkerCrashed(f'worker exited with code {worker.process.exitcode}'))
+                    continue
+                worker.future = None
+                worker.tasks_done += 1
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+                if (self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker) or \
+                        (self.rss_ceiling and worker.rss() > self.rss_ceiling):
+                    with self._lock:
+                        self._retire(worker)
+                    self.recycled += 1
+
+            for worker in busy:
+                if worker.future is not None and worker.deadline is not None and time.time() > worker.deadline:
+                    future = worker.future
+                    worker.future = None
+                    with self._lock:
+                        self._retire(worker, kill=True)
+                    future.set_exception(TaskTimeout(f'no result after {format_timespan(worker.timeout)}'))
+
+        for worker in list(self._workers):
+            self._retire(worker)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while self._pending:
+                    self._pending.popleft()[0].cancel()
+        self._wakeup_writer.send(None)
+        if wait:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True, cancel_futures=exc_type is not None)
+
+
+# Run ledger, in the organized output folder
+LEDGER_NAME = 'run_ledger.sqlite'
+
+
+class RunLedger:
+    """Durable record (SQLite, in the organized output folder) of the state of every stage position of the
+    WoundCompute runs on that folder: queued, running, done or failed, with start and end times, attempts and exit
+    status. Only the parent process writes to it, and every update is its own short transaction, so a reboot loses
+    at most the update in progress. The output folder is often on a network share, where SQLite's WAL mode is not
+    safe, so the ledger uses the default rollback journal"""
+
+    def __init__(self, path_output_fn):
+        self.path = path_output_fn if path_output_fn.endswith('.sqlite') else \
+            os.path.join(path_output_fn, LEDGER_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            # Also turns a ledger written in WAL mode by an earlier version back to a rollback journal
+            self._conn.execute('PRAGMA journal_mode=DELETE')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS positions '
+                               '(position TEXT PRIMARY KEY, basename_folder TEXT NOT NULL, state TEXT NOT NULL, '
+                               'attempts INTEGER NOT NULL DEFAULT 0, queued REAL, started REAL, finished REAL, '
+                               'worker_pid INTEGER, status TEXT)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS positions_state ON positions(state)')
+
+    def queue(self, positions: list):
+        """Given (basename folder, position folder) pairs. Marks them queued for a new run"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO positions (position, basename_folder, state, attempts, queued) "
+                "VALUES (?, ?, 'queued', 0, ?)",
+                [(os.path.abspath(position_path), os.path.abspath(main_folder), now)
+                 for main_folder, position_path in positions])
+
+    def start(self, position_path, pid: int = None):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE positions SET state = 'running', attempts = attempts + 1, started = ?, "
+                               "finished = NULL, worker_pid = ?, status = NULL WHERE position = ?",
+                               (time.time(), pid or os.getpid(), os.path.abspath(position_path)))
+
+    def finish(self, position_path, state: str, status: str = None):
+        """Record the outcome of a position: 'done', 'failed', or 'queued' again when it is retried"""
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE positions SET state = ?, finished = ?, status = ? WHERE position = ?',
+                               (state, time.time(), status, os.path.abspath(position_path)))
+
+    def unfinished(self) -> list:
+        """Returns the (basename folder, position folder) pairs that are not done. Positions left running were
+        interrupted, e.g. by a reboot, and count as unfinished"""
+        with self._lock:
+            rows = self._conn.execute("SELECT basename_folder, position FROM positions WHERE state != 'done' "
+                                      "ORDER BY basename_folder, position")
+            return [tuple(row) for row in rows.fetchall()]
+
+    def summary(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute('SELECT state, COUNT(*) FROM positions GROUP BY state')
+            return dict(rows.fetchall())
+
+    def close(self):
+        self._conn.close()
+
+
+# Positions that failed or timed out in the last run, one per line, re-run with wc_process_failed
+FAILURE_LIST_NAME = 'failed_positions.tsv'
+# Timeout of a position, as a multiple of its expected wall time, and never shorter than TASK_TIMEOUT_MIN seconds
+TASK_TIMEOUT_FACTOR = 4
+TASK_TIMEOUT_MIN = 600
+# Timeout per frame while nothing is known about how long a position takes
+TASK_TIMEOUT_PER_FRAME = 30
+# Failures retried, as long as they look transient (worker crash, out of memory, I/O errors of flaky drives). A
+# position that timed out already used its whole timeout and is more likely to hang again, so it is not retried
+MAX_TASK_RETRIES = 2
+TRANSIENT_ERRORS = (WorkerCrashed, MemoryError)
+TRANSIENT_ERRNOS = {getattr(errno, name) for name in ('EIO', 'ETIMEDOUT', 'ESTALE') if hasattr(errno, name)}
+# Workers are replaced after this many positions, or once their RSS exceeds this share of the memory budget
+MAX_TASKS_PER_WORKER = 20
+WORKER_RSS_CEILING_FRACTION = 0.25
+
+
+def task_timeout(workload: PositionWorkload, expected_seconds: float = None) -> float:
+    """Timeout of a position: TASK_TIMEOUT_FACTOR times its expected wall time, or TASK_TIMEOUT_PER_FRAME seconds per
+    frame when nothing is known about it, and never shorter than TASK_TIMEOUT_MIN"""
+    if expected_seconds:
+        return max(TASK_TIMEOUT_MIN, TASK_TIMEOUT_FACTOR * expected_seconds)
+    return max(TASK_TIMEOUT_MIN, TASK_TIMEOUT_PER_FRAME * workload.frames)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """True for failures worth retrying; missing files, permissions and bad inputs fail the same way every time"""
+    return isinstance(error, TRANSIENT_ERRORS) or (isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS)
+
+
+def read_failure_list(path_output_fn) -> list:
+    """Returns the (basename folder, position folder, reason, attempts) rows of failed_positions.tsv"""
+    path_failures = os.path.join(path_output_fn, FAILURE_LIST_NAME)
+    if not os.path.isfile(path_failures):
+        return []
+    with open(path_failures, 'r', encoding='utf-8') as file:
+        next(file, None)
+        return [tuple(line.rstrip('\n').split('\t')) for line in file if line.count('\t') == 3]
+
+
+def write_failure_list(path_output_fn, positions_run: list, failures: list):
+    """Replace the rows of the positions in positions_run by this run's failures, keeping other rows. Removes the
+    file when no failures are left"""
+    paths_run = {position_path for _, position_path in positions_run}
+    rows = [row for row in read_failure_list(path_output_fn) if row[1] not in paths_run] + failures
+    path_failures = os.path.join(path_output_fn, FAILURE_LIST_NAME)
+    if not rows:
+        if os.path.exists(path_failures):
+            os.remove(path_failures)
+        return
+    with open(path_failures, 'w', encoding='utf-8') as file:
+        file.write('basename_folder\tposition_folder\treason\tattempts\n')
+        for row in rows:
+            file.write('\t'.join(str(field).replace('\t', ' ').replace('\n', ' ') for field in row) + '\n')
+    print(f'\t{len(rows)} failed positions listed in {path_failures}')
+
+
+def wc_process_folder(main_folder:str, cpu_threshold:int, memory_percent: float = 80, force: bool = False,
+                      frame_chunk_size: int = None):
+    """Run WoundCompute on every stage position folder of one basename folder, see wc_process_folders"""
+    wc_process_folders([main_folder], cpu_threshold, memory_percent, force, frame_chunk_size)
+
+
+def wc_process_folders(main_folders: list, cpu_threshold: int, memory_percent: float = 80, force: bool = False,
+                       frame_chunk_size: int = None):
+    """Run WoundCompute on the stage position folders of several basename folders from a single work queue on one
+    shared process pool, so positions of the next basename start as soon as cores free up instead of after the
+    previous basename has drained. See wc_process_positions"""
+
+    positions = []
+    for main_folder in main_folders:
+        if not os.path.exists(main_folder):
+            print(f"Folder {main_folder} does not exist. Skipping...")
+            continue
+        positions += [(main_folder, f.path) for f in os.scandir(main_folder) if f.is_dir()]
+    wc_process_positions(positions, cpu_threshold, memory_percent, force, frame_chunk_size)
+
+
+def wc_process_failed(path_output_fn, cpu_threshold: int, memory_percent: float = 80, frame_chunk_size: int = None):
+    """Run WoundCompute again on the positions listed in failed_positions.tsv of an output folder"""
+    positions = [(main_folder, position_path) for main_folder, position_path, _, _ in
+                 read_failure_list(path_output_fn) if os.path.isdir(position_path)]
+    if not positions:
+        print(f'\tNo failed positions listed in {os.path.join(path_output_fn, FAILURE_LIST_NAME)}')
         return
-    subfolders = [f for f in os.scandir(main_folder) if f.is_dir()]
+    print(f'\tRe-running {len(positions)} failed positions')
+    wc_process_positions(positions, cpu_threshold, memory_percent, frame_chunk_size=frame_chunk_size)
 
-    cpu_count = psutil.cpu_count() or 1
-    max_processes = 1
 
-    with ProcessPoolExecutor() as executor:
-        futures = set()
-        subfolder_queue = subfolders.copy()
-
-        # Start processing the first subfolder
-        if subfolder_queue:
-            initial_subfolder = subfolder_queue.pop(0)
-            initial_future = executor.submit(wc_run, initial_subfolder.path)
-            futures.add(initial_future)
-            print(f'\tStarted process for {initial_subfolder.name}...')
-
-            # Let the worker spawn and start consuming CPU
-            time.sleep(2)
-
-            # Measure the WC worker(s) specifically — not system-wide CPU —
-            # so background processes (Chrome, IDE, etc.) don't inflate the
-            # estimate of a single worker's cost.
-            parent = psutil.Process(os.getpid())
-            workers = parent.children(recursive=True)
-            for w in workers:
-                try:
-                    w.cpu_percent(interval=None)  # prime; first call always returns 0.0
-                except psutil.NoSuchProcess:
-                    pass
-            time.sleep(5)
-            worker_cpu_total = 0.0
-            for w in workers:
+def wc_resume_run(path_output_fn, cpu_threshold: int, memory_percent: float = 80, frame_chunk_size: int = None):
+    """Continue an interrupted WoundCompute run: runs only the positions that the RunLedger of an output folder does
+    not record as done"""
+    if not os.path.isfile(os.path.join(path_output_fn, LEDGER_NAME)):
+        print(f'\tNo run ledger in {path_output_fn}; nothing to resume')
+        return
+    ledger = RunLedger(path_output_fn)
+    print(f'\tRun ledger: {", ".join(f"{count} {state}" for state, count in sorted(ledger.summary().items()))}')
+    positions = [(main_folder, position_path) for main_folder, position_path in ledger.unfinished()
+                 if os.path.isdir(position_path)]
+    ledger.close()
+    if not positions:
+        print('\tEvery position of the last run is done')
+        return
+    print(f'\tResuming {len(positions)} unfinished positions')
+    wc_process_positions(positions, cpu_threshold, memory_percent, frame_chunk_size=frame_chunk_size)
+
+
+def wc_process_positions(positions: list, cpu_threshold: int, memory_percent: float = 80, force: bool = False,
+                         frame_chunk_size: int = None):
+    """Given (basename folder, position folder) pairs. Runs WoundCompute on every position from a single queue on one
+    WorkerPool. Completion of each basename is reported as soon as its last position finishes. Positions are started
+    largest first, only while their projected memory fits within memory_percent of the RAM (see MemoryAdmission),
+    with the number in flight set by a ConcurrencyController. Each position gets a timeout of TASK_TIMEOUT_FACTOR
+    times its expected wall time (TASK_TIMEOUT_PER_FRAME seconds per frame while nothing is known about it),
+    transient failures (is_transient_error) are retried up to MAX_TASK_RETRIES times, and positions that
+    still fail are written to failed_positions.tsv in the output folder. Unless force is set, positions whose
+    outputs are complete and whose images and settings are unchanged since their last run are skipped. The state
+    of every position is kept in the RunLedger of the output folder, from which wc_resume_run continues.
+
+    With frame_chunk_size, positions with at least two chunks of frames are split (split_position_frames) and their
+    chunks are segmented as separate tasks on the same pool. Once every chunk is done the outputs are merged in frame
+    order and, when the yaml asks for tracking, a last task runs the whole-time-lapse steps. If that task fails, or the
+    chunks wrote outputs that cannot be merged (see merge_position_chunks), the position is analyzed again in one
+    piece"""
+
+    if not positions:
+        return
+    path_output_fn = os.path.dirname(os.path.normpath(positions[0][0]))
+    ledger = RunLedger(path_output_fn)
+    ledger.queue(positions)
+    if not force:
+        positions_all = positions
+        positions = []
+        for position in positions_all:
+            if position_up_to_date(position[1]):
+                ledger.finish(position[1], 'done', 'up to date')
+            else:
+                positions.append(position)
+        if len(positions) < len(positions_all):
+            print(f'\tSkipping {len(positions_all) - len(positions)} of {len(positions_all)} positions whose outputs '
+                  f'are up to date (force re-analysis to run them again)')
+        if not positions:
+            ledger.close()
+            write_failure_list(path_output_fn, positions_all, [])
+            print('\tAll subfolders processed.')
+            return
+    remaining = {}
+    for main_folder, _ in positions:
+        remaining[main_folder] = remaining.get(main_folder, 0) + 1
+    positions_run = positions
+
+    # Split long time-lapses into frame chunks; tasks are then (basename folder, position or chunk folder) pairs
+    chunked = {}
+    parent_of = {}
+    sequence_pass = set()
+    fallback = set()
+    if frame_chunk_size:
+        tasks = []
+        for position in positions:
+            chunks = split_position_frames(position[1], frame_chunk_size)
+            if not chunks:
+                tasks.append(position)
+                continue
+            path_fingerprint = os.path.join(position[1], FINGERPRINT_NAME)
+            if os.path.exists(path_fingerprint):
+                os.remove(path_fingerprint)
+            chunked[position[1]] = {'chunks': chunks, 'left': len(chunks), 'failed': False, 'started': False,
+                                    'fingerprint': position_fingerprint(position[1])}
+            for chunk_path, _ in chunks:
+                parent_of[chunk_path] = position
+                tasks.append((position[0], chunk_path))
+        if chunked:
+            print(f'\tSplit {len(chunked)} long positions into {len(parent_of)} chunks of up to {frame_chunk_size} '
+                  f'frames')
+        positions = tasks
+
+    def name(position):
+        if position[1] in parent_of:
+            return f'{name(parent_of[position[1]])} ({os.path.basename(position[1])})'
+        return f'{os.path.basename(os.path.normpath(position[0]))}/{os.path.basename(position[1])}'
+
+    cpu_count = psutil.cpu_count() or 1
+    time_start = time.time()
+
+    # Size concurrency from the recorded cost of earlier runs of the same kind of positions when there is any
+    cost_model = CostModel()
+    workloads = {position_path: position_workload(position_path, 'segment' if position_path in parent_of else '')
+                 for _, position_path in positions}
+    cores_per_task = cost_model.cores_per_task(list(workloads.values()))
+    futures_positions = {}
+    attempts = {}
+    failures = []
+    longest_seconds = [0.0]
+
+    # Longest job first: the largest positions start first so that none of them runs alone at the end. Expected
+    # seconds come from the cost model; without history, positions are ordered by image bytes and frame count
+    expected_seconds = estimate_position_seconds(workloads, cost_model)
+    positions = sorted(positions, key=lambda position: (expected_seconds[position[1]] or 0,
+                                                        workloads[position[1]].nbytes,
+                                                        workloads[position[1]].frames), reverse=True)
+
+    admission = MemoryAdmission(memory_percent, cost_model)
+    print(f'\tMemory budget: {format_size(admission.budget)} ({memory_percent:g}% of RAM, {admission.headroom()})')
+
+    def timeout_for(task_path):
+        # Without history, positions are allowed several times the longest one finished so far in this run
+        return task_timeout(workloads[task_path], expected_seconds.get(task_path) or longest_seconds[0])
+
+    def submit(task):
+        task_path = task[1]
+        attempts[task_path] = attempts.get(task_path, 0) + 1
+        # The ledger marks a position running once a worker picks up its task (or its first chunk)
+        if task_path in parent_of:
+            on_start = None
+            if not chunked[parent_of[task_path][1]]['started']:
+                chunked[parent_of[task_path][1]]['started'] = True
+                on_start = partial(ledger.start, parent_of[task_path][1])
+            future = pool.submit(wc_run, task_path, timeout=timeout_for(task_path), on_start=on_start)
+        elif task_path in sequence_pass:
+            future = pool.submit(wc_run_sequence_steps, task_path, timeout=timeout_for(task_path),
+                                 on_start=partial(ledger.start, task_path))
+        else:
+            future = pool.submit(wc_run, task_path, timeout=timeout_for(task_path),
+                                 on_start=partial(ledger.start, task_path))
+        futures_positions[future] = task
+        admission.start(task_path, workloads[task_path])
+        return future
+
+    def finish(future):
+        task = futures_positions.pop(future)
+        task_path = task[1]
+        position = parent_of.get(task_path, task)
+        main_folder, position_path = position
+        stats = None
+        try:
+            stats = future.result()  # Check for exceptions
+            if stats:
+                cost_model.record(workloads[task_path], stats)
+                longest_seconds[0] = max(longest_seconds[0], stats['wall_seconds'])
+        except Exception as e:
+            reason = f'{type(e).__name__}: {e}'
+            admission.finish(task_path)
+            if is_transient_error(e) and attempts[task_path] <= MAX_TASK_RETRIES:
+                print(f'\tError processing {name(task)} ({reason}), retrying')
+                ledger.finish(position_path, 'queued', reason)
+                position_queue.append(task)
+                return
+            if task_path in sequence_pass and position_path not in fallback:
+                print(f'\tTracking {name(position)} after chunked segmentation failed ({reason}); analyzing it in '
+                      f'one piece')
+                sequence_pass.discard(position_path)
+                fallback.add(position_path)
+                position_queue.append(position)
+                workloads[position_path] = position_workload(position_path)
+                return
+            if task_path in parent_of:
+                chunk_info = chunked[position_path]
+                chunk_info['left'] -= 1
+                # The other chunks of a failed position are not started
+                queued = [t for t in position_queue if parent_of.get(t[1]) == position]
+                for t in queued:
+                    position_queue.remove(t)
+                chunk_info['left'] -= len(queued)
+                if not chunk_info['left']:
+                    discard_position_chunks(position_path)
+            if position_path in chunked:
+                if chunked[position_path]['failed']:
+                    return
+                chunked[position_path]['failed'] = True
+            print(f'\tError processing {name(task)}: {reason}')
+            ledger.finish(position_path, 'failed', reason)
+            failures.append((main_folder, position_path, reason, attempts[task_path]))
+        else:
+            admission.finish(task_path, stats)
+            if task_path in parent_of:
+                chunk_info = chunked[position_path]
+                chunk_info['left'] -= 1
+                if chunk_info['failed'] and not chunk_info['left']:
+                    discard_position_chunks(position_path)
+                if chunk_info['failed'] or chunk_info['left']:
+                    return
                 try:
-                    worker_cpu_total += w.cpu_percent(interval=None)
-                except psutil.NoSuchProcess:
-                    pass
+                    merge_position_chunks(position_path, chunk_info['chunks'])
+                except ValueError as e:
+                    print(f'\tCannot merge the chunks of {name(position)} ({e}); analyzing it in one piece')
+                    discard_position_chunks(position_path)
+                    fallback.add(position_path)
+                    position_queue.insert(0, position)
+                    workloads[position_path] = position_workload(position_path)
+                    return
+                if needs_sequence_pass(position_path):
+                    sequence_pass.add(position_path)
+                    position_queue.insert(0, position)
+                    workloads[position_path] = position_workload(position_path, 'track')
+                    return
+            if task_path in parent_of or task_path in sequence_pass:
+                write_position_fingerprint(position_path, chunked[position_path]['fingerprint'])
+            ledger.finish(position_path, 'done', 'ok')
+        remaining[main_folder] -= 1
+        if remaining[main_folder] == 0:
+            print(f'\tFinished {os.path.basename(os.path.normpath(main_folder))} after '
+                  f'{format_timespan(time.time() - time_start)}')
+
+    rss_ceiling = int(admission.budget * WORKER_RSS_CEILING_FRACTION)
+    with WorkerPool(cpu_count, MAX_TASKS_PER_WORKER, rss_ceiling) as pool:
+        futures = set()
+        position_queue = list(positions)
 
-            # psutil.Process.cpu_percent returns 0..(100 * cpu_count). Divide
-            # to express as share of total system capacity (0..100).
-            worker_share = worker_cpu_total / cpu_count
-            print(f'\tSingle WC worker is using ~{worker_share:.1f}% of total CPU capacity')
+        controller = ConcurrencyController(cpu_threshold, cores_per_task)
+        if cores_per_task:
+            print(f'\tFrom earlier runs, a WC worker uses ~{100 * cores_per_task / cpu_count:.1f}% of total CPU '
+                  f'capacity; starting with {controller.limit} processes')
+        else:
+            print('\tNo earlier runs of these positions; starting with 1 process and growing from measurements')
 
-            if worker_share > 0:
-                max_processes = max(1, int(cpu_threshold / worker_share))
-            else:
-                # Couldn't measure (worker exited early or wasn't found yet).
-                # Fall back to slider-as-fraction-of-cores.
-                max_processes = max(1, int(cpu_count * cpu_threshold / 100))
-            print(f'\tMaximum number of processes that can run: {max_processes}')
-
-            # Submit remaining subfolders based on calculated max processes
-            while subfolder_queue and len(futures) < max_processes:
-                next_subfolder = subfolder_queue.pop(0)
-                future = executor.submit(wc_run, next_subfolder.path)
-                futures.add(future)
-                print(f'\tAdded process for {next_subfolder.name}.')
-
-        # Process remaining subfolders as tasks complete
-        while futures or subfolder_queue:
-            done, futures = wait(futures, timeout=5, return_when=FIRST_COMPLETED)
+        if None not in expected_seconds.values():
+            predicted_makespan = lpt_makespan(list(expected_seconds.values()), controller.limit)
+            print(f'\tPredicted makespan for {len(positions)} positions: {format_timespan(predicted_makespan)}')
+        else:
+            predicted_makespan = None
+
+        # Keep up to controller.limit positions in flight, topping up as each one finishes
+        memory_wait_reported = False
+        while futures or position_queue:
+            controller.update(len(futures), len(position_queue))
+            while position_queue and len(futures) < controller.limit:
+                # The largest position that fits in memory; smaller ones may backfill while a large one waits
+                next_position = next((position for position in position_queue
+                                      if admission.admits(workloads[position[1]])), None)
+                if next_position is None:
+                    if not memory_wait_reported:
+                        print(f'\tWaiting for memory before starting more positions ({admission.headroom()})')
+                        memory_wait_reported = True
+                    break
+                memory_wait_reported = False
+                position_queue.remove(next_position)
+                futures.add(submit(next_position))
+                print(f'\tAdded process for {name(next_position)}.')
+
+            done, futures = wait(futures, timeout=controller.interval, return_when=FIRST_COMPLETED)
             for future in done:
-                try:
-                    future.result()  # Check for exceptions
-                except Exception as e:
-                    print(f'\tError processing subfolder: {e}')
-
-            # Add new tasks if there are subfolders remaining and we're below max_processes
-            while subfolder_queue and len(futures) < max_processes:
-                next_subfolder = subfolder_queue.pop(0)
-                future = executor.submit(wc_run, next_subfolder.path)
-                futures.add(future)
-                print(f'\tAdded future for {next_subfolder.name}.')
-
-            # Wait for all remaining futures to complete
-            wait(futures, return_when=ALL_COMPLETED)
+                finish(future)
+
+    cost_model.save()
+    write_failure_list(path_output_fn, positions_run, failures)
+    ledger.close()
+    makespan = time.time() - time_start
+    if predicted_makespan is not None:
+        print(f'\tMakespan: {format_timespan(makespan)} (predicted {format_timespan(predicted_makespan)})')
+    else:
+        print(f'\tMakespan: {format_timespan(makespan)} (no history to predict it)')
+    if pool.recycled:
+        print(f'\tRecycled {pool.recycled} worker processes')
     print('\tAll subfolders processed.')
+
+
+def run_plate(path_output_fn, basename_list_fn: list, cpu_threshold: int,
+              run_before_injury_and_after_injury_together: bool, memory_percent: float = 80, force: bool = False,
+              frame_chunk_size: int = None):
+    """Run WoundCompute in parallel on every basename folder of an organized output folder, with the positions of all
+    basenames in one work queue"""
+
+    time_start = time.time()
+    print("\tStarting WoundCompute for each experiment folder...")
+    print("\tStart time:", time.ctime())
+
+    main_folders = []
+    for index, basename in enumerate(basename_list_fn):
+        if run_before_injury_and_after_injury_together and basename.endswith('_bi'):
+            print(f"\tSkipping {basename}: handled inside the compiled folder during the *_ai pass.")
+            continue
+        print("\tQueueing folder:", basename)
+        main_folders.append(os.path.join(path_output_fn, basename))
+    try:
+        wc_process_folders(main_folders, cpu_threshold, memory_percent, force, frame_chunk_size)
+    except Exception as e:
+        print(f"\tERROR processing {', '.join(basename_list_fn)}: {e}")
+        traceback.print_exc()
+
+    print("\tEnd time:", time.ctime())
+    print("\tTotal time taken:", format_timespan(time.time() - time_start))
+
+
+# inotify event flags (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class FolderWatcher:
+    """Reports files that have finished being written to a folder. Uses inotify (close-after-write and moved-in
+    events) on Linux and falls back to polling elsewhere, or when inotify is unavailable, e.g. on some network
+    drives. A polled file is reported once its size and mtime are unchanged between two scans. Files already in the
+    folder are reported by the first call to wait"""
+
+    def __init__(self, path: str, poll_interval: float = 2.0, use_inotify: bool = True):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.seen = set()
+        self._pending = {}
+        self._fd = self._init_inotify(path) if use_inotify else None
+        self.backend = 'inotify' if self._fd is not None else 'polling'
+        # With inotify the folder is only rescanned now and then, to catch events missed by the kernel queue
+        self._rescan_interval = 60.0 if self._fd is not None else poll_interval
+        self._last_scan = None
+
+    @staticmethod
+    def _init_inotify(path: str):
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def _read_events(self, timeout: float) -> list:
+        names = []
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return names
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buffer):
+            _, mask, _, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = buffer[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                self._last_scan = None
+            elif name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def _scan(self) -> list:
+        ready = []
+        now = time.time()
+        for entry in os.scandir(self.path):
+            if entry.name in self.seen or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if self._pending.get(entry.name) == signature or now - stat.st_mtime > 2 * self.poll_interval:
+                ready.append(entry.name)
+            else:
+                self._pending[entry.name] = signature
+        self._last_scan = now
+        return ready
+
+    def wait(self, timeout: float = None) -> list:
+        """Returns the names of files completed since the last call, waiting up to timeout (default poll_interval)
+        seconds for at least one"""
+        timeout = self.poll_interval if timeout is None else timeout
+        if self._fd is not None and self._last_scan is not None:
+            names = self._read_events(timeout)
+        else:
+            names = []
+            if self._last_scan is not None:
+                time.sleep(timeout)
+        if self._last_scan is None or time.time() - self._last_scan >= self._rescan_interval:
+            names += self._scan()
+        ready = []
+        for name in names:
+            if name not in self.seen:
+                self.seen.add(name)
+                self._pending.pop(name, None)
+                ready.append(name)
+        return ready
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def expected_position_frames(nd_info: NDInfo) -> int:
+    """Number of TIFs one stage position holds once acquisition ends: one per timepoint and wavelength"""
+    return nd_info.timepoints * max(1, len(nd_info.wavelengths))
+
+
+def watch_plate(path_input_fn: str, path_output_fn: str, image_type_fn: str, low_quality_frame_inds: List,
+                run_before_injury_and_after_injury_together: bool, cpu_threshold: int = 80, link_mode: str = 'copy',
+                expected_frames: int = None, poll_interval: float = 2.0, idle_timeout: float = None,
+                use_inotify: bool = True, stop_event: threading.Event = None, force: bool = False,
+                ms_choice: str = '') -> (list, dict):
+    """Organize and analyze a plate while it is being acquired. Every new TIF in the input folder is placed in its
+    <basename>/<position>/<type>_images folder as soon as it has been written. A position is complete when it holds
+    its expected number of frames, taken from NTimePoints (times the number of wavelengths) of the basename's .nd
+    file or from expected_frames, and is then submitted to a WorkerPool running wc_run, with the timeouts, retries,
+    RunLedger and failed_positions.tsv of wc_process_positions. Watching ends when every
+    stage position listed in the .nd files is complete, after idle_timeout seconds without new files (positions
+    that are still incomplete are then analyzed with the frames they have), or when stop_event is set. Placed files
+    are recorded in the OrganizeJournal, so a stopped watch can be restarted on the same output folder, and
+    positions already analyzed with the same images are not analyzed again unless force is set. Only the flat
+    MetaMorph layout, with every TIF directly in the input folder, can be watched; Cytation plates (one sub folder
+    per experiment) raise ValueError. Returns the basename list and stage position maps"""
+
+    cytation_folders = [entry.name for entry in os.scandir(path_input_fn)
+                        if entry.is_dir() and os.path.normpath(entry.path) != os.path.normpath(path_output_fn)
+                        and any(name.lower().endswith(('.tif', '.tiff')) for name in os.listdir(entry.path))]
+    if ms_choice == "Cytation" or cytation_folders:
+        raise ValueError("Watch mode only handles the MetaMorph layout with every .tif file directly in the input "
+                         "folder" + (f"; found .tif files in {', '.join(cytation_folders)}" if cytation_folders else
+                                     "") + ". Organize and run Cytation plates once acquisition has finished.")
+
+    create_wc_yaml(path_output_fn, image_type_in=image_type_fn, is_fl_in=False, is_pillars_in=True,
+                   low_quality_frame_inds=low_quality_frame_inds,
+                   run_before_injury_and_after_injury_together=run_before_injury_and_after_injury_together)
+    yaml_src = os.path.join(path_output_fn, f'wc_dataset_{image_type_fn}.yaml')
+
+    nd_infos = {}             # basename -> NDInfo
+    basename_list = []
+    position_frames = {}      # (basename, position) -> set of frame names
+    position_tokens = {}      # basename -> position tokens seen, for basenames without an .nd file
+    submitted = set()
+    futures = {}              # Future -> (basename, position)
+    workloads = {}
+    attempts = {}
+    positions_run = []
+    failures = []
+    cost_model = CostModel()
+
+    def add_basename(basename_fn):
+        if basename_fn not in basename_list:
+            basename_list.append(basename_fn)
+            os.makedirs(os.path.join(path_output_fn, basename_fn), exist_ok=True)
+            write_to_sp_yaml(path_output_fn, basename_list, 'basename_list')
+            print(f'\tNew experiment: {basename_fn}')
+
+    def add_nd(basename_fn):
+        add_basename(basename_fn)
+        nd_dest = os.path.join(path_output_fn, basename_fn, basename_fn + '.nd')
+        copy_file(os.path.join(path_input_fn, basename_fn + '.nd'), nd_dest)
+        nd_infos[basename_fn] = parse_nd_file(nd_dest)
+        print(f'\t{basename_fn}: {len(nd_infos[basename_fn].stage_positions)} stage positions, '
+              f'{expected_position_frames(nd_infos[basename_fn])} frames per position')
+
+    def basename_for(file):
+        """The basename of a TIF: the longest known or on-disk .nd name prefixing it, else the name's stem"""
+        prefixes = [file[:ind] for ind, char in enumerate(file) if char == '_']
+        for prefix in reversed(prefixes):
+            if prefix in nd_infos:
+                return prefix
+        for prefix in reversed(prefixes):
+            if os.path.isfile(os.path.join(path_input_fn, prefix + '.nd')):
+                add_nd(prefix)
+                return prefix
+        basenames = basenames_from_tif_names([file])
+        return basenames[0] if basenames else None
+
+    def expected_for(basename_fn):
+        if expected_frames:
+            return expected_frames
+        if basename_fn in nd_infos:
+            return expected_position_frames(nd_infos[basename_fn])
+        return None
+
+    def submit_position(key, reason):
+        basename_fn, spos = key
+        submitted.add(key)
+        if run_before_injury_and_after_injury_together and basename_fn.endswith('_bi'):
+            print(f'\t{basename_fn}/{spos} {reason}; it is analyzed with its *_ai position')
+            return
+        position_path = os.path.join(path_output_fn, basename_fn, spos)
+        if not force and position_up_to_date(position_path):
+            print(f'\t{basename_fn}/{spos} {reason}; its outputs are up to date')
+            return
+        workloads[key] = position_workload(position_path)
+        positions_run.append((os.path.join(path_output_fn, basename_fn), position_path))
+        ledger.queue([positions_run[-1]])
+        run_position(key)
+        print(f'\t{basename_fn}/{spos} {reason}, submitted for analysis')
+
+    def run_position(key):
+        # The ledger marks the position running once a worker picks it up, with that worker's pid
+        position_path = os.path.join(path_output_fn, *key)
+        attempts[key] = attempts.get(key, 0) + 1
+        expected = estimate_position_seconds({position_path: workloads[key]}, cost_model)[position_path]
+        future = pool.submit(wc_run, position_path, timeout=task_timeout(workloads[key], expected),
+                             on_start=partial(ledger.start, position_path))
+        futures[future] = key
+
+    def finish_position(key, future, retry: bool = True):
+        basename_fn, spos = key
+        position_path = os.path.join(path_output_fn, basename_fn, spos)
+        try:
+            stats = future.result()
+        except Exception as e:
+            reason = f'{type(e).__name__}: {e}'
+            if retry and is_transient_error(e) and attempts[key] <= MAX_TASK_RETRIES:
+                print(f'\tError processing {basename_fn}/{spos} ({reason}), retrying')
+                ledger.finish(position_path, 'queued', reason)
+                run_position(key)
+                return
+            ledger.finish(position_path, 'failed', reason)
+            failures.append((os.path.join(path_output_fn, basename_fn), position_path, reason, attempts[key]))
+            print(f'\tError processing {basename_fn}/{spos}: {reason}')
+            return
+        if stats:
+            cost_model.record(workloads[key], stats)
+        ledger.finish(position_path, 'done', 'ok')
+        print(f'\t{basename_fn}/{spos} analyzed')
+
+    def all_positions_complete():
+        if not basename_list or any(basename_fn not in nd_infos for basename_fn in basename_list):
+            return False
+        for basename_fn in basename_list:
+            num_submitted = sum(1 for key in submitted if key[0] == basename_fn)
+            if num_submitted < len(nd_infos[basename_fn].stage_positions):
+                return False
+        return True
+
+    max_processes = max(1, int((psutil.cpu_count() or 1) * cpu_threshold / 100))
+    watcher = FolderWatcher(path_input_fn, poll_interval, use_inotify)
+    journal = OrganizeJournal(path_output_fn)
+    ledger = RunLedger(path_output_fn)
+    pool = WorkerPool(max_processes, MAX_TASKS_PER_WORKER)
+    print(f'\tWatching {path_input_fn} ({watcher.backend}), analyzing up to {max_processes} positions at a time')
+    time_start = time.time()
+    last_file_time = time.time()
+    interrupted = False
+    place_failed = False
+
+    try:
+        while not (stop_event is not None and stop_event.is_set()):
+            names = watcher.wait()
+            if names:
+                last_file_time = time.time()
+            # .nd files first, they name the stage positions of the TIFs that follow
+            for name in sorted(names, key=lambda n: not n.endswith('.nd')):
+                if name.endswith('.nd'):
+                    if os.path.splitext(name)[0] not in nd_infos:
+                        add_nd(os.path.splitext(name)[0])
+                    continue
+                if not name.lower().endswith(('.tif', '.tiff')) or 'thumb' in name:
+                    continue
+
+                basename_fn = basename_for(name)
+                if basename_fn is None:
+                    print(f'\tSkipped {name}: no experiment name found')
+                    continue
+                add_basename(basename_fn)
+                is_nd = basename_fn in nd_infos
+                tokens = parse_image_name(name)
+                stage_pos_map = {basename_fn: nd_infos[basename_fn].stage_positions} if is_nd else {}
+                spos, new_filename = rename_for_position(name, basename_fn, stage_pos_map, is_nd, tokens)
+                if spos is None:
+                    print(f'\tSkipped {name}: no stage position found in file name')
+                    continue
+                if not is_nd:
+                    position_tokens.setdefault(basename_fn, []).append(tokens[1] or tokens[2])
+
+                key = (basename_fn, spos)
+                target_dir = os.path.join(path_output_fn, basename_fn, spos, f'{image_type_fn}_images')
+                if key not in position_frames:
+                    os.makedirs(target_dir, exist_ok=True)
+                    shutil.copy2(yaml_src, os.path.join(path_output_fn, basename_fn, spos,
+                                                        f'wc_dataset_{image_type_fn}.yaml'))
+                    position_frames[key] = set()
+                if key in submitted:
+                    print(f'\tWARNING: {name} arrived after {basename_fn}/{spos} was submitted for analysis')
+
+                src = os.path.join(path_input_fn, name)
+                target_path = os.path.join(target_dir, new_filename)
+                try:
+                    stat = os.stat(src)
+                except FileNotFoundError:
+                    # Acquisition software renames or removes temporary files right after writing them
+                    print(f'\tSkipped {name}: removed before it could be placed')
+                    continue
+                if not journal.is_complete(src, target_path, stat.st_size, stat.st_mtime):
+                    try:
+                        _, _, strategy, _, _ = place_file_task(src, target_path, link_mode, stat.st_size,
+                                                               stat.st_mtime)
+                    except OSError as e:
+                        print(f'\tError placing {src}: {e}')
+                        place_failed = True
+                        continue
+                    journal.record(src, target_path, strategy, stat.st_size, stat.st_mtime)
+                position_frames[key].add(new_filename)
+
+                expected = expected_for(basename_fn)
+                if key not in submitted and expected and len(position_frames[key]) >= expected:
+                    submit_position(key, f'complete ({len(position_frames[key])} frames)')
+
+            for future in [future for future in futures if future.done()]:
+                finish_position(futures.pop(future), future)
+
+            if all_positions_complete():
+                print('\tAll stage positions are complete')
+                if not place_failed:
+                    journal.mark_finished()
+                break
+            if idle_timeout is not None and time.time() - last_file_time > idle_timeout:
+                print(f'\tNo new files for {format_timespan(idle_timeout)}, stopping the watch')
+                for key in sorted(position_frames):
+                    if key not in submitted:
+                        submit_position(key, f'incomplete ({len(position_frames[key])} frames)')
+                break
+
+        watcher.close()
+        # Wait for the positions still being analyzed, retrying transient failures
+        while futures:
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                finish_position(futures.pop(future), future)
+    except KeyboardInterrupt:
+        interrupted = True
+        print('\tWatch interrupted; restart it on the same output folder to continue')
+    finally:
+        watcher.close()
+        journal.close()
+        pool.shutdown(wait=True, cancel_futures=interrupted)
+
+    for future, key in futures.items():
+        if not future.cancelled():
+            finish_position(key, future, retry=False)
+
+    ledger.close()
+    cost_model.save()
+    write_failure_list(path_output_fn, positions_run, failures)
+    stage_pos_maps = {}
+    for basename_fn in basename_list:
+        if basename_fn in nd_infos:
+            stage_pos_maps[basename_fn] = dict(nd_infos[basename_fn].stage_positions)
+        else:
+            stage_pos_maps[basename_fn] = stage_position_map(position_tokens.get(basename_fn, []))
+    print(f'\tWatched for {format_timespan(time.time() - time_start)}: {len(position_frames)} positions, '
+          f'{len(submitted)} submitted for analysis')
+    return basename_list, stage_pos_maps